@@ -0,0 +1,193 @@
+"""
+BillFlow Agorot Engine
+Fixed-point money for the invoice lines: every amount is taken from the CSV once
+as an int64 count of milli-agorot (1/100000 ILS - the CSV's 1/1000 ILS amounts
+are exact in it), and all further arithmetic is integer.
+
+- The included lines of each CSV row are allocated the row's Total cost with a
+  largest-remainder split in proportion to the row's CSV components, so every row
+  (and so every document) sums to its CSV total exactly. The weights are the CSV
+  columns themselves, not the float lines scaled by the adjustment factor.
+- VAT is computed per line in integer milli-agorot, rounded half away from zero.
+- Documents are checked against the unrounded CSV totals.
+All steps are vectorized over the whole file.
+"""
+import numpy as np
+import pandas as pd
+
+VAT_PERCENT = 18
+UNITS_PER_ILS = 100000
+
+DOCUMENT_COLUMN = 'מספר חשבונית'
+AMOUNT_COLUMN = 'סכום '
+VAT_COLUMN = 'סכום המע"מ'
+TOTAL_COLUMN = 'סכום כולל מע"מ'
+INCLUDED_COLUMN = 'כלול בחיוב'
+QUANTITY_COLUMN = 'כמות'
+UNIT_PRICE_COLUMN = 'מחיר יחידה'
+UNIT_COLUMN = 'יחידת מידה'
+
+# Included lines of one CSV row in the order generate_invoice_lines writes them:
+# (CSV column, sign of the line amount, when the line is written)
+#   'amount'   - the CSV amount is positive
+#   'adjusted' - the amount after the row's adjustment factor is positive
+#   'nonzero'  - the amount after the row's adjustment factor is not zero
+INCLUDED_COMPONENTS = [
+    ('Total discount peak (ILS)', -1, 'amount'),
+    ('Total discount off-peak (ILS)', -1, 'amount'),
+    ('Energy cost peak by TOU tariff', 1, 'amount'),
+    ('Energy cost off-peak by TOU tariff', 1, 'amount'),
+    ('Supply', 1, 'adjusted'),
+    ('Distribution', 1, 'adjusted'),
+    ('KVA cost', 1, 'adjusted'),
+    ('Power factor fine', 1, 'adjusted'),
+    ('Various charges', 1, 'adjusted'),
+    ('Various credits', 1, 'nonzero'),
+]
+
+
+def to_units(values):
+    """ILS amounts to int64 milli-agorot (rounded half away from zero)."""
+    values = np.asarray(values, dtype=float) * UNITS_PER_ILS
+    return (np.sign(values) * np.floor(np.abs(values) + 0.5)).astype(np.int64)
+
+
+def vat_units(amounts, vat_percent=VAT_PERCENT):
+    """Integer VAT of int64 milli-agorot amounts, rounded half away from zero."""
+    amounts = np.asarray(amounts, dtype=np.int64)
+    return np.sign(amounts) * ((np.abs(amounts) * vat_percent + 50) // 100)
+
+
+def largest_remainder(weights, groups, targets):
+    """
+    Split each group's integer target over its members in proportion to integer
+    weights (negative weights, e.g. discounts, are allowed). groups are codes
+    0..G-1, targets is (G,) int64; groups whose weights do not sum to a positive
+    value keep their weights. Returns int64 shares that sum exactly to the target
+    of every allocated group.
+    """
+    weights = np.asarray(weights, dtype=np.int64)
+    groups = np.asarray(groups, dtype=np.int64)
+    targets = np.asarray(targets, dtype=np.int64)
+    weight_sums = np.bincount(groups, weights=weights, minlength=len(targets))
+    allocate = weight_sums[groups] > 0
+
+    quotas = weights / np.where(allocate, weight_sums[groups], 1.0) * targets[groups]
+    shares = np.floor(quotas).astype(np.int64)
+    remainders = quotas - shares
+
+    # Units still missing per group go to the members with the largest remainders;
+    # float error in the quotas can also leave one unit too many, taken from the smallest
+    missing = targets - np.bincount(groups, weights=shares, minlength=len(targets)).astype(np.int64)
+    order = np.lexsort((-remainders, groups))
+    group_starts = np.searchsorted(groups[order], np.arange(len(targets)))
+    rank = np.empty(len(weights), dtype=np.int64)
+    rank[order] = np.arange(len(weights)) - group_starts[groups[order]]
+    rank_from_end = np.bincount(groups, minlength=len(targets))[groups] - 1 - rank
+    shares += (allocate & (rank < missing[groups])).astype(np.int64)
+    shares -= (allocate & (rank_from_end < -missing[groups])).astype(np.int64)
+
+    return np.where(allocate, shares, weights)
+
+
+def included_components(csv_rows):
+    """
+    The included line amounts of the CSV rows before adjustment.
+    Returns (units, written, targets): (rows x components) int64 milli-agorot,
+    whether generate_invoice_lines writes that line, and each row's Total cost.
+    """
+    values = np.column_stack([
+        pd.to_numeric(csv_rows[column], errors='coerce').fillna(0.0).to_numpy(dtype=float)
+        if column in csv_rows.columns else np.zeros(len(csv_rows))
+        for column, _, _ in INCLUDED_COMPONENTS
+    ])
+    raw = values * np.array([sign for _, sign, _ in INCLUDED_COMPONENTS], dtype=float)
+    totals = csv_rows['Total cost'].to_numpy(dtype=float)
+
+    # The converter's adjustment factor decides which fixed-charge lines are written
+    components_sum = raw.sum(axis=1)
+    factor = np.divide(totals, components_sum, out=np.ones(len(totals)), where=components_sum > 0)
+    adjusted = values * factor[:, None]
+    conditions = {'amount': values > 0, 'adjusted': adjusted > 0, 'nonzero': adjusted != 0}
+    written = np.column_stack([conditions[when][:, j] for j, (_, _, when) in enumerate(INCLUDED_COMPONENTS)])
+    return to_units(raw), written, to_units(totals)
+
+
+def apply_agorot_amounts(lines, csv_rows, vat_percent=VAT_PERCENT):
+    """
+    Recompute the money columns of the invoice lines in integer milli-agorot.
+    csv_rows is the cleaned CSV frame the lines were generated from (same row
+    order). Returns (lines with amounts from milli-agorot, stats).
+    """
+    lines = lines.copy()
+    included = (lines[INCLUDED_COLUMN] == 'כן').to_numpy()
+    units, written, targets = included_components(csv_rows)
+
+    # Included lines come row by row, components in order - the True cells of written
+    line_rows = np.nonzero(written)[0]
+    row_documents = csv_rows['Document number'].to_numpy(dtype=float).astype(np.int64)
+    if (len(line_rows) != included.sum() or
+            (row_documents[line_rows] != lines.loc[included, DOCUMENT_COLUMN].to_numpy(dtype=np.int64)).any()):
+        raise ValueError("Invoice lines do not match the CSV rows they were generated from")
+
+    # Display lines are CSV amounts as they are; included lines share their row's total
+    amounts = to_units(lines[AMOUNT_COLUMN])
+    amounts[included] = largest_remainder(units[written], line_rows, targets)
+
+    vat = vat_units(amounts, vat_percent)
+    lines[AMOUNT_COLUMN] = amounts / UNITS_PER_ILS
+    lines[VAT_COLUMN] = vat / UNITS_PER_ILS
+    lines[TOTAL_COLUMN] = (amounts + vat) / UNITS_PER_ILS
+
+    # Per-kWh prices of included energy and discount lines follow the new amounts
+    quantities = pd.to_numeric(lines[QUANTITY_COLUMN], errors='coerce').to_numpy()
+    priced = included & (lines[UNIT_COLUMN] == 'kWh').to_numpy()
+    prices = np.divide(amounts / UNITS_PER_ILS, quantities, out=np.zeros(len(lines)),
+                       where=priced & (quantities > 0))
+    lines[UNIT_PRICE_COLUMN] = lines[UNIT_PRICE_COLUMN].astype(object)
+    lines.loc[priced, UNIT_PRICE_COLUMN] = prices[priced]
+
+    # Reconciliation against the CSV totals (integers, so exact)
+    doc_codes, doc_values = pd.factorize(row_documents)
+    csv_documents = np.zeros(len(doc_values), dtype=np.int64)
+    np.add.at(csv_documents, doc_codes, targets)
+    line_documents = np.zeros(len(doc_values), dtype=np.int64)
+    np.add.at(line_documents, doc_codes[line_rows], amounts[included])
+    row_weights = np.zeros(len(targets), dtype=np.int64)
+    np.add.at(row_weights, line_rows, units[written])
+
+    included_units = int(amounts[included].sum())
+    csv_units = int(targets.sum())
+    stats = {
+        'engine': 'agorot',
+        'unit': 'milli-agorot',
+        'vat_percent': vat_percent,
+        'documents': int(len(doc_values)),
+        'documents_exact': int((line_documents == csv_documents).sum()),
+        'rows_unallocated': int((row_weights <= 0).sum()),
+        'included_units': included_units,
+        'csv_units': csv_units,
+        'vat_units': int(vat[included].sum()),
+        'difference': abs(csv_units - included_units) / UNITS_PER_ILS,
+    }
+    return lines, stats
+
+
+def document_amounts(lines, item_columns):
+    """
+    Per-document money columns of the per-document summary, from final lines.
+    item_columns maps fixed-charge item codes to summary columns.
+    """
+    included = lines[INCLUDED_COLUMN] == 'כן'
+    peak = lines['מש"ב'] == 'פסגה'
+    category = lines['מזהה פריט'].map(item_columns)
+    category = category.where(category.notna() | ~included, np.where(peak, 'energy_peak', 'energy_offpeak'))
+    category = category.where(included, np.where(peak, 'gross_peak', 'gross_offpeak'))
+
+    amounts = pd.DataFrame({'document': lines[DOCUMENT_COLUMN], 'category': category, 'amount': lines[AMOUNT_COLUMN]})
+    table = amounts.pivot_table(index='document', columns='category', values='amount', aggfunc='sum', fill_value=0.0)
+    totals = lines[included].groupby(DOCUMENT_COLUMN)[[AMOUNT_COLUMN, VAT_COLUMN, TOTAL_COLUMN]].sum()
+    table['total'] = totals[AMOUNT_COLUMN]
+    table['vat'] = totals[VAT_COLUMN]
+    table['total_with_vat'] = totals[TOTAL_COLUMN]
+    return table.fillna(0.0)
@@ -0,0 +1,236 @@
+"""
+BillFlow Anomaly Detector
+Scores every site-month against the same meter's own recent history and
+stores the flagged ones in a small SQLite table.
+
+For each metric the trailing window of the previous ROLLING_WINDOW converted
+months gives a median and a MAD (median absolute deviation); the robust score is
+    z = 0.6745 * (value - median) / MAD
+Peak consumption moves with the TOU season (winter peak hours cover the evening
+lighting load), so it is only compared with earlier months of the same Season
+within SEASONAL_WINDOW months.
+The windows are built with sliding_window_view over the whole sites x months
+matrix, so there is no per-site Python loop; sites are processed in blocks
+sized to WINDOW_CELL_BUDGET to bound memory.
+
+Flags:
+    peak_spike          peak consumption far above the meter's usual level
+    power_factor_fine   a power factor fine far above the meter's usual fines
+    availability_drop   current availability far below the meter's usual level
+    below_guaranteed    current availability under the guaranteed availability
+"""
+import os
+import sys
+import json
+import sqlite3
+import warnings
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from site_history import load_site_records, build_site_matrix
+
+ROLLING_WINDOW = 12
+SEASONAL_WINDOW = 24
+MIN_HISTORY = 3
+Z_THRESHOLD = 3.5
+
+# Floors on the MAD so a perfectly flat history does not flag tiny changes:
+# max(absolute floor, relative floor * |median|)
+METRICS = {
+    'peak_consumption': {'reason': 'peak_spike', 'direction': 1, 'mad_floor': 1.0, 'relative_floor': 0.25,
+                         'seasonal': True},
+    'power_factor_fine': {'reason': 'power_factor_fine', 'direction': 1, 'mad_floor': 1.0, 'relative_floor': 0.05,
+                          'seasonal': False},
+    'availability_current': {'reason': 'availability_drop', 'direction': -1, 'mad_floor': 1.0, 'relative_floor': 0.0,
+                             'seasonal': False},
+}
+EXTRA_FIELDS = ['availability_guaranteed']
+
+# Upper bound on sites x months x window cells held at once (~32 MB per array)
+WINDOW_CELL_BUDGET = 4_000_000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS anomalies (
+    site TEXT NOT NULL,
+    billing_period TEXT NOT NULL,
+    reason TEXT NOT NULL,
+    site_name TEXT,
+    metric TEXT NOT NULL,
+    value REAL,
+    median REAL,
+    mad REAL,
+    score REAL,
+    history_months INTEGER,
+    PRIMARY KEY (site, billing_period, reason)
+);
+CREATE INDEX IF NOT EXISTS idx_anomalies_period ON anomalies (billing_period, reason);
+CREATE INDEX IF NOT EXISTS idx_anomalies_score ON anomalies (score DESC);
+"""
+
+
+def rolling_robust_stats(values, window=ROLLING_WINDOW, columns=None):
+    """
+    Median, MAD and observation count of the `window` months before each cell.
+    values is (sites, months) with NaN gaps; columns limits the output to those month positions.
+    Returns three (sites, len(columns)) arrays.
+    """
+    sites, months = values.shape
+    columns = np.arange(months) if columns is None else np.asarray(columns)
+    padded = np.concatenate([np.full((sites, window), np.nan), values], axis=1)
+    block = max(1, WINDOW_CELL_BUDGET // max(1, len(columns) * window))
+
+    median = np.full((sites, len(columns)), np.nan)
+    mad = np.full((sites, len(columns)), np.nan)
+    count = np.zeros((sites, len(columns)), dtype=int)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)  # all-NaN windows
+        for start in range(0, sites, block):
+            # windows[:, j] covers values[:, j - window:j] - the months before j
+            windows = sliding_window_view(padded[start:start + block], window, axis=1)[:, columns, :]
+            med = np.nanmedian(windows, axis=2)
+            median[start:start + block] = med
+            mad[start:start + block] = np.nanmedian(np.abs(windows - med[:, :, None]), axis=2)
+            count[start:start + block] = (~np.isnan(windows)).sum(axis=2)
+    return median, mad, count
+
+
+def seasonal_robust_stats(values, seasons, window=SEASONAL_WINDOW, columns=None):
+    """rolling_robust_stats where each month only sees earlier months of its own season."""
+    seasons = np.asarray(seasons)
+    columns = np.arange(values.shape[1]) if columns is None else np.asarray(columns)
+    median = np.full((values.shape[0], len(columns)), np.nan)
+    mad = np.full_like(median, np.nan)
+    count = np.zeros(median.shape, dtype=int)
+    for season in np.unique(seasons[columns]):
+        in_season = seasons[columns] == season
+        masked = np.where(seasons[None, :] == season, values, np.nan)
+        median[:, in_season], mad[:, in_season], count[:, in_season] = \
+            rolling_robust_stats(masked, window, columns[in_season])
+    return median, mad, count
+
+
+def score_metric(values, metric, window=ROLLING_WINDOW, columns=None, seasons=None):
+    """
+    Robust z-scores (sites, columns), signed so that positive means anomalous.
+    seasons (one per month) is required for seasonal metrics.
+    """
+    config = METRICS[metric]
+    columns = np.arange(values.shape[1]) if columns is None else np.asarray(columns)
+    if config['seasonal']:
+        median, mad, count = seasonal_robust_stats(values, seasons, max(window, SEASONAL_WINDOW), columns)
+    else:
+        median, mad, count = rolling_robust_stats(values, window, columns)
+    current = values[:, columns]
+    scale = np.maximum(mad, np.maximum(config['mad_floor'], config['relative_floor'] * np.abs(median)))
+    score = config['direction'] * 0.6745 * (current - median) / scale
+    score = np.where((count >= MIN_HISTORY) & ~np.isnan(current), score, np.nan)
+    return score, current, median, mad, count
+
+
+def period_seasons(records, periods):
+    """The Season billed in each period (most common value across its records)."""
+    counts = {}
+    for record in records:
+        period_counts = counts.setdefault(record.get('billing_period'), {})
+        period_counts[record.get('season')] = period_counts.get(record.get('season'), 0) + 1
+    return [max(counts[p], key=counts[p].get) if p in counts else None for p in periods]
+
+
+def detect_anomalies(records, periods=None, key='meter_number', window=ROLLING_WINDOW, threshold=Z_THRESHOLD):
+    """
+    Score site-months in `periods` (default: every period) and return the flagged rows.
+    """
+    matrix = build_site_matrix(records, list(METRICS) + EXTRA_FIELDS, key=key)
+    all_periods = matrix['periods']
+    periods = all_periods if periods is None else [p for p in periods if p in all_periods]
+    columns = np.array([all_periods.index(p) for p in periods], dtype=int)
+    names = matrix['attributes']['site_name'].to_numpy() if 'site_name' in matrix['attributes'] else None
+    seasons = period_seasons(records, all_periods)
+    flagged = []
+
+    def collect(mask, reason, metric, values, median, mad, score, count):
+        for i, j in zip(*np.nonzero(mask)):
+            flagged.append({
+                'site': str(matrix['sites'][i]),
+                'billing_period': periods[j],
+                'reason': reason,
+                'site_name': None if names is None else names[i],
+                'metric': metric,
+                'value': float(values[i, j]),
+                'median': None if np.isnan(median[i, j]) else float(median[i, j]),
+                'mad': None if np.isnan(mad[i, j]) else float(mad[i, j]),
+                'score': float(score[i, j]),
+                'history_months': int(count[i, j]),
+            })
+
+    for metric, config in METRICS.items():
+        score, current, median, mad, count = score_metric(matrix['values'][metric], metric, window, columns, seasons)
+        with np.errstate(invalid='ignore'):
+            mask = score > threshold
+        if metric == 'power_factor_fine':
+            mask &= current > 0
+        collect(mask, config['reason'], metric, current, median, mad, score, count)
+
+    # Contractual check - needs no history
+    current = matrix['values']['availability_current'][:, columns]
+    guaranteed = matrix['values']['availability_guaranteed'][:, columns]
+    with np.errstate(invalid='ignore'):
+        shortfall = guaranteed - current
+        mask = (guaranteed > 0) & (shortfall > 0)
+    collect(mask, 'below_guaranteed', 'availability_current', current, guaranteed,
+            np.full_like(current, np.nan), shortfall, np.zeros_like(current, dtype=int))
+
+    flagged.sort(key=lambda r: (r['billing_period'], -r['score']))
+    return flagged
+
+
+def save_anomalies(db_path, anomalies, periods):
+    """Replace the stored flags of `periods` with `anomalies`."""
+    os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+    with sqlite3.connect(db_path) as conn:
+        conn.executescript(SCHEMA)
+        conn.executemany('DELETE FROM anomalies WHERE billing_period = ?', [(p,) for p in periods])
+        conn.executemany(
+            'INSERT OR REPLACE INTO anomalies (site, billing_period, reason, site_name, metric, value, '
+            'median, mad, score, history_months) VALUES (:site, :billing_period, :reason, :site_name, '
+            ':metric, :value, :median, :mad, :score, :history_months)',
+            anomalies)
+    conn.close()
+
+
+def summarize_anomalies(anomalies):
+    summary = {}
+    for row in anomalies:
+        summary[row['reason']] = summary.get(row['reason'], 0) + 1
+    return {'count': len(anomalies), 'by_reason': summary}
+
+
+def run_anomaly_stage(history_dir, db_path, periods, key='meter_number'):
+    """Post-conversion hook: score the newly converted periods against the saved history."""
+    anomalies = detect_anomalies(load_site_records(history_dir), periods, key=key)
+    save_anomalies(db_path, anomalies, periods)
+    return summarize_anomalies(anomalies)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print(json.dumps({'success': False, 'error': 'Usage: python anomaly_detector.py <anomalies.db> <history_json_or_dir>... [--period YYYY-MM] [--key meter_number|site_key]'}))
+        sys.exit(1)
+
+    args = sys.argv[1:]
+    options = {}
+    for flag in ('--period', '--key'):
+        if flag in args:
+            i = args.index(flag)
+            options[flag] = args[i + 1]
+            del args[i:i + 2]
+
+    try:
+        records = load_site_records(args[1:])
+        periods = [options['--period']] if '--period' in options else sorted({r['billing_period'] for r in records})
+        anomalies = detect_anomalies(records, periods, key=options.get('--key', 'meter_number'))
+        save_anomalies(args[0], anomalies, periods)
+        print(json.dumps({'success': True, 'periods': periods, **summarize_anomalies(anomalies)}))
+    except Exception as e:
+        print(json.dumps({'success': False, 'error': str(e)}))
+        sys.exit(1)
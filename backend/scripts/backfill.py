@@ -0,0 +1,254 @@
+"""
+BillFlow Rule Backfill
+Re-bills historical periods from their stored input files under a rule set version
+(see billing_rules.py) and reports what the new rules change per period.
+
+    python backfill.py <input_csv_or_dir>... --rules 2 [--before-rules 1]
+                       [--from YYYY-MM] [--to YYYY-MM] [--output DIR] [--workers N]
+                       [--parse-cache DIR] [--money float|agorot]
+
+- inputs are classified with the converter's header probe, so only the files of the
+  chosen periods are parsed
+- files are converted in a process pool; every worker bills its file twice from one
+  parse - invoice lines only under the before rules, full outputs under the new rules
+- outputs go to their own directory (default output/backfill_v<N>) with the input's
+  name as file suffix, so several stored files of one period never share outputs; next to
+    backfill_manifest.json   - rule version and fingerprint of every output file
+    backfill_diff_v<A>_v<B>.tsv - per-period before/after totals and deltas
+The dedupe index and the original outputs are never touched.
+"""
+import os
+import sys
+import glob
+import json
+import time
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+TOTAL_FIELDS = ['tsv_total', 'vat', 'total_with_vat', 'total_rows', 'included_rows']
+DIFF_COLUMNS = ['billing_period', 'files', 'csv_total',
+                *[f'{field}_{side}' for field in TOTAL_FIELDS for side in ('before', 'after', 'delta')]]
+
+
+def collect_inputs(paths):
+    """CSV files from the given files and directories (directories are not recursed)."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(glob.glob(os.path.join(path, '*.csv'))))
+        else:
+            files.append(path)
+    return files
+
+
+def select_inputs(files, period_from=None, period_to=None):
+    """(file, billing_period) for the files whose period is in range, plus the files that could not be probed."""
+    from billflow_converter import probe_csv
+
+    selected, skipped = [], []
+    for path in files:
+        try:
+            period = probe_csv(path)['billing_period']
+        except Exception as e:
+            skipped.append({'file': os.path.basename(path), 'error': str(e)})
+            continue
+        if period is None:
+            skipped.append({'file': os.path.basename(path), 'error': 'Billing period could not be read'})
+        elif (period_from is None or period >= period_from) and (period_to is None or period <= period_to):
+            selected.append((path, period))
+    return selected, skipped
+
+
+def output_suffixes(files):
+    """Output file suffix per input: its name, plus a path hash when two inputs share a name."""
+    stems = [os.path.splitext(os.path.basename(path))[0] for path in files]
+    suffixes = {}
+    for path, stem in zip(files, stems):
+        if stems.count(stem) > 1:
+            stem += '_' + hashlib.sha256(os.path.abspath(path).encode('utf-8')).hexdigest()[:8]
+        suffixes[path] = f'_{stem}'
+    return suffixes
+
+
+def invoice_totals(lines):
+    """Totals of an invoice-line DataFrame (included lines only, like the converter reports)."""
+    included = lines[lines['כלול בחיוב'] == 'כן']
+    return {
+        'tsv_total': float(included['סכום '].sum()),
+        'vat': float(included['סכום המע"מ'].sum()),
+        'total_with_vat': float(included['סכום כולל מע"מ'].sum()),
+        'total_rows': len(lines),
+        'included_rows': len(included),
+    }
+
+
+def backfill_file(csv_file, output_dir, rules, before_rules, parse_cache=None, money='float', file_suffix=''):
+    """Re-bill one stored input. Runs in a worker process and never raises."""
+    import pandas as pd
+    from billflow_converter import generate_invoice_lines, convert_billing_frame, load_billing_frame
+
+    started = time.perf_counter()
+    try:
+        if parse_cache is not None:
+            from parse_cache import cached_billing_frame
+            df, _ = cached_billing_frame(csv_file, parse_cache, load_billing_frame)
+        else:
+            df = load_billing_frame(csv_file)
+
+        before_lines = pd.DataFrame(generate_invoice_lines(df, rules=before_rules))
+        if money == 'agorot':
+            from agorot_engine import apply_agorot_amounts
+            before_lines, _ = apply_agorot_amounts(before_lines, df, before_rules['vat_percent'])
+        before = invoice_totals(before_lines)
+
+        result = convert_billing_frame(df, output_dir, file_suffix=file_suffix, money=money, rules=rules)
+        after = {
+            'tsv_total': result['tsv_total'],
+            'vat': result['total_with_vat'] - result['tsv_total'],
+            'total_with_vat': result['total_with_vat'],
+            'total_rows': result['total_rows'],
+            'included_rows': result['included_rows'],
+        }
+        return {
+            'success': True,
+            'file': os.path.basename(csv_file),
+            'path': csv_file,
+            'billing_period': result['billing_period'],
+            'csv_total': result['csv_total'],
+            'before': before,
+            'after': after,
+            'outputs': [result['tsv_filename'], result['excel_filename'], result['summary_filename']],
+            'rule_version': result['rule_version'],
+            'rule_fingerprint': result['rule_fingerprint'],
+            'seconds': time.perf_counter() - started,
+        }
+    except Exception as e:
+        return {'success': False, 'file': os.path.basename(csv_file), 'error': str(e),
+                'seconds': time.perf_counter() - started}
+
+
+def period_diff_rows(results):
+    """One row per billing period: summed before/after totals and their deltas."""
+    periods = {}
+    for r in results:
+        row = periods.setdefault(r['billing_period'], {'billing_period': r['billing_period'], 'files': 0,
+                                                       'csv_total': 0.0,
+                                                       **{f'{f}_{side}': 0 for f in TOTAL_FIELDS
+                                                          for side in ('before', 'after')}})
+        row['files'] += 1
+        row['csv_total'] += r['csv_total']
+        for field in TOTAL_FIELDS:
+            row[f'{field}_before'] += r['before'][field]
+            row[f'{field}_after'] += r['after'][field]
+
+    rows = []
+    for period in sorted(periods):
+        row = periods[period]
+        for field in TOTAL_FIELDS:
+            row[f'{field}_delta'] = row[f'{field}_after'] - row[f'{field}_before']
+        rows.append({column: row[column] for column in DIFF_COLUMNS})
+    return rows
+
+
+def write_period_diff(rows, path):
+    with open(path, 'w', encoding='utf-8-sig') as f:
+        f.write('\t'.join(DIFF_COLUMNS) + '\n')
+        for row in rows:
+            f.write('\t'.join(str(round(v, 2)) if isinstance(v, float) else str(v)
+                              for v in (row[c] for c in DIFF_COLUMNS)) + '\n')
+    return path
+
+
+def run_backfill(inputs, rules_version=None, before_version=None, period_from=None, period_to=None,
+                 output_dir=None, workers=None, parse_cache=None, money='float'):
+    """
+    Re-bill every stored input of the chosen periods under rules_version (default:
+    the latest) and diff the totals against before_version (default: the version
+    before it). Returns the summary that is also printed by the CLI.
+    """
+    from billing_rules import load_rule_set, available_versions
+
+    started = time.perf_counter()
+    rules = load_rule_set(rules_version)
+    if before_version is None:
+        older = [v for v in available_versions() if v < rules['version']]
+        before_version = older[-1] if older else rules['version']
+    before_rules = load_rule_set(before_version)
+
+    output_dir = output_dir or os.path.join('output', f"backfill_v{rules['version']}")
+    os.makedirs(output_dir, exist_ok=True)
+
+    selected, skipped = select_inputs(collect_inputs(inputs), period_from, period_to)
+    suffixes = output_suffixes([path for path, _ in selected])
+    results = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(backfill_file, path, output_dir, rules, before_rules, parse_cache, money,
+                               suffixes[path])
+                   for path, _ in selected]
+        for future in as_completed(futures):
+            results.append(future.result())
+    results.sort(key=lambda r: (r.get('billing_period') or '', r['file']))
+
+    converted = [r for r in results if r['success']]
+    failed = [{'file': r['file'], 'error': r['error']} for r in results if not r['success']]
+    rows = period_diff_rows(converted)
+    diff_path = write_period_diff(rows, os.path.join(
+        output_dir, f"backfill_diff_v{before_rules['version']}_v{rules['version']}.tsv"))
+
+    manifest_path = os.path.join(output_dir, 'backfill_manifest.json')
+    manifest = {
+        'rule_version': rules['version'],
+        'rule_fingerprint': rules['fingerprint'],
+        'before_rule_version': before_rules['version'],
+        'money': money,
+        # Keyed by input path - stored files of different directories may share a name
+        'files': {r['path']: {'billing_period': r['billing_period'], 'outputs': r['outputs'],
+                              'rule_version': r['rule_version'], 'rule_fingerprint': r['rule_fingerprint']}
+                  for r in converted},
+    }
+    with open(manifest_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+
+    return {
+        'success': not failed,
+        'rule_version': rules['version'],
+        'before_rule_version': before_rules['version'],
+        'output_dir': output_dir,
+        'file_count': len(converted),
+        'period_count': len(rows),
+        'diff_path': diff_path,
+        'manifest_path': manifest_path,
+        'periods': rows,
+        'failed': failed,
+        'skipped': skipped,
+        'seconds': time.perf_counter() - started,
+        **({'error': f'{len(failed)} files failed'} if failed else {}),
+    }
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    options = {}
+    for flag in ('--rules', '--before-rules', '--from', '--to', '--output', '--workers', '--parse-cache', '--money'):
+        if flag in args:
+            i = args.index(flag)
+            options[flag] = args[i + 1]
+            del args[i:i + 2]
+
+    if not args:
+        print(json.dumps({'success': False, 'error': 'Usage: python backfill.py <input_csv_or_dir>... [--rules VERSION] '
+                                                     '[--before-rules VERSION] [--from YYYY-MM] [--to YYYY-MM] '
+                                                     '[--output DIR] [--workers N] [--parse-cache DIR] [--money float|agorot]'}))
+        sys.exit(1)
+
+    try:
+        result = run_backfill(args, options.get('--rules'), options.get('--before-rules'),
+                              options.get('--from'), options.get('--to'), options.get('--output'),
+                              int(options['--workers']) if '--workers' in options else None,
+                              options.get('--parse-cache'), options.get('--money', 'float'))
+        print(json.dumps(result, ensure_ascii=False))
+        if not result['success']:
+            sys.exit(1)
+    except Exception as e:
+        print(json.dumps({'success': False, 'error': str(e)}))
+        sys.exit(1)
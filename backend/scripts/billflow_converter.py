@@ -2,23 +2,85 @@
 BillFlow CSV to TSV Converter
 Converts electricity billing CSV files to TSV format with PERFECT total matching.
 Also extracts site-level records for analytics database storage.
+
+pandas, NumPy and the optional subsystems (dedupe index, compression, analytics,
+XLSX writing) are imported by the functions that use them, so --probe and
+--validate start without loading any of them.
+
+With --max-seconds / --max-memory-mb / --cancel-file the conversion runs under a
+job budget (see job_budget.py): it stops at the next checkpoint once the budget is
+used up or the job is cancelled (also by SIGTERM), deletes its partial outputs and
+reports a "budget_exceeded" result with the stage reached. The stages that update
+shared state (site index, history, anomalies, sketches, dedupe index) run after
+the last checkpoint, so an aborted job leaves no trace in them.
+
+With --quarantine, rows that cannot be converted are written to a rejects CSV with
+reason codes (see row_quarantine.py) and the rest of the file is converted. The
+fixed rejects file is then merged into that conversion's outputs with
+    python billflow_converter.py <fixed_rejects.csv> --merge-into "<invoice_lines TSV>"
+(pass the same --dedupe-index so the merged documents are registered); the merged
+lines also get their own XLSX next to the month's one.
 """
-import pandas as pd
-import numpy as np
 from datetime import datetime
 import sys
 import json
 import os
+import io
+import re
+import csv
+import time
+import hashlib
+from file_hash import file_sha256
+
+CSV_ENCODINGS = ['utf-8-sig', 'utf-8', 'cp1255', 'iso-8859-8']
+
+# Per-document summary columns: fixed-charge items by the rule set's item columns, the rest by peak/off-peak
+SUMMARY_AMOUNT_COLUMNS = ['gross_peak', 'gross_offpeak', 'energy_peak', 'energy_offpeak',
+                          'discount_peak', 'discount_offpeak', 'supply', 'distribution', 'kva',
+                          'power_factor_fine', 'various_charges', 'various_credits',
+                          'total', 'vat', 'total_with_vat']
+SUMMARY_COLUMNS = ['document_number', 'site_name', 'site_id', 'meter_number', 'contract_number',
+                   'period_start', 'period_end', 'tariff_id', *SUMMARY_AMOUNT_COLUMNS,
+                   'included_lines', 'excluded_lines', 'first_line', 'last_line']
+
+# Invoice-line count from which the XLSX is written in a separate process
+XLSX_PROCESS_MIN_ROWS = 20000
+
+# How often the budget is checked while concurrent stages run
+STAGE_CHECK_SECONDS = 0.5
+
+# Probe reads at most this much of a file, and reports customers from the first rows
+PROBE_SAMPLE_BYTES = 64 * 1024
+PROBE_SAMPLE_ROWS = 20
 
+# Columns the conversion cannot run without
+REQUIRED_COLUMNS = ['Document number', 'From', 'To', 'Site name', 'Site ID', 'Meter IEC long number',
+                    'Tariff ID', 'Peak consumption', 'Off-peak consumption',
+                    'Energy cost peak by TOU tariff', 'Energy cost off-peak by TOU tariff',
+                    'Total discount peak (ILS)', 'Total discount off-peak (ILS)',
+                    'Distribution', 'Supply', 'KVA cost', 'Total cost']
 
-def extract_site_records(df, billing_period, billing_month, billing_year):
+# Output names of an uncompressed conversion: YYYYMM, timestamp and file suffix
+INVOICE_LINES_PATTERN = re.compile(r'^invoice_lines - (\d{6})_(\d{8}_\d{6})(.*)\.txt$')
+
+# Paying customer used when the file is not partitioned by customer
+DEFAULT_PAYER = {'payer_account': 10003, 'payer_name': "עיריית ראשון לציון"}
+
+
+def extract_site_records(df, billing_period, billing_month, billing_year, budget=None):
     """
     Extract site-level records from the CSV dataframe for database storage.
     Returns a list of dictionaries with site billing data for analytics.
     """
+    import pandas as pd
+    from job_budget import CHECKPOINT_ROWS
+
     site_records = []
 
-    for _, row in df.iterrows():
+    for i, (_, row) in enumerate(df.iterrows()):
+        if i % CHECKPOINT_ROWS == 0:
+            _checkpoint(budget)
+
         # Parse dates
         from_date = str(row["From"])
         to_date = str(row["To"])
@@ -140,26 +202,29 @@ def extract_site_records(df, billing_period, billing_month, billing_year):
     return site_records
 
 
-def convert_csv_to_tsv(csv_file, output_dir=None):
+def read_billing_csv(csv_file, usecols=None):
     """
-    Convert CSV to TSV matching customer's format with VAT-inclusive amounts.
-    Returns JSON with processing results for the backend.
+    Read a billing CSV with proper encoding for Hebrew files.
+    Tries UTF-8-BOM first (common for Excel exports), then UTF-8, then cp1255 (Hebrew Windows).
     """
+    import pandas as pd
 
-    # Read CSV with proper encoding for Hebrew files
-    # Try UTF-8-BOM first (common for Excel exports), then UTF-8, then cp1255 (Hebrew Windows)
-    encodings_to_try = ['utf-8-sig', 'utf-8', 'cp1255', 'iso-8859-8']
     df = None
-    for encoding in encodings_to_try:
+    for encoding in CSV_ENCODINGS:
         try:
-            df = pd.read_csv(csv_file, encoding=encoding)
+            df = pd.read_csv(csv_file, encoding=encoding, usecols=usecols)
             break
         except (UnicodeDecodeError, UnicodeError):
             continue
 
     if df is None:
-        raise ValueError(f"Could not read CSV file with any supported encoding: {encodings_to_try}")
+        raise ValueError(f"Could not read CSV file with any supported encoding: {CSV_ENCODINGS}")
+
+    return df
+
 
+def clean_billing_frame(df):
+    """Drop shadow total rows and convert comma-formatted numbers to floats."""
     # Filter out total rows (rows with NaN document numbers) - handles shadow totals
     df = df[df['Document number'].notna()]
 
@@ -172,10 +237,82 @@ def convert_csv_to_tsv(csv_file, output_dir=None):
                 except:
                     pass
 
+    return df
+
+
+def load_billing_frame(csv_file):
+    """Read and clean a billing CSV (the unit the parse cache stores)."""
+    return clean_billing_frame(read_billing_csv(csv_file))
+
+
+def summarize_document_lines(summaries, lines, row, item_columns):
+    """
+    Fold one CSV row's invoice lines into the per-document summary (summaries is
+    keyed by document number; a document spread over several rows accumulates).
+    item_columns maps fixed-charge item codes to summary columns.
+    """
+    if not lines:
+        return
+    first = lines[0]
+    document = first['מספר חשבונית']
+    summary = summaries.get(document)
+    if summary is None:
+        summary = summaries[document] = {
+            'document_number': document,
+            'site_name': first['שם משתמש עיקרי'],
+            'site_id': first['מספר  מזהה לחיבור'],
+            'meter_number': first['מספר מונה חח"י'],
+            'contract_number': first['מספר חוזה'],
+            'period_start': first['תאריך התחלה'],
+            'period_end': first['תאריך הסיום'],
+            'tariff_id': str(row.get('Tariff ID', '')),
+            **{column: 0.0 for column in SUMMARY_AMOUNT_COLUMNS},
+            'included_lines': 0,
+            'excluded_lines': 0,
+            'first_line': first['מספר שורה'],
+        }
+
+    for line in lines:
+        amount = line['סכום ']
+        if line['כלול בחיוב'] != 'כן':
+            summary['gross_peak' if line['מש"ב'] == 'פסגה' else 'gross_offpeak'] += amount
+            summary['excluded_lines'] += 1
+            continue
+        column = item_columns.get(line['מזהה פריט'])
+        if column is None:
+            column = 'energy_peak' if line['מש"ב'] == 'פסגה' else 'energy_offpeak'
+        summary[column] += amount
+        summary['total'] += amount
+        summary['vat'] += line['סכום המע"מ']
+        summary['total_with_vat'] += line['סכום כולל מע"מ']
+        summary['included_lines'] += 1
+    summary['last_line'] = lines[-1]['מספר שורה']
+
+
+def generate_invoice_lines(df, payer=None, summaries=None, budget=None, rules=None, start_row=1):
+    """
+    Build the customer's invoice lines (one dict per TSV row) from the cleaned CSV rows.
+    payer overrides the paying customer account/name (defaults to DEFAULT_PAYER).
+    When a summaries dict is given, the per-document summary is filled in the same pass.
+    rules is the billing rule set (VAT and item codes; defaults to the latest version).
+    start_row is the first line number (lines appended to an existing TSV continue its numbering).
+    """
+    import pandas as pd
+    from job_budget import CHECKPOINT_ROWS
+    from billing_rules import load_rule_set, tariff_rules
+
+    payer = payer or DEFAULT_PAYER
+    rules = rules or load_rule_set()
+    vat_rate, vat_multiplier = rules['vat_rate'], rules['vat_multiplier']
+    items = rules['items']
     out = []
-    row_number = 1
+    row_number = start_row
+
+    for i, (_, row) in enumerate(df.iterrows()):
+        if i % CHECKPOINT_ROWS == 0:
+            _checkpoint(budget)
+        first_line = len(out)
 
-    for _, row in df.iterrows():
         # Parse dates - handle both formats
         from_date = str(row["From"])
         to_date = str(row["To"])
@@ -197,8 +334,8 @@ def convert_csv_to_tsv(csv_file, output_dir=None):
         # Base fields
         base_fields_first = {
             'מספר חשבונית': int(row["Document number"]),
-            'חשבון לקוח משלם': 10003,
-            'שם הלקוח המשלם': "עיריית ראשון לציון",
+            'חשבון לקוח משלם': payer['payer_account'],
+            'שם הלקוח המשלם': payer['payer_name'],
             'שם משתמש עיקרי': row["Site name"],
             'מספר  מזהה לחיבור': str(row["Site ID"]).strip("'"),
             'מספר מונה חח"י': int(float(meter_num)),
@@ -242,38 +379,13 @@ def convert_csv_to_tsv(csv_file, output_dir=None):
         adjusted_charges = row.get('Various charges', 0) * adjustment_factor
         adjusted_credits = row.get('Various credits', 0) * adjustment_factor
 
-        # Determine tariff type
-        tariff = str(row.get("Tariff ID", "")).upper()
-        if "TOU MV" in tariff:
-            peak_code, offpeak_code = "P-1008", "P-1009"
-            peak_desc, offpeak_desc = 'תעוז מתח גבוה - עם הנחה פסגה', 'תעוז מתח גבוה - עם הנחה שפל'
-            gross_peak_code, gross_offpeak_code = "P-5008", "P-5009"
-            gross_peak_desc = 'סה"כ חיוב גולמי תעוז מתח גבוה פסגה'
-            gross_offpeak_desc = 'סה"כ חיוב גולמי תעוז מתח גבוה שפל'
-        elif "TOU" in tariff:
-            peak_code, offpeak_code = "P-2008", "P-2009"
-            peak_desc, offpeak_desc = 'תעוז מתח נמוך - עם הנחה פסגה', 'תעוז מתח נמוך - עם הנחה שפל'
-            gross_peak_code, gross_offpeak_code = "P-5004", "P-5005"
-            gross_peak_desc = 'סה"כ חיוב גולמי תעוז מתח נמוך פסגה'
-            gross_offpeak_desc = 'סה"כ חיוב גולמי תעוז מתח נמוך שפל'
-        elif "RESIDENTIAL" in tariff:
-            peak_code, offpeak_code = "P-3008", "P-3009"
-            peak_desc, offpeak_desc = 'מגורים - עם הנחה פסגה', 'מגורים - עם הנחה שפל'
-            gross_peak_code, gross_offpeak_code = "P-5038", "P-5039"
-            gross_peak_desc = 'סה"כ חיוב גולמי מגורים פסגה'
-            gross_offpeak_desc = 'סה"כ חיוב גולמי מגורים שפל'
-        elif "STREETLIGHT" in tariff:
-            peak_code, offpeak_code = "P-4008", "P-4009"
-            peak_desc, offpeak_desc = 'תאורת רחוב - עם הנחה פסגה', 'תאורת רחוב - עם הנחה שפל'
-            gross_peak_code, gross_offpeak_code = "P-5048", "P-5049"
-            gross_peak_desc = 'סה"כ חיוב גולמי תאורת רחוב פסגה'
-            gross_offpeak_desc = 'סה"כ חיוב גולמי תאורת רחוב שפל'
-        else:
-            peak_code, offpeak_code = "P-2008", "P-2009"
-            peak_desc, offpeak_desc = 'תעוז מתח נמוך - עם הנחה פסגה', 'תעוז מתח נמוך - עם הנחה שפל'
-            gross_peak_code, gross_offpeak_code = "P-5004", "P-5005"
-            gross_peak_desc = 'סה"כ חיוב גולמי תעוז מתח נמוך פסגה'
-            gross_offpeak_desc = 'סה"כ חיוב גולמי תעוז מתח נמוך שפל'
+        # Item codes of the row's tariff
+        tariff = tariff_rules(rules, row.get("Tariff ID", ""))
+        peak_code, peak_desc = tariff['energy_peak']['code'], tariff['energy_peak']['description']
+        offpeak_code, offpeak_desc = tariff['energy_offpeak']['code'], tariff['energy_offpeak']['description']
+        gross_peak_code, gross_peak_desc = tariff['gross_peak']['code'], tariff['gross_peak']['description']
+        gross_offpeak_code = tariff['gross_offpeak']['code']
+        gross_offpeak_desc = tariff['gross_offpeak']['description']
 
         # Add display-only items (gross amounts)
         if row['Energy cost peak by TOU tariff'] > 0:
@@ -284,8 +396,8 @@ def convert_csv_to_tsv(csv_file, output_dir=None):
                 'כמות': row['Peak consumption'], 'יחידת מידה': 'kWh',
                 'מחיר יחידה': row['TOU tariff peak'],
                 'סכום ': row['Energy cost peak by TOU tariff'],
-                'סכום המע"מ': row['Energy cost peak by TOU tariff'] * 0.18,
-                'סכום כולל מע"מ': row['Energy cost peak by TOU tariff'] * 1.18,
+                'סכום המע"מ': row['Energy cost peak by TOU tariff'] * vat_rate,
+                'סכום כולל מע"מ': row['Energy cost peak by TOU tariff'] * vat_multiplier,
                 'כלול בחיוב': 'לא'
             })
             row_number += 1
@@ -295,13 +407,13 @@ def convert_csv_to_tsv(csv_file, output_dir=None):
             discount_value = -adjusted_discount_peak
             out.append({
                 'מספר שורה': row_number, **base_fields_first,
-                'מזהה פריט': 'P-6001', 'תיאור': 'הנחה פסגה',
+                'מזהה פריט': items['discount_peak']['code'], 'תיאור': items['discount_peak']['description'],
                 **base_fields_dates, 'מש"ב': 'פסגה',
                 'כמות': row['Peak consumption'], 'יחידת מידה': 'kWh',
                 'מחיר יחידה': discount_value / row['Peak consumption'] if row['Peak consumption'] > 0 else 0,
                 'סכום ': discount_value,
-                'סכום המע"מ': discount_value * 0.18,
-                'סכום כולל מע"מ': discount_value * 1.18,
+                'סכום המע"מ': discount_value * vat_rate,
+                'סכום כולל מע"מ': discount_value * vat_multiplier,
                 'כלול בחיוב': 'כן'
             })
             row_number += 1
@@ -315,8 +427,8 @@ def convert_csv_to_tsv(csv_file, output_dir=None):
                 'כמות': row['Off-peak consumption'], 'יחידת מידה': 'kWh',
                 'מחיר יחידה': row['TOU tariff off-peak'],
                 'סכום ': row['Energy cost off-peak by TOU tariff'],
-                'סכום המע"מ': row['Energy cost off-peak by TOU tariff'] * 0.18,
-                'סכום כולל מע"מ': row['Energy cost off-peak by TOU tariff'] * 1.18,
+                'סכום המע"מ': row['Energy cost off-peak by TOU tariff'] * vat_rate,
+                'סכום כולל מע"מ': row['Energy cost off-peak by TOU tariff'] * vat_multiplier,
                 'כלול בחיוב': 'לא'
             })
             row_number += 1
@@ -326,13 +438,13 @@ def convert_csv_to_tsv(csv_file, output_dir=None):
             discount_value = -adjusted_discount_offpeak
             out.append({
                 'מספר שורה': row_number, **base_fields_first,
-                'מזהה פריט': 'P-6002', 'תיאור': 'הנחה שפל',
+                'מזהה פריט': items['discount_offpeak']['code'], 'תיאור': items['discount_offpeak']['description'],
                 **base_fields_dates, 'מש"ב': 'שפל',
                 'כמות': row['Off-peak consumption'], 'יחידת מידה': 'kWh',
                 'מחיר יחידה': discount_value / row['Off-peak consumption'] if row['Off-peak consumption'] > 0 else 0,
                 'סכום ': discount_value,
-                'סכום המע"מ': discount_value * 0.18,
-                'סכום כולל מע"מ': discount_value * 1.18,
+                'סכום המע"מ': discount_value * vat_rate,
+                'סכום כולל מע"מ': discount_value * vat_multiplier,
                 'כלול בחיוב': 'כן'
             })
             row_number += 1
@@ -346,8 +458,8 @@ def convert_csv_to_tsv(csv_file, output_dir=None):
                 'כמות': row['Peak consumption'], 'יחידת מידה': 'kWh',
                 'מחיר יחידה': adjusted_gross_peak / row['Peak consumption'] if row['Peak consumption'] > 0 else 0,
                 'סכום ': adjusted_gross_peak,
-                'סכום המע"מ': adjusted_gross_peak * 0.18,
-                'סכום כולל מע"מ': adjusted_gross_peak * 1.18,
+                'סכום המע"מ': adjusted_gross_peak * vat_rate,
+                'סכום כולל מע"מ': adjusted_gross_peak * vat_multiplier,
                 'כלול בחיוב': 'כן'
             })
             row_number += 1
@@ -361,8 +473,8 @@ def convert_csv_to_tsv(csv_file, output_dir=None):
                 'כמות': row['Off-peak consumption'], 'יחידת מידה': 'kWh',
                 'מחיר יחידה': adjusted_gross_offpeak / row['Off-peak consumption'] if row['Off-peak consumption'] > 0 else 0,
                 'סכום ': adjusted_gross_offpeak,
-                'סכום המע"מ': adjusted_gross_offpeak * 0.18,
-                'סכום כולל מע"מ': adjusted_gross_offpeak * 1.18,
+                'סכום המע"מ': adjusted_gross_offpeak * vat_rate,
+                'סכום כולל מע"מ': adjusted_gross_offpeak * vat_multiplier,
                 'כלול בחיוב': 'כן'
             })
             row_number += 1
@@ -371,105 +483,353 @@ def convert_csv_to_tsv(csv_file, output_dir=None):
         if adjusted_supply > 0:
             out.append({
                 'מספר שורה': row_number, **base_fields_first,
-                'מזהה פריט': 'P-0001', 'תיאור': 'אספקה',
+                'מזהה פריט': items['supply']['code'], 'תיאור': items['supply']['description'],
                 **base_fields_dates, 'מש"ב': '', 'כמות': 1.0, 'יחידת מידה': '', 'מחיר יחידה': '',
-                'סכום ': adjusted_supply, 'סכום המע"מ': adjusted_supply * 0.18,
-                'סכום כולל מע"מ': adjusted_supply * 1.18, 'כלול בחיוב': 'כן'
+                'סכום ': adjusted_supply, 'סכום המע"מ': adjusted_supply * vat_rate,
+                'סכום כולל מע"מ': adjusted_supply * vat_multiplier, 'כלול בחיוב': 'כן'
             })
             row_number += 1
 
         if adjusted_distribution > 0:
             out.append({
                 'מספר שורה': row_number, **base_fields_first,
-                'מזהה פריט': 'P-0005', 'תיאור': 'חלוקה',
+                'מזהה פריט': items['distribution']['code'], 'תיאור': items['distribution']['description'],
                 **base_fields_dates, 'מש"ב': '', 'כמות': 1.0, 'יחידת מידה': '', 'מחיר יחידה': '',
-                'סכום ': adjusted_distribution, 'סכום המע"מ': adjusted_distribution * 0.18,
-                'סכום כולל מע"מ': adjusted_distribution * 1.18, 'כלול בחיוב': 'כן'
+                'סכום ': adjusted_distribution, 'סכום המע"מ': adjusted_distribution * vat_rate,
+                'סכום כולל מע"מ': adjusted_distribution * vat_multiplier, 'כלול בחיוב': 'כן'
             })
             row_number += 1
 
         if adjusted_kva > 0:
             out.append({
                 'מספר שורה': row_number, **base_fields_first,
-                'מזהה פריט': 'P-0011', 'תיאור': 'עלות החיבור',
+                'מזהה פריט': items['kva']['code'], 'תיאור': items['kva']['description'],
                 **base_fields_dates, 'מש"ב': '', 'כמות': 1.0, 'יחידת מידה': '', 'מחיר יחידה': '',
-                'סכום ': adjusted_kva, 'סכום המע"מ': adjusted_kva * 0.18,
-                'סכום כולל מע"מ': adjusted_kva * 1.18, 'כלול בחיוב': 'כן'
+                'סכום ': adjusted_kva, 'סכום המע"מ': adjusted_kva * vat_rate,
+                'סכום כולל מע"מ': adjusted_kva * vat_multiplier, 'כלול בחיוב': 'כן'
             })
             row_number += 1
 
         if adjusted_power_factor > 0:
             out.append({
                 'מספר שורה': row_number, **base_fields_first,
-                'מזהה פריט': 'P-8001', 'תיאור': 'קנס מקדם הספק',
+                'מזהה פריט': items['power_factor_fine']['code'], 'תיאור': items['power_factor_fine']['description'],
                 **base_fields_dates, 'מש"ב': '', 'כמות': 1.0, 'יחידת מידה': '', 'מחיר יחידה': '',
-                'סכום ': adjusted_power_factor, 'סכום המע"מ': adjusted_power_factor * 0.18,
-                'סכום כולל מע"מ': adjusted_power_factor * 1.18, 'כלול בחיוב': 'כן'
+                'סכום ': adjusted_power_factor, 'סכום המע"מ': adjusted_power_factor * vat_rate,
+                'סכום כולל מע"מ': adjusted_power_factor * vat_multiplier, 'כלול בחיוב': 'כן'
             })
             row_number += 1
 
         if adjusted_charges > 0:
             out.append({
                 'מספר שורה': row_number, **base_fields_first,
-                'מזהה פריט': 'P-9001', 'תיאור': 'חיובים שונים',
+                'מזהה פריט': items['various_charges']['code'], 'תיאור': items['various_charges']['description'],
                 **base_fields_dates, 'מש"ב': '', 'כמות': 1.0, 'יחידת מידה': '', 'מחיר יחידה': '',
-                'סכום ': adjusted_charges, 'סכום המע"מ': adjusted_charges * 0.18,
-                'סכום כולל מע"מ': adjusted_charges * 1.18, 'כלול בחיוב': 'כן'
+                'סכום ': adjusted_charges, 'סכום המע"מ': adjusted_charges * vat_rate,
+                'סכום כולל מע"מ': adjusted_charges * vat_multiplier, 'כלול בחיוב': 'כן'
             })
             row_number += 1
 
         if adjusted_credits != 0:
             out.append({
                 'מספר שורה': row_number, **base_fields_first,
-                'מזהה פריט': 'P-9002', 'תיאור': 'זיכויים שונים',
+                'מזהה פריט': items['various_credits']['code'], 'תיאור': items['various_credits']['description'],
                 **base_fields_dates, 'מש"ב': '', 'כמות': 1.0, 'יחידת מידה': '', 'מחיר יחידה': '',
-                'סכום ': adjusted_credits, 'סכום המע"מ': adjusted_credits * 0.18,
-                'סכום כולל מע"מ': adjusted_credits * 1.18, 'כלול בחיוב': 'כן'
+                'סכום ': adjusted_credits, 'סכום המע"מ': adjusted_credits * vat_rate,
+                'סכום כולל מע"מ': adjusted_credits * vat_multiplier, 'כלול בחיוב': 'כן'
             })
             row_number += 1
 
-    # Create DataFrame
-    result_df = pd.DataFrame(out)
+        if summaries is not None:
+            summarize_document_lines(summaries, out[first_line:], row, rules['item_columns'])
 
-    # Extract month/year from CSV data
-    first_date_str = str(df['From'].iloc[0])
+    return out
+
+
+def parse_billing_date(first_date_str):
+    """Parse a 'From' date - both dd/mm/yyyy and mm/dd/yyyy exports occur."""
     parts = first_date_str.split('/')
     if len(parts) == 3:
         day, month, year = int(parts[0]), int(parts[1]), int(parts[2])
         if day <= 31 and month <= 12:
-            first_date = pd.to_datetime(first_date_str, format='%d/%m/%Y')
-        else:
-            first_date = pd.to_datetime(first_date_str, format='%m/%d/%Y')
+            return datetime.strptime(first_date_str, '%d/%m/%Y')
+        return datetime.strptime(first_date_str, '%m/%d/%Y')
+    import pandas as pd
+    return pd.to_datetime(first_date_str).to_pydatetime()
+
+
+def billing_date(df):
+    """First billing date of the file."""
+    import pandas as pd
+    return pd.Timestamp(parse_billing_date(str(df['From'].iloc[0])))
+
+
+def probe_csv(csv_file, sample_rows=PROBE_SAMPLE_ROWS):
+    """
+    Classify an upload without parsing it: reads only the first PROBE_SAMPLE_BYTES
+    through a real CSV parser (quoted Hebrew names like "אח""י להב" stay intact).
+    Returns encoding, billing period, customer name(s), a row-count estimate and
+    a schema fingerprint.
+    """
+    started = time.perf_counter()
+    file_size = os.path.getsize(csv_file)
+    with open(csv_file, 'rb') as f:
+        sample = f.read(PROBE_SAMPLE_BYTES)
+    complete = len(sample) == file_size
+
+    # Cut at the last newline so a multi-byte character is never split
+    if not complete and b'\n' in sample:
+        sample = sample[:sample.rindex(b'\n') + 1]
+
+    text = encoding = None
+    for candidate in CSV_ENCODINGS:
+        try:
+            text = sample.decode(candidate)
+            encoding = candidate
+            break
+        except (UnicodeDecodeError, UnicodeError):
+            continue
+    if text is None:
+        raise ValueError(f"Could not read CSV file with any supported encoding: {CSV_ENCODINGS}")
+
+    reader = csv.reader(io.StringIO(text))
+    header = next(reader, [])
+    header_bytes = len(','.join(header).encode(encoding)) + 1
+    rows = [dict(zip(header, row)) for row in reader if row]
+    documents = [r for r in rows if r.get('Document number', '').strip()]
+
+    # Exact when the whole file fit in the sample, otherwise extrapolated from bytes per row
+    if complete or not rows:
+        row_estimate = len(documents)
     else:
-        first_date = pd.to_datetime(first_date_str)
+        bytes_per_row = (len(sample) - header_bytes) / len(rows)
+        row_estimate = int(round((file_size - header_bytes) / bytes_per_row * len(documents) / len(rows)))
 
-    year_month = first_date.strftime('%Y%m')
-    month_year_display = first_date.strftime('%B_%Y')
-    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    first = documents[0] if documents else {}
+    period = parse_billing_date(first['From'].strip()) if first.get('From') else None
 
-    # Determine output directory
-    if output_dir is None:
-        output_dir = os.path.dirname(csv_file) or '.'
+    return {
+        'success': True,
+        'file': os.path.basename(csv_file),
+        'file_size': file_size,
+        'encoding': encoding,
+        'column_count': len(header),
+        'schema_fingerprint': hashlib.sha256('\x1f'.join(header).encode('utf-8')).hexdigest()[:16],
+        'missing_columns': [c for c in REQUIRED_COLUMNS if c not in header],
+        'billing_period': period.strftime('%Y-%m') if period else None,
+        'billing_month': period.month if period else None,
+        'billing_year': period.year if period else None,
+        'customer_names': sorted({r['Customer name'].strip() for r in documents[:sample_rows]
+                                  if r.get('Customer name', '').strip()}),
+        'business_entities': sorted({r['Business entity'].strip() for r in documents[:sample_rows]
+                                     if r.get('Business entity', '').strip()}),
+        'row_count_estimate': row_estimate,
+        'row_count_exact': complete,
+        'probe_ms': (time.perf_counter() - started) * 1000,
+    }
 
-    # Save files (match original naming convention: "invoice_lines - YYYYMM_TIMESTAMP.txt")
-    tsv_filename = f'invoice_lines - {year_month}_{timestamp}.txt'
-    excel_filename = f'{month_year_display}_FINAL.xlsx'
 
-    tsv_path = os.path.join(output_dir, tsv_filename)
-    excel_path = os.path.join(output_dir, excel_filename)
+def validate_csv(csv_file):
+    """
+    Cheap pre-flight check of an upload (no pandas): the probe plus a verdict.
+    Fails when required columns are missing, no document rows were found or the
+    billing period cannot be read.
+    """
+    result = probe_csv(csv_file)
+    problems = []
+    if result['missing_columns']:
+        problems.append(f"Missing columns: {', '.join(result['missing_columns'])}")
+    if result['row_count_estimate'] == 0:
+        problems.append("No document rows found")
+    if result['billing_period'] is None:
+        problems.append("Billing period could not be read from the 'From' column")
+    result['success'] = not problems
+    if problems:
+        result['error'] = '; '.join(problems)
+    return result
+
+
+def _checkpoint(budget, stage=None):
+    """budget.checkpoint(stage) when the job runs under a budget."""
+    if budget is not None:
+        budget.checkpoint(stage)
+
 
+def _wait_for_stages(futures, budget=None):
+    """Wait for concurrently running stages, checking the budget while they run."""
+    from concurrent.futures import wait
+
+    pending = futures
+    while pending:
+        _, pending = wait(pending, timeout=STAGE_CHECK_SECONDS if budget is not None else None)
+        _checkpoint(budget)
+
+
+def _terminate_workers(pool):
+    """
+    Kill the processes of a ProcessPoolExecutor (Python 3.11 has no public API for it).
+    SIGKILL, because forked workers inherit the SIGTERM handler of the budget.
+    """
+    for process in list((pool._processes or {}).values()):
+        process.kill()
+
+
+def _timed_stage(stage, *args):
+    """Run one output stage and return (its result, seconds taken)."""
+    started = time.perf_counter()
+    result = stage(*args)
+    return result, time.perf_counter() - started
+
+
+def write_tsv_output(result_df, tsv_path, compression=None):
+    """Write the invoice-line TSV; returns the compression stats for compressed output."""
+    if compression:
+        from compressed_output import write_framed_tsv
+        return write_framed_tsv(result_df, tsv_path, codec=compression)
     result_df.to_csv(tsv_path, sep='\t', index=False, encoding='utf-8-sig')
+    return None
+
+
+def write_document_summary(summaries, summary_path):
+    """Write the per-document summary (one row per invoice) next to the invoice lines."""
+    import pandas as pd
+    pd.DataFrame(list(summaries.values()), columns=SUMMARY_COLUMNS).to_csv(
+        summary_path, sep='\t', index=False, encoding='utf-8-sig')
+    return summary_path
+
+
+def write_excel_output(result_df, excel_path):
     result_df.to_excel(excel_path, index=False, engine='openpyxl')
+    return excel_path
+
+
+def apply_money_engine(result_df, df, summaries, money, rules):
+    """Recompute the line and summary amounts with the chosen money engine; returns (lines, stats)."""
+    if money == 'float':
+        return result_df, None
+    if money != 'agorot':
+        raise ValueError(f"Unsupported money engine: {money}")
+
+    from agorot_engine import apply_agorot_amounts, document_amounts
+    result_df, money_stats = apply_agorot_amounts(result_df, df, rules['vat_percent'])
+    amounts = document_amounts(result_df, rules['item_columns'])
+    for document, summary in summaries.items():
+        summary.update({column: float(amounts.at[document, column]) if column in amounts.columns else 0.0
+                        for column in SUMMARY_AMOUNT_COLUMNS})
+    return result_df, money_stats
+
+
+def write_rejects_stage(rejects, output_dir, name, budget=None):
+    """Write quarantined rows to 'rejects - <name>.csv'; returns the result fields for them."""
+    from row_quarantine import write_rejects, reject_counts
+
+    rejects_filename = f'rejects - {name}.csv'
+    rejects_path = os.path.join(output_dir, rejects_filename)
+    if budget is not None:
+        budget.output(rejects_path)
+    write_rejects(rejects, rejects_path)
+    return {
+        'rejected_rows': len(rejects),
+        'reject_reasons': reject_counts(rejects),
+        'rejects_filename': rejects_filename,
+        'rejects_path': rejects_path,
+    }
 
-    # Calculate totals
-    included = result_df[result_df['כלול בחיוב'] == 'כן']
-    total_sum = included['סכום '].sum()
-    total_with_vat = included['סכום כולל מע"מ'].sum()
-    csv_total = df['Total cost'].sum()
 
-    # Extract site records for analytics database
+def convert_billing_frame(df, output_dir, payer=None, file_suffix='', compression=None, money='float',
+                          budget=None, rules=None, rejects=None):
+    """
+    Convert cleaned CSV rows into the TSV/XLSX outputs and site records.
+    file_suffix is appended to the output filenames (used per customer in partitioned mode).
+    compression ('gzip' or 'zstd') writes the TSV as document-framed compressed output.
+    money='agorot' recomputes the amounts in integer milli-agorot (see agorot_engine.py).
+    budget (a job_budget.JobBudget) is checked between stages and registers the outputs.
+    rules is the billing rule set (see billing_rules.py; defaults to the latest version).
+    rejects (rows set aside by row_quarantine.quarantine_rows) are written as a
+    rejects CSV next to the outputs.
+    """
+    import multiprocessing
+    import pandas as pd
+    from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+    from compressed_output import CODEC_EXTENSIONS, index_path_for
+    from billing_rules import load_rule_set, rule_stamp
+
+    rules = rules or load_rule_set()
+    summaries = {}
+    _checkpoint(budget, 'invoice_lines')
+    out = generate_invoice_lines(df, payer, summaries, budget, rules)
+
+    # Create DataFrame
+    result_df = pd.DataFrame(out)
+
+    _checkpoint(budget, 'money')
+    result_df, money_stats = apply_money_engine(result_df, df, summaries, money, rules)
+
+    # Extract month/year from CSV data
+    first_date = billing_date(df)
+
+    year_month = first_date.strftime('%Y%m')
+    month_year_display = first_date.strftime('%B_%Y')
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+
+    # Save files (match original naming convention: "invoice_lines - YYYYMM_TIMESTAMP.txt")
+    tsv_filename = f'invoice_lines - {year_month}_{timestamp}{file_suffix}.txt'
+    excel_filename = f'{month_year_display}_FINAL{file_suffix}.xlsx'
+    summary_filename = f'invoice_summary - {year_month}_{timestamp}{file_suffix}.tsv'
+    if compression:
+        tsv_filename += CODEC_EXTENSIONS[compression]
+
+    tsv_path = os.path.join(output_dir, tsv_filename)
+    excel_path = os.path.join(output_dir, excel_filename)
+    summary_path = os.path.join(output_dir, summary_filename)
     billing_period = first_date.strftime('%Y-%m')
-    site_records = extract_site_records(df, billing_period, int(first_date.month), int(first_date.year))
+    if budget is not None:
+        # Only files this job creates are deleted on abort (the XLSX name repeats per month);
+        # a compressed TSV has its document index next to it
+        paths = [tsv_path, excel_path, summary_path, *([index_path_for(tsv_path)] if compression else [])]
+        for path in paths:
+            if not os.path.exists(path):
+                budget.output(path)
+
+    reject_stats = None
+    if rejects is not None and len(rejects):
+        reject_stats = write_rejects_stage(rejects, output_dir, f'{year_month}_{timestamp}{file_suffix}', budget)
+
+    # The output stages are independent once the invoice lines exist - run them
+    # concurrently. openpyxl is pure Python and holds the GIL, so for large months
+    # the XLSX goes to its own process (unless we already are a worker process).
+    stage_seconds = {}
+    _checkpoint(budget, 'outputs')
+    xlsx_pool = None
+    if len(result_df) >= XLSX_PROCESS_MIN_ROWS and multiprocessing.parent_process() is None:
+        xlsx_pool = ProcessPoolExecutor(max_workers=1)
+    try:
+        with ThreadPoolExecutor(max_workers=4) as threads:
+            xlsx_future = (xlsx_pool or threads).submit(_timed_stage, write_excel_output, result_df, excel_path)
+            tsv_future = threads.submit(_timed_stage, write_tsv_output, result_df, tsv_path, compression)
+            sites_future = threads.submit(_timed_stage, extract_site_records, df, billing_period,
+                                          int(first_date.month), int(first_date.year), budget)
+            summary_future = threads.submit(_timed_stage, write_document_summary, summaries, summary_path)
+
+            # Calculate totals
+            included = result_df[result_df['כלול בחיוב'] == 'כן']
+            total_sum = included['סכום '].sum()
+            total_with_vat = included['סכום כולל מע"מ'].sum()
+            csv_total = df['Total cost'].sum()
+
+            _wait_for_stages([tsv_future, sites_future, xlsx_future, summary_future], budget)
+            compression_stats, stage_seconds['tsv'] = tsv_future.result()
+            site_records, stage_seconds['site_records'] = sites_future.result()
+            _, stage_seconds['xlsx'] = xlsx_future.result()
+            _, stage_seconds['summary'] = summary_future.result()
+    except BaseException:
+        # An aborted job does not wait for the XLSX process
+        if xlsx_pool is not None:
+            _terminate_workers(xlsx_pool)
+        raise
+    finally:
+        if xlsx_pool is not None:
+            xlsx_pool.shutdown()
 
     # Return results as JSON
     # Return only filenames (not full paths) for backend to construct relative paths
@@ -490,24 +850,597 @@ def convert_csv_to_tsv(csv_file, output_dir=None):
         'tsv_path': tsv_path,
         'excel_filename': excel_filename,
         'excel_path': excel_path,
+        'summary_filename': summary_filename,
+        'summary_path': summary_path,
+        'document_count': len(summaries),
         'month_display': month_year_display,
+        **rule_stamp(rules),
         'site_records': site_records  # Include site data for database insertion
     }
+    if compression_stats:
+        results['compression'] = compression_stats
+    if money_stats:
+        # Integer engines reconcile exactly against the CSV totals - no tolerance
+        results['money'] = money_stats
+        results['difference'] = money_stats['difference']
+        results['perfect_match'] = money_stats['difference'] == 0
+    if reject_stats:
+        results.update(reject_stats)
+    results['stage_seconds'] = stage_seconds
+
+    return results
+
+
+def convert_csv_to_tsv(csv_file, output_dir=None, dedupe_index=None, compression=None, site_index=None,
+                       history_dir=None, anomaly_db=None, parse_cache=None, money='float', budget=None, rules=None,
+                       sketch_dir=None, quarantine=False, reprocess=False):
+    """
+    Convert CSV to TSV matching customer's format with VAT-inclusive amounts.
+    Returns JSON with processing results for the backend.
+    With dedupe_index (an index directory), files already converted or overlapping
+    converted documents are rejected before parsing, and successful conversions
+    are registered in the index. The check reserves the documents under the index
+    lock, so concurrent conversions sharing the index cannot both accept them.
+    reprocess converts a file that is already registered again (its own earlier
+    registration is ignored by the check and replaced by the new one).
+    With site_index (a site dimension index file), every site record gets a site_key.
+    With history_dir the site records are kept for the analytics modules, and with
+    anomaly_db the new period is scored for anomalies against that history.
+    With parse_cache (a cache directory), reprocessing a file loads its cleaned
+    frame from the cache instead of parsing the CSV again.
+    With budget (a job_budget.JobBudget) every stage is checked against it; run it
+    through job_budget.run_with_budget to get the cleanup and the structured result.
+    rules is the billing rule set to convert with (default: the latest version).
+    With sketch_dir the period's site records are summarized into mergeable
+    dashboard sketches (see site_sketches.py).
+    With quarantine, rows that would stop the conversion (bad dates, meter numbers,
+    amounts...) are set aside in a rejects CSV and the rest of the file is converted;
+    fix the rejects and add them with merge_fixed_rejects().
+    """
+
+    from dedupe_index import (index_lock, load_index, save_index, load_pending, check_upload, reserve_upload,
+                              release_upload, register_upload, unregister_upload)
+
+    # Stop duplicates and overlapping documents before the full parse
+    register = False
+    file_hash = None
+    _checkpoint(budget, 'dedupe')
+    if dedupe_index is not None:
+        file_hash = file_sha256(csv_file)
+        with index_lock(dedupe_index):
+            index = load_index(dedupe_index)
+            if reprocess:
+                index = {**index, 'files': dict(index['files'])}
+                unregister_upload(index, file_hash)
+            documents = read_billing_csv(csv_file, usecols=['Document number'])['Document number'].dropna()
+            pending = load_pending(dedupe_index)
+            dedupe = check_upload(index, file_hash, documents, pending)
+            if dedupe['duplicate'] or dedupe['overlap_count']:
+                if dedupe['duplicate'] and (dedupe['duplicate_of'] or {}).get('converting'):
+                    error = f"The same file is being converted ({dedupe['duplicate_of'].get('filename')})"
+                elif dedupe['duplicate']:
+                    error = f"Duplicate of already converted file {dedupe['duplicate_of'].get('filename')}"
+                else:
+                    error = f"{dedupe['overlap_count']} documents were already converted in another file"
+                return {'success': False, 'duplicate': True, 'error': error, 'dedupe': dedupe}
+            reserve_upload(dedupe_index, pending, file_hash, documents, os.path.basename(csv_file))
+            register = True
+
+    try:
+        results, converted = _convert_file(csv_file, output_dir, file_hash, compression, site_index, history_dir,
+                                           anomaly_db, parse_cache, money, budget, rules, sketch_dir, quarantine)
+        if register and results['success']:
+            # Only converted documents - quarantined ones may still come back in a corrected file
+            with index_lock(dedupe_index):
+                index = load_index(dedupe_index)
+                unregister_upload(index, file_hash)
+                save_index(register_upload(index, file_hash, converted, os.path.basename(csv_file),
+                                           results['billing_period']))
+    finally:
+        if register:
+            release_upload(dedupe_index, file_hash)
+    return results
+
+
+def _convert_file(csv_file, output_dir, file_hash, compression, site_index, history_dir, anomaly_db, parse_cache,
+                  money, budget, rules, sketch_dir, quarantine):
+    """convert_csv_to_tsv after the dedupe check; returns (results, document numbers converted)."""
+    cache_stats = None
+    _checkpoint(budget, 'parse')
+    if parse_cache is not None:
+        from parse_cache import cached_billing_frame
+        df, cache_stats = cached_billing_frame(csv_file, parse_cache, load_billing_frame, file_hash)
+    else:
+        df = load_billing_frame(csv_file)
+
+    # Determine output directory
+    if output_dir is None:
+        output_dir = os.path.dirname(csv_file) or '.'
+
+    rejects = None
+    _checkpoint(budget, 'quarantine')
+    if quarantine:
+        from row_quarantine import quarantine_rows
+        df, rejects = quarantine_rows(df)
+        if df.empty:
+            name = f"{os.path.splitext(os.path.basename(csv_file))[0]}_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+            return {'success': False, 'error': f'All {len(rejects)} rows were rejected',
+                    **write_rejects_stage(rejects, output_dir, name, budget)}, df['Document number']
+
+    results = convert_billing_frame(df, output_dir, compression=compression, money=money, budget=budget,
+                                    rules=rules, rejects=rejects)
+    if cache_stats is not None:
+        results['parse_cache'] = cache_stats
+
+    # Last checkpoint - the stages below update shared state (site index, history,
+    # anomalies, sketches, dedupe index) that an abort could not roll back
+    _checkpoint(budget, 'records')
+    if site_index is not None:
+        results['site_keys'] = apply_site_index(site_index, results['site_records'])
+
+    if history_dir is not None:
+        results.update(run_history_stages(history_dir, anomaly_db, results['billing_period'], results['site_records']))
 
+    if sketch_dir is not None:
+        results['sketch_file'] = save_sketch_stage(sketch_dir, results['billing_period'], results['site_records'])
+
+    return results, df['Document number']
+
+
+def apply_site_index(site_index, site_records):
+    """Assign surrogate site keys to site_records from the persistent index file."""
+    from site_dimension import load_site_index, save_site_index, assign_site_keys
+
+    index = load_site_index(site_index)
+    stats = assign_site_keys(index, site_records)
+    save_site_index(index, site_index)
+    return stats
+
+
+def run_history_stages(history_dir, anomaly_db, billing_period, site_records, append=False):
+    """
+    Save the period's site records to the history and run the post-conversion analytics.
+    append adds the records to the stored period instead of replacing it.
+    """
+    from site_history import save_period_records, append_period_records
+
+    save = append_period_records if append else save_period_records
+    stages = {'history_file': os.path.basename(save(history_dir, billing_period, site_records))}
+    if anomaly_db is not None:
+        from anomaly_detector import run_anomaly_stage
+        stages['anomalies'] = run_anomaly_stage(history_dir, anomaly_db, [billing_period])
+    return stages
+
+
+def save_sketch_stage(sketch_dir, billing_period, site_records, append=False):
+    """Store the period's dashboard sketches (append merges into the stored ones); returns the file name."""
+    from site_sketches import save_period_sketch, add_to_period_sketch
+    save = add_to_period_sketch if append else save_period_sketch
+    return os.path.basename(save(sketch_dir, billing_period, site_records))
+
+
+def merge_document_summary(summaries, summary_path):
+    """Add new per-document summaries to a summary file (a document already in it accumulates)."""
+    import pandas as pd
+
+    existing = pd.read_csv(summary_path, sep='\t', encoding='utf-8-sig', dtype=str, keep_default_na=False)
+    merged = {row['document_number']: row for row in existing.to_dict('records')}
+    for document, summary in summaries.items():
+        row = merged.get(str(document))
+        if row is None:
+            merged[str(document)] = summary
+            continue
+        for column in SUMMARY_AMOUNT_COLUMNS:
+            row[column] = float(row[column]) + summary[column]
+        for column in ('included_lines', 'excluded_lines'):
+            row[column] = int(row[column]) + summary[column]
+        row['last_line'] = summary['last_line']
+
+    tmp_path = summary_path + '.tmp'
+    pd.DataFrame(list(merged.values()), columns=SUMMARY_COLUMNS).to_csv(
+        tmp_path, sep='\t', index=False, encoding='utf-8-sig')
+    os.replace(tmp_path, summary_path)
+    return summary_path
+
+
+def merge_fixed_rejects(rejects_csv, tsv_path, money='float', budget=None, rules=None, site_index=None,
+                        history_dir=None, anomaly_db=None, sketch_dir=None, dedupe_index=None):
+    """
+    Convert a fixed rejects file (written by a --quarantine conversion) and merge
+    the rows into that conversion's outputs, without converting the month again:
+    the invoice lines are appended to tsv_path (continuing its line numbers, same
+    payer), the per-document summary is updated, the new lines also go to their
+    own '<Month>_<Year>_FINAL_merge_<timestamp>.xlsx' (the month's XLSX is not
+    reloaded), and the site records are added to the history and sketches.
+    Rows that still fail validation go to a new rejects file.
+    With dedupe_index the merged documents are registered under the fixed file's
+    hash, and merging the same fixed file twice is rejected.
+    Use the same rules and money engine as the original conversion.
+    """
+    from dedupe_index import (index_lock, load_index, save_index, load_pending, reserve_upload, release_upload,
+                              register_upload)
+
+    register = False
+    _checkpoint(budget, 'dedupe')
+    if dedupe_index is not None:
+        file_hash = file_sha256(rejects_csv)
+        with index_lock(dedupe_index):
+            index = load_index(dedupe_index)
+            pending = load_pending(dedupe_index)
+            if file_hash in pending:
+                return {'success': False, 'duplicate': True,
+                        'error': f"The same file is being merged ({pending[file_hash].get('filename')})"}
+            if file_hash in index['files']:
+                return {'success': False, 'duplicate': True,
+                        'error': f"Already merged or converted as {index['files'][file_hash].get('filename')}"}
+            reserve_upload(dedupe_index, pending, file_hash, [], os.path.basename(rejects_csv))
+            register = True
+
+    try:
+        results, merged = _merge_rows(rejects_csv, tsv_path, money, budget, rules, site_index, history_dir,
+                                      anomaly_db, sketch_dir)
+        if register and results['success']:
+            with index_lock(dedupe_index):
+                index = load_index(dedupe_index)
+                save_index(register_upload(index, file_hash, merged, os.path.basename(rejects_csv),
+                                           results['billing_period']))
+    finally:
+        if register:
+            release_upload(dedupe_index, file_hash)
     return results
 
 
+def _merge_rows(rejects_csv, tsv_path, money, budget, rules, site_index, history_dir, anomaly_db, sketch_dir):
+    """merge_fixed_rejects after the dedupe check; returns (results, document numbers merged)."""
+    import pandas as pd
+    from row_quarantine import quarantine_rows, drop_reject_columns, REASONS_COLUMN
+    from billing_rules import load_rule_set, rule_stamp
+
+    match = INVOICE_LINES_PATTERN.match(os.path.basename(tsv_path))
+    if match is None:
+        raise ValueError(f"Not the invoice-lines TSV of an uncompressed conversion: {tsv_path}")
+    year_month, timestamp, file_suffix = match.groups()
+    output_dir = os.path.dirname(tsv_path) or '.'
+    month = datetime.strptime(year_month, '%Y%m')
+    merge_timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    summary_filename = f'invoice_summary - {year_month}_{timestamp}{file_suffix}.tsv'
+    excel_filename = f"{month.strftime('%B_%Y')}_FINAL{file_suffix}_merge_{merge_timestamp}.xlsx"
+    summary_path = os.path.join(output_dir, summary_filename)
+    excel_path = os.path.join(output_dir, excel_filename)
+    for path in (tsv_path, summary_path):
+        if not os.path.exists(path):
+            raise ValueError(f"Output to merge into not found: {path}")
+
+    rules = rules or load_rule_set()
+    _checkpoint(budget, 'parse')
+    fixed = clean_billing_frame(read_billing_csv(rejects_csv))
+    # Rows that are still bad keep the source_row of the original file
+    df, rejects = quarantine_rows(fixed.drop(columns=[REASONS_COLUMN], errors='ignore'))
+    df = drop_reject_columns(df)
+    if not df.empty and billing_date(df).strftime('%Y%m') != year_month:
+        raise ValueError(f"Rows are for {billing_date(df).strftime('%Y-%m')}, "
+                         f"the outputs are for {month.strftime('%Y-%m')}")
+
+    reject_stats = {}
+    if len(rejects):
+        reject_stats = write_rejects_stage(rejects, output_dir, f"{year_month}_{merge_timestamp}{file_suffix}", budget)
+    if df.empty:
+        return {'success': False, 'error': f'All {len(rejects)} rows were rejected again',
+                **reject_stats}, df['Document number']
+
+    # Line numbers and payer continue from the existing TSV
+    header = list(pd.read_csv(tsv_path, sep='\t', encoding='utf-8-sig', nrows=0).columns)
+    existing = pd.read_csv(tsv_path, sep='\t', encoding='utf-8-sig',
+                           usecols=['מספר שורה', 'חשבון לקוח משלם', 'שם הלקוח המשלם'])
+    start_row = int(existing['מספר שורה'].max()) + 1 if len(existing) else 1
+    payer = ({'payer_account': existing['חשבון לקוח משלם'].tolist()[0],
+              'payer_name': existing['שם הלקוח המשלם'].tolist()[0]} if len(existing) else None)
+
+    summaries = {}
+    _checkpoint(budget, 'invoice_lines')
+    result_df = pd.DataFrame(generate_invoice_lines(df, payer, summaries, budget, rules, start_row))
+    if set(result_df.columns) != set(header):
+        raise ValueError(f"Invoice-line columns do not match {os.path.basename(tsv_path)}")
+    _checkpoint(budget, 'money')
+    result_df, money_stats = apply_money_engine(result_df[header], df, summaries, money, rules)
+
+    billing_period = month.strftime('%Y-%m')
+    site_records = extract_site_records(df, billing_period, int(month.month), int(month.year), budget)
+
+    # Last checkpoint - the existing outputs, site index, history and sketches change
+    # from here on, and an abort could not roll any of it back
+    _checkpoint(budget, 'outputs')
+    merge_document_summary(summaries, summary_path)
+    write_excel_output(result_df, excel_path)
+    result_df.to_csv(tsv_path, sep='\t', index=False, header=False, mode='a', encoding='utf-8')
+
+    included = result_df[result_df['כלול בחיוב'] == 'כן']
+    total_sum = included['סכום '].sum()
+    csv_total = df['Total cost'].sum()
+    results = {
+        'success': True,
+        'merged': True,
+        'merged_rows': len(df),
+        'csv_total': float(csv_total),
+        'tsv_total': float(total_sum),
+        'total_with_vat': float(included['סכום כולל מע"מ'].sum()),
+        'difference': float(abs(csv_total - total_sum)),
+        'perfect_match': bool(abs(csv_total - total_sum) < 1),
+        'total_rows': len(result_df),
+        'included_rows': len(included),
+        'first_line': start_row,
+        'site_count': len(site_records),
+        'billing_month': int(month.month),
+        'billing_year': int(month.year),
+        'billing_period': billing_period,
+        'tsv_filename': os.path.basename(tsv_path),
+        'tsv_path': tsv_path,
+        'excel_filename': excel_filename,
+        'excel_path': excel_path,
+        'summary_filename': summary_filename,
+        'summary_path': summary_path,
+        'document_count': len(summaries),
+        **rule_stamp(rules),
+        **reject_stats,
+        'site_records': site_records,
+    }
+    if money_stats:
+        # Integer engines reconcile exactly against the CSV totals - no tolerance
+        results['money'] = money_stats
+        results['difference'] = money_stats['difference']
+        results['perfect_match'] = money_stats['difference'] == 0
+
+    if site_index is not None:
+        results['site_keys'] = apply_site_index(site_index, site_records)
+    if history_dir is not None:
+        results.update(run_history_stages(history_dir, anomaly_db, billing_period, site_records, append=True))
+    if sketch_dir is not None:
+        results['sketch_file'] = save_sketch_stage(sketch_dir, billing_period, site_records, append=True)
+    return results, df['Document number']
+
+
+def load_payer_map(payer_map_file):
+    """
+    Load the payer mapping JSON: {partition value: {"payer_account": 10003, "payer_name": "..."}}.
+    payer_name defaults to the partition value itself.
+    """
+    with open(payer_map_file, encoding='utf-8') as f:
+        mapping = json.load(f)
+    return {str(key): {'payer_account': entry['payer_account'],
+                       'payer_name': entry.get('payer_name', str(key))}
+            for key, entry in mapping.items()}
+
+
+def _convert_partition(df, output_dir, payer, file_suffix, compression, money, budget, rules):
+    """convert_billing_frame in a worker process; an aborted partition deletes its own outputs."""
+    from job_budget import BudgetExceeded
+
+    try:
+        return convert_billing_frame(df, output_dir, payer, file_suffix, compression, money, budget, rules)
+    except (BudgetExceeded, MemoryError):
+        if budget is not None:
+            budget.remove_outputs()
+        raise
+
+
+def convert_partitioned(csv_file, output_dir=None, partition_key='Customer name',
+                        payer_map_file=None, max_workers=None, compression=None, site_index=None,
+                        history_dir=None, anomaly_db=None, money='float', budget=None, rules=None, sketch_dir=None,
+                        quarantine=False):
+    """
+    Convert a combined file covering several customers (municipalities).
+    Rows are grouped by partition_key, mapped to a paying customer through the
+    payer map, and each customer is converted concurrently in a process pool into
+    its own TSV/XLSX and site-record set.
+    Under a budget every worker checks its own copy (time, its own memory, cancel
+    files); when the parent stops, running workers are told through a cancel file.
+    With quarantine, rejected rows of all customers go to one rejects CSV.
+    """
+    from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+    from billing_rules import load_rule_set, rule_stamp
+
+    if payer_map_file is None:
+        raise ValueError("Partitioned conversion needs a payer map file (--payer-map)")
+
+    _checkpoint(budget, 'parse')
+    df = load_billing_frame(csv_file)
+    if partition_key not in df.columns:
+        raise ValueError(f"Partition column not found in CSV: {partition_key}")
+
+    payer_map = load_payer_map(payer_map_file)
+    # Loaded once so every partition is billed with the same rules
+    rules = rules or load_rule_set()
+    keys = df[partition_key].astype(str).str.strip()
+    missing = sorted(set(keys) - set(payer_map))
+    if missing:
+        raise ValueError(f"No payer account mapped for {partition_key}: {missing}")
+
+    # Several partition values may bill the same payer - they share one output set
+    accounts = keys.map(lambda key: payer_map[key]['payer_account'])
+
+    if output_dir is None:
+        output_dir = os.path.dirname(csv_file) or '.'
+
+    reject_stats = {}
+    _checkpoint(budget, 'quarantine')
+    if quarantine:
+        from row_quarantine import quarantine_rows
+        df, rejects = quarantine_rows(df)
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        if df.empty:
+            name = f"{os.path.splitext(os.path.basename(csv_file))[0]}_{timestamp}"
+            return {'success': False, 'error': f'All {len(rejects)} rows were rejected',
+                    **write_rejects_stage(rejects, output_dir, name, budget)}
+        if len(rejects):
+            reject_stats = write_rejects_stage(rejects, output_dir,
+                                               f"{billing_date(df).strftime('%Y%m')}_{timestamp}", budget)
+        keys, accounts = keys[df.index], accounts[df.index]
+
+    partitions = []
+    _checkpoint(budget, 'partitions')
+    if budget is not None:
+        budget.share_with_workers(os.path.join(output_dir, f'.cancel_{os.getpid()}'))
+    try:
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            futures = {}
+            for account, part in df.groupby(accounts, sort=True):
+                part_keys = sorted(keys[part.index].unique())
+                payer = payer_map[part_keys[0]]
+                future = pool.submit(_convert_partition, part, output_dir, payer, f'_{account}', compression,
+                                     money, budget, rules)
+                futures[future] = (payer, part_keys)
+            try:
+                pending = set(futures)
+                while pending:
+                    done, pending = wait(pending, timeout=STAGE_CHECK_SECONDS if budget is not None else None,
+                                         return_when=FIRST_COMPLETED)
+                    for future in done:
+                        payer, part_keys = futures[future]
+                        partitions.append({**future.result(), **payer, 'partition_values': part_keys})
+                        if budget is not None:
+                            for key in ('tsv_path', 'excel_path', 'summary_path'):
+                                budget.output(partitions[-1][key])
+                            if compression:
+                                budget.output(partitions[-1]['tsv_path'] + '.idx.json')
+                    _checkpoint(budget)
+            except BaseException:
+                # Queued partitions never start; running ones stop at their next checkpoint
+                for future in futures:
+                    future.cancel()
+                if budget is not None:
+                    budget.stop_workers()
+                raise
+    finally:
+        if budget is not None and os.path.exists(budget.worker_cancel_file):
+            os.remove(budget.worker_cancel_file)
+
+    partitions.sort(key=lambda r: str(r['payer_account']))
+
+    # Last checkpoint - the stages below update shared state an abort could not roll back.
+    # Keys are assigned here, not in the workers, so the index has a single writer
+    site_keys = None
+    _checkpoint(budget, 'records')
+    if site_index is not None:
+        site_keys = apply_site_index(site_index, [record for r in partitions for record in r['site_records']])
+
+    # All customers of one period share a history file and a sketch file
+    by_period = {}
+    for r in partitions:
+        by_period.setdefault(r['billing_period'], []).extend(r['site_records'])
+
+    history = {}
+    if history_dir is not None:
+        for period, records in sorted(by_period.items()):
+            history[period] = run_history_stages(history_dir, anomaly_db, period, records)
+
+    sketch_files = []
+    if sketch_dir is not None:
+        sketch_files = [save_sketch_stage(sketch_dir, period, records) for period, records in sorted(by_period.items())]
+    csv_total = sum(r['csv_total'] for r in partitions)
+    tsv_total = sum(r['tsv_total'] for r in partitions)
+
+    return {
+        'success': True,
+        'partitioned': True,
+        'partition_key': partition_key,
+        'partition_count': len(partitions),
+        'csv_total': float(csv_total),
+        'tsv_total': float(tsv_total),
+        'difference': float(abs(csv_total - tsv_total)),
+        'perfect_match': all(r['perfect_match'] for r in partitions),
+        **rule_stamp(rules),
+        **reject_stats,
+        'partitions': partitions,
+        **({'site_keys': site_keys} if site_keys else {}),
+        **({'history': history} if history else {}),
+        **({'sketch_files': sketch_files} if sketch_files else {}),
+    }
+
+
+def _pop_flag(args, flag):
+    """Remove a boolean '--flag' from args and return whether it was present."""
+    if flag not in args:
+        return False
+    args.remove(flag)
+    return True
+
+
+def _pop_option(args, flag):
+    """Remove '--flag value' from args and return the value (None if absent)."""
+    if flag not in args:
+        return None
+    i = args.index(flag)
+    value = args[i + 1] if i + 1 < len(args) else None
+    del args[i:i + 2]
+    return value
+
+
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print(json.dumps({'success': False, 'error': 'Usage: python billflow_converter.py <csv_file> [output_dir]'}))
+    args = sys.argv[1:]
+    dedupe_index = _pop_option(args, '--dedupe-index')
+    partition_key = _pop_option(args, '--partition-by')
+    payer_map_file = _pop_option(args, '--payer-map')
+    workers = _pop_option(args, '--workers')
+    compression = _pop_option(args, '--compress')
+    site_index = _pop_option(args, '--site-index')
+    history_dir = _pop_option(args, '--history-dir')
+    anomaly_db = _pop_option(args, '--anomaly-db')
+    parse_cache = _pop_option(args, '--parse-cache')
+    money = _pop_option(args, '--money') or 'float'
+    max_seconds = _pop_option(args, '--max-seconds')
+    max_memory_mb = _pop_option(args, '--max-memory-mb')
+    cancel_file = _pop_option(args, '--cancel-file')
+    rules_version = _pop_option(args, '--rules')
+    sketch_dir = _pop_option(args, '--sketch-dir')
+    merge_into = _pop_option(args, '--merge-into')
+    quarantine = _pop_flag(args, '--quarantine')
+    reprocess = _pop_flag(args, '--reprocess')
+    probe = _pop_flag(args, '--probe')
+    validate = _pop_flag(args, '--validate')
+
+    if len(args) < 1:
+        print(json.dumps({'success': False, 'error': 'Usage: python billflow_converter.py <csv_file> [output_dir] [--probe | --validate] [--dedupe-index DIR [--reprocess]] [--site-index FILE] [--history-dir DIR [--anomaly-db FILE]] [--sketch-dir DIR] [--parse-cache DIR] [--money float|agorot] '
+                                                     '[--partition-by COLUMN --payer-map FILE [--workers N]] [--compress gzip|zstd] '
+                                                     '[--max-seconds S] [--max-memory-mb MB] [--cancel-file FILE] [--rules VERSION|FILE] '
+                                                     '[--quarantine | <fixed_rejects_csv> --merge-into INVOICE_LINES_TSV]'}))
         sys.exit(1)
 
-    csv_file = sys.argv[1]
-    output_dir = sys.argv[2] if len(sys.argv) > 2 else None
+    csv_file = args[0]
+    output_dir = args[1] if len(args) > 1 else None
 
     try:
-        result = convert_csv_to_tsv(csv_file, output_dir)
+        if probe:
+            result = probe_csv(csv_file)
+        elif validate:
+            result = validate_csv(csv_file)
+        else:
+            from job_budget import JobBudget, run_with_budget
+            from billing_rules import load_rule_set
+
+            rules = load_rule_set(rules_version)
+
+            # SIGTERM (e.g. the server cancelling the job) stops at the next checkpoint
+            budget = JobBudget(float(max_seconds) if max_seconds else None,
+                               float(max_memory_mb) if max_memory_mb else None, cancel_file)
+            budget.install_signal_handlers()
+            if merge_into:
+                result = run_with_budget(budget, merge_fixed_rejects, csv_file, merge_into, money, rules=rules,
+                                         site_index=site_index, history_dir=history_dir, anomaly_db=anomaly_db,
+                                         sketch_dir=sketch_dir, dedupe_index=dedupe_index)
+            elif partition_key:
+                result = run_with_budget(budget, convert_partitioned, csv_file, output_dir, partition_key,
+                                         payer_map_file, int(workers) if workers else None, compression,
+                                         site_index, history_dir, anomaly_db, money, rules=rules,
+                                         sketch_dir=sketch_dir, quarantine=quarantine)
+            else:
+                result = run_with_budget(budget, convert_csv_to_tsv, csv_file, output_dir,
+                                         dedupe_index=dedupe_index, compression=compression,
+                                         site_index=site_index, history_dir=history_dir, anomaly_db=anomaly_db,
+                                         parse_cache=parse_cache, money=money, rules=rules, sketch_dir=sketch_dir,
+                                         quarantine=quarantine, reprocess=reprocess)
         print(json.dumps(result, ensure_ascii=False))
+        if not result['success']:
+            sys.exit(1)
     except Exception as e:
         print(json.dumps({'success': False, 'error': str(e)}))
         sys.exit(1)
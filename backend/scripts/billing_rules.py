@@ -0,0 +1,111 @@
+"""
+BillFlow Billing Rule Sets
+The VAT rate and the invoice-line item catalogue (P-codes and descriptions) are
+versioned JSON files in backend/rules/rules_v<N>.json instead of constants in the
+converters. Every conversion reports the rule version and fingerprint it used, so
+an output can always be traced back to the rules that produced it.
+
+A rule set has:
+    version       - integer, matches the file name
+    vat_percent   - integer VAT percentage
+    tariffs       - energy and gross display items per tariff; the first entry whose
+                    "match" occurs in the upper-cased Tariff ID wins, "match": null
+                    is the fallback
+    items         - fixed-charge items keyed by their per-document summary column
+Changing any code, description or rate means adding a new version file, never
+editing an old one.
+"""
+import os
+import re
+import sys
+import json
+import hashlib
+
+RULES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'rules')
+RULE_FILE_PATTERN = re.compile(r'^rules_v(\d+)\.json$')
+
+TARIFF_ITEMS = ['energy_peak', 'energy_offpeak', 'gross_peak', 'gross_offpeak']
+ITEM_COLUMNS = ['discount_peak', 'discount_offpeak', 'supply', 'distribution', 'kva',
+                'power_factor_fine', 'various_charges', 'various_credits']
+
+
+def available_versions(rules_dir=RULES_DIR):
+    """Sorted rule-set versions present in rules_dir."""
+    versions = []
+    for name in os.listdir(rules_dir):
+        match = RULE_FILE_PATTERN.match(name)
+        if match:
+            versions.append(int(match.group(1)))
+    return sorted(versions)
+
+
+def rule_set_path(version=None, rules_dir=RULES_DIR):
+    """Path of a rule set: a version number (default: the latest) or a JSON file path."""
+    if version is not None and str(version).endswith('.json'):
+        return str(version)
+    if version is None:
+        versions = available_versions(rules_dir)
+        if not versions:
+            raise ValueError(f"No rule sets found in {rules_dir}")
+        version = versions[-1]
+    return os.path.join(rules_dir, f'rules_v{int(str(version).lstrip("v"))}.json')
+
+
+def load_rule_set(version=None, rules_dir=RULES_DIR):
+    """
+    Load and check a rule set. Adds the derived fields the converters use:
+    vat_rate, vat_multiplier (1 + VAT), item_columns {item code: summary column}
+    and fingerprint (hash of the file content).
+    """
+    path = rule_set_path(version, rules_dir)
+    if not os.path.exists(path):
+        raise ValueError(f"Rule set not found: {path}")
+    with open(path, 'rb') as f:
+        content = f.read()
+    rules = json.loads(content.decode('utf-8'))
+
+    if not any(tariff.get('match') is None for tariff in rules['tariffs']):
+        raise ValueError(f"Rule set {path} has no fallback tariff (\"match\": null)")
+    for tariff in rules['tariffs']:
+        missing = [item for item in TARIFF_ITEMS if item not in tariff]
+        if missing:
+            raise ValueError(f"Tariff {tariff.get('match')} in {path} is missing {missing}")
+    missing = [item for item in ITEM_COLUMNS if item not in rules['items']]
+    if missing:
+        raise ValueError(f"Rule set {path} is missing items {missing}")
+
+    # Divisions of integers so 18% gives exactly the 0.18 / 1.18 the converters always used
+    rules['vat_rate'] = rules['vat_percent'] / 100
+    rules['vat_multiplier'] = (100 + rules['vat_percent']) / 100
+    rules['item_columns'] = {item['code']: column for column, item in rules['items'].items()}
+    rules['fingerprint'] = hashlib.sha256(content).hexdigest()[:16]
+    rules['path'] = os.path.abspath(path)
+    return rules
+
+
+def tariff_rules(rules, tariff_id):
+    """The tariff entry for a Tariff ID value."""
+    tariff_id = str(tariff_id).upper()
+    for tariff in rules['tariffs']:
+        if tariff.get('match') is not None and tariff['match'] in tariff_id:
+            return tariff
+    return next(tariff for tariff in rules['tariffs'] if tariff.get('match') is None)
+
+
+def rule_stamp(rules):
+    """The fields recorded with every output."""
+    return {'rule_version': rules['version'], 'rule_fingerprint': rules['fingerprint']}
+
+
+if __name__ == "__main__":
+    try:
+        if len(sys.argv) > 1 and sys.argv[1] != 'list':
+            rules = load_rule_set(sys.argv[1])
+            print(json.dumps({'success': True, **rules}, ensure_ascii=False))
+        else:
+            versions = available_versions()
+            print(json.dumps({'success': True, 'versions': versions,
+                              'latest': versions[-1] if versions else None}))
+    except Exception as e:
+        print(json.dumps({'success': False, 'error': str(e)}))
+        sys.exit(1)
@@ -0,0 +1,136 @@
+"""
+BillFlow Compressed TSV Output
+Writes invoice-line TSVs as gzip or zstd in document-aligned frames.
+
+Each frame is an independent gzip member / zstd frame holding whole documents, so:
+- the file is still a normal .gz/.zst stream (gzip -d / zstd -d restore the exact TSV)
+- a sidecar index (<file>.idx.json) maps every document to its frames (normally
+  one; more if the document's lines are not contiguous), and a single document is
+  read back by decompressing only those frames.
+"""
+import io
+import os
+import json
+import time
+import gzip
+import numpy as np
+
+DOCUMENT_COLUMN = 'מספר חשבונית'
+DEFAULT_DOCS_PER_FRAME = 64
+CODEC_EXTENSIONS = {'gzip': '.gz', 'zstd': '.zst'}
+
+
+def _compressor(codec, level):
+    if codec == 'gzip':
+        return lambda data: gzip.compress(data, compresslevel=level or 6)
+    if codec == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise ValueError("zstd compression requires the 'zstandard' package (pip install zstandard)")
+        compressor = zstandard.ZstdCompressor(level=level or 9)
+        return compressor.compress
+    raise ValueError(f"Unsupported compression codec: {codec}")
+
+
+def _decompressor(codec):
+    if codec == 'gzip':
+        return gzip.decompress
+    import zstandard
+    return zstandard.ZstdDecompressor().decompress
+
+
+def _data_encoding(encoding):
+    """utf-8-sig only prefixes the BOM once - data frames use plain utf-8."""
+    return 'utf-8' if encoding == 'utf-8-sig' else encoding
+
+
+def index_path_for(path):
+    return path + '.idx.json'
+
+
+def write_framed_tsv(df, path, codec='gzip', docs_per_frame=DEFAULT_DOCS_PER_FRAME,
+                     level=None, encoding='utf-8-sig'):
+    """
+    Write df as a compressed TSV, one frame per docs_per_frame consecutive documents.
+    Rows keep their order; a document whose lines are split over several runs is
+    indexed in every frame it appears in. Returns compression statistics.
+    """
+    compress = _compressor(codec, level)
+    started = time.perf_counter()
+    documents = df[DOCUMENT_COLUMN].to_numpy()
+
+    # Row offsets where a new document starts, then every docs_per_frame-th of them
+    doc_starts = np.concatenate(([0], np.flatnonzero(documents[1:] != documents[:-1]) + 1)) if len(df) else np.array([0])
+    frame_starts = list(doc_starts[::docs_per_frame]) + [len(df)]
+
+    raw_bytes = 0
+    frames = []
+    document_frames = {}
+
+    with open(path, 'wb') as f:
+        # Header frame (with the BOM) so the decompressed stream equals the plain TSV
+        header = df.iloc[:0].to_csv(sep='\t', index=False).encode(encoding)
+        block = compress(header)
+        f.write(block)
+        header_frame = [0, len(block)]
+        raw_bytes += len(header)
+        offset = len(block)
+
+        data_encoding = _data_encoding(encoding)
+        for start, end in zip(frame_starts[:-1], frame_starts[1:]):
+            if start >= end:
+                continue
+            text = df.iloc[start:end].to_csv(sep='\t', index=False, header=False).encode(data_encoding)
+            block = compress(text)
+            f.write(block)
+            frame_no = len(frames)
+            frames.append([offset, len(block), int(end - start)])
+            for doc in np.unique(documents[start:end]):
+                document_frames.setdefault(str(doc), []).append(frame_no)
+            raw_bytes += len(text)
+            offset += len(block)
+
+    seconds = time.perf_counter() - started
+    index = {
+        'codec': codec,
+        'encoding': encoding,
+        'header': header_frame,
+        'frames': frames,
+        'documents': document_frames,
+    }
+    with open(index_path_for(path), 'w', encoding='utf-8') as f:
+        json.dump(index, f)
+
+    return {
+        'codec': codec,
+        'frame_count': len(frames),
+        'raw_bytes': raw_bytes,
+        'compressed_bytes': offset,
+        'compression_ratio': raw_bytes / offset if offset else 0.0,
+        'write_seconds': seconds,
+        'write_mb_per_second': raw_bytes / seconds / 1e6 if seconds else 0.0,
+        'index_filename': os.path.basename(index_path_for(path)),
+    }
+
+
+def read_document(path, document_number):
+    """Read one document's invoice lines by decompressing only its frames."""
+    import pandas as pd
+
+    with open(index_path_for(path), encoding='utf-8') as f:
+        index = json.load(f)
+    frame_numbers = index['documents'].get(str(document_number), [])
+    decompress = _decompressor(index['codec'])
+
+    body = ''
+    with open(path, 'rb') as f:
+        f.seek(index['header'][0])
+        header = decompress(f.read(index['header'][1])).decode(index['encoding'])
+        for frame_no in frame_numbers:
+            offset, length, _ = index['frames'][frame_no]
+            f.seek(offset)
+            body += decompress(f.read(length)).decode(_data_encoding(index['encoding']))
+
+    frame = pd.read_csv(io.StringIO(header + body), sep='\t')
+    return frame[frame[DOCUMENT_COLUMN].astype(str) == str(document_number)]
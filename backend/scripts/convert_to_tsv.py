@@ -1,16 +1,136 @@
 import os
-import glob
-import pandas as pd
+import re
 import sys
 import io
+import glob
+import json
+import time
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from excel_reader import excel_to_tsv
+from file_hash import file_sha256
+
+# Manifest of already converted workbooks, kept in the output folder
+MANIFEST_FILENAME = '.tsv_manifest.json'
+
+# Map Hebrew months to numbers
+HEBREW_MONTHS = {
+    'ינואר': '01', 'פברואר': '02', 'מרץ': '03', 'אפריל': '04',
+    'מאי': '05', 'יוני': '06', 'יולי': '07', 'אוגוסט': '08',
+    'ספטמבר': '09', 'אוקטובר': '10', 'נובמבר': '11', 'דצמבר': '12'
+}
+
+
+def tsv_filename_for(filename: str) -> str:
+    """
+    Build the standardized TSV filename for an Excel file:
+    invoice_lines - YYYYMM_YYYYMMDD_HHMM.txt (TSV with .txt extension)
+    """
+    # Try to extract month/year from the Excel filename
+    match = re.search(r'invoice_lines [-–] (\d{6})_(\d{8}_\d{4})', filename)
+    if match:
+        # Already in new format, just change extension to .txt
+        data_month = match.group(1)
+        timestamp = match.group(2)
+    else:
+        # Try to extract from old format
+        match_old = re.search(r'(\w+)\s+(\d{4})', filename)
+        if match_old:
+            month = HEBREW_MONTHS.get(match_old.group(1), '01')
+            data_month = f"{match_old.group(2)}{month}"
+        else:
+            # Fallback to current date
+            data_month = datetime.now().strftime("%Y%m")
+
+        # Generate new timestamp
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M")
+
+    return f"invoice_lines - {data_month}_{timestamp}.txt"
+
+
+def load_manifest(output_folder: str) -> dict:
+    """Load the conversion manifest ({excel filename: entry}), empty if missing or unreadable."""
+    manifest_path = os.path.join(output_folder, MANIFEST_FILENAME)
+    try:
+        with open(manifest_path, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
 
-# Set UTF-8 encoding for stdout
-sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
 
-def convert_excel_to_tsv(input_folder: str, output_folder: str = None):
+def save_manifest(output_folder: str, manifest: dict):
+    """Write the manifest atomically so an interrupted run never leaves it half-written."""
+    manifest_path = os.path.join(output_folder, MANIFEST_FILENAME)
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, manifest_path)
+
+
+def is_unchanged(excel_file: str, entry: dict, output_folder: str) -> bool:
+    """
+    Check an Excel file against its manifest entry.
+    Size and mtime are compared first; the content hash settles the case where
+    only the mtime moved (file copied or touched without edits).
+    """
+    if not entry or not os.path.exists(os.path.join(output_folder, entry.get('tsv_filename', ''))):
+        return False
+
+    stat = os.stat(excel_file)
+    if stat.st_size != entry.get('size'):
+        return False
+    if stat.st_mtime_ns == entry.get('mtime_ns'):
+        return True
+    if file_sha256(excel_file) != entry.get('sha256'):
+        return False
+
+    # Same content - refresh the mtime so the hash is skipped next time
+    entry['mtime_ns'] = stat.st_mtime_ns
+    return True
+
+
+def unique_tsv_filenames(excel_files: list, reserved: set = ()) -> dict:
+    """
+    Assign TSV filenames up front so parallel workers never write the same file.
+    Files that fall back to the same month/timestamp (or a reserved name) get a numeric suffix.
+    """
+    names = {}
+    taken = set(reserved)
+    for excel_file in excel_files:
+        tsv_filename = tsv_filename_for(os.path.basename(excel_file))
+        stem, ext = os.path.splitext(tsv_filename)
+        suffix = 2
+        while tsv_filename in taken:
+            tsv_filename = f"{stem}_{suffix}{ext}"
+            suffix += 1
+        taken.add(tsv_filename)
+        names[excel_file] = tsv_filename
+    return names
+
+
+def convert_one_file(excel_file: str, output_folder: str, tsv_filename: str) -> dict:
+    """Convert a single Excel file to TSV. Runs inside a worker process."""
+    started = time.perf_counter()
+    stat = os.stat(excel_file)
+
+    # UTF-8 with BOM for better Excel/Google Sheets compatibility
+    row_count = excel_to_tsv(excel_file, os.path.join(output_folder, tsv_filename), encoding='utf-8-sig')
+
+    return {
+        'tsv_filename': tsv_filename,
+        'rows': row_count,
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'sha256': file_sha256(excel_file),
+        'seconds': time.perf_counter() - started,
+    }
+
+
+def convert_excel_to_tsv(input_folder: str, output_folder: str = None,
+                         incremental: bool = True, max_workers: int = None):
     """
     Convert Excel files to TSV (Tab Separated Values) format for Google Sheets.
-    
+
     Parameters:
     -----------
     input_folder : str
@@ -18,133 +138,131 @@ def convert_excel_to_tsv(input_folder: str, output_folder: str = None):
     output_folder : str, optional
         Path to folder where TSV files will be saved.
         If None, saves to input_folder/TSV_Files
+    incremental : bool
+        Skip files whose size, mtime and content hash match the manifest
+        from the previous run. False reconverts everything.
+    max_workers : int, optional
+        Size of the worker pool for changed files (defaults to CPU count)
     """
-    
+
     if not os.path.exists(input_folder):
-        print(f"❌ Folder not found: {input_folder}")
+        print(f"[ERROR] Folder not found: {input_folder}")
         return
-    
+
     # Set output folder
     if output_folder is None:
         output_folder = os.path.join(input_folder, "TSV_Files")
-    
+
     # Create output folder if it doesn't exist
     os.makedirs(output_folder, exist_ok=True)
-    
+
     # Find all Excel files
     excel_pattern = os.path.join(input_folder, "*.xlsx")
-    excel_files = glob.glob(excel_pattern)
-    
+    excel_files = sorted(glob.glob(excel_pattern))
+
     if not excel_files:
-        print(f"❌ No Excel (.xlsx) files found in: {input_folder}")
+        print(f"[ERROR] No Excel (.xlsx) files found in: {input_folder}")
         return
-    
-    print(f"📊 Converting {len(excel_files)} Excel files to TSV format")
-    print(f"📂 Input folder: {input_folder}")
-    print(f"📁 Output folder: {output_folder}")
-    print("🔄 TSV format is perfect for Google Sheets import")
+
+    manifest = load_manifest(output_folder)
+    pending = [f for f in excel_files
+               if not incremental or not is_unchanged(f, manifest.get(os.path.basename(f)), output_folder)]
+    skipped = len(excel_files) - len(pending)
+
+    print(f"Converting {len(pending)} of {len(excel_files)} Excel files to TSV format "
+          f"({skipped} unchanged)")
+    print(f"Input folder: {input_folder}")
+    print(f"Output folder: {output_folder}")
     print()
-    
+
     successful = 0
     failed = 0
-    
-    for i, excel_file in enumerate(excel_files, 1):
-        filename = os.path.basename(excel_file)
-        print(f"📝 [{i}/{len(excel_files)}] Converting: {filename}")
-        
-        try:
-            # Read Excel file
-            df = pd.read_excel(excel_file)
-            
-            # Create standardized TSV filename
-            import re
-            from datetime import datetime
-            
-            # Try to extract month/year from the Excel filename
-            match = re.search(r'invoice_lines [-–] (\d{6})_(\d{8}_\d{4})', filename)
-            if match:
-                # Already in new format, just change extension to .txt
-                data_month = match.group(1)
-                timestamp = match.group(2)
-            else:
-                # Try to extract from old format
-                match_old = re.search(r'(\w+)\s+(\d{4})', filename)
-                if match_old:
-                    month_name = match_old.group(1)
-                    year = match_old.group(2)
-                    # Map Hebrew months to numbers
-                    month_map = {
-                        'ינואר': '01', 'פברואר': '02', 'מרץ': '03', 'אפריל': '04',
-                        'מאי': '05', 'יוני': '06', 'יולי': '07', 'אוגוסט': '08',
-                        'ספטמבר': '09', 'אוקטובר': '10', 'נובמבר': '11', 'דצמבר': '12'
-                    }
-                    month = month_map.get(month_name, '01')
-                    data_month = f"{year}{month}"
-                else:
-                    # Fallback to current date
-                    data_month = datetime.now().strftime("%Y%m")
-                
-                # Generate new timestamp
-                timestamp = datetime.now().strftime("%Y%m%d_%H%M")
-            
-            # New filename format: invoice_lines - YYYYMM_YYYYMMDD_HHMM.txt (TSV with .txt extension)
-            tsv_filename = f"invoice_lines - {data_month}_{timestamp}.txt"
-            tsv_path = os.path.join(output_folder, tsv_filename)
-            
-            # Convert to TSV (tab-separated values)
-            df.to_csv(
-                tsv_path,
-                sep='\t',  # Tab separator
-                index=False,  # Don't include row numbers
-                encoding='utf-8-sig'  # UTF-8 with BOM for better Excel/Google Sheets compatibility
-            )
-            
-            print(f"   ✅ Success: {len(df)} rows → {tsv_filename}")
-            successful += 1
-            
-        except Exception as e:
-            print(f"   ❌ Error: {str(e)}")
-            failed += 1
-    
+    timings = []
+    started = time.perf_counter()
+
+    if pending:
+        pending_names = {os.path.basename(f) for f in pending}
+        reserved = {entry.get('tsv_filename') for name, entry in manifest.items() if name not in pending_names}
+        tsv_names = unique_tsv_filenames(pending, reserved)
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            futures = {pool.submit(convert_one_file, f, output_folder, tsv_names[f]): os.path.basename(f)
+                       for f in pending}
+            for i, future in enumerate(as_completed(futures), 1):
+                filename = futures[future]
+                try:
+                    entry = future.result()
+                except Exception as e:
+                    print(f"[{i}/{len(pending)}] FAILED {filename}: {str(e)}")
+                    failed += 1
+                    continue
+
+                # Remove the previous TSV of a reconverted file if its name changed
+                previous = manifest.get(filename, {}).get('tsv_filename')
+                if previous and previous != entry['tsv_filename']:
+                    previous_path = os.path.join(output_folder, previous)
+                    if os.path.exists(previous_path):
+                        os.remove(previous_path)
+
+                manifest[filename] = entry
+                timings.append((filename, entry['seconds'], entry['rows']))
+                print(f"[{i}/{len(pending)}] {filename}: {entry['rows']} rows -> {entry['tsv_filename']}")
+                successful += 1
+
+    save_manifest(output_folder, manifest)
+    elapsed = time.perf_counter() - started
+
     print()
     print("=" * 70)
-    print(f"🎉 TSV CONVERSION COMPLETED!")
-    print(f"✅ Successfully converted: {successful} files")
-    print(f"❌ Failed: {failed} files")
-    print(f"📁 TSV files saved to: {output_folder}")
-    print()
-    print("📋 How to use TSV files:")
-    print("1. Open Google Sheets")
-    print("2. File → Import → Upload → Select .tsv file")
-    print("3. Choose 'Tab' as separator")
-    print("4. Import data")
+    print("TSV CONVERSION COMPLETED")
+    print(f"Converted: {successful}  Unchanged: {skipped}  Failed: {failed}")
+    if timings:
+        print()
+        print("Per-file timing (slowest first):")
+        for filename, seconds, rows in sorted(timings, key=lambda t: t[1], reverse=True):
+            print(f"  {seconds:8.2f}s  {rows:>8} rows  {filename}")
+        print(f"  Total {sum(t[1] for t in timings):.2f}s of work in {elapsed:.2f}s wall time")
+    print(f"TSV files saved to: {output_folder}")
     print("=" * 70)
 
 def convert_specific_folder(folder_path: str):
     """
     Convert Excel files in a specific folder to TSV
     """
-    print(f"🎯 Converting Excel files in: {folder_path}")
+    print(f"Converting Excel files in: {folder_path}")
     convert_excel_to_tsv(folder_path)
 
 def main():
     """
     Main function - you can specify which folder to convert
+
+    Usage: python convert_to_tsv.py [input_folder] [output_folder] [--full] [--workers N]
     """
-    
+    args = sys.argv[1:]
+    incremental = '--full' not in args
+    max_workers = None
+    if '--workers' in args:
+        max_workers = int(args[args.index('--workers') + 1])
+        del args[args.index('--workers'):args.index('--workers') + 2]
+    folders = [a for a in args if not a.startswith('--')]
+
+    if folders:
+        output_folder = folders[1] if len(folders) > 1 else None
+        convert_excel_to_tsv(folders[0], output_folder, incremental, max_workers)
+        return
+
     print("Excel to TSV Converter for Google Sheets")
     print("=" * 50)
-    
+
     # DEFAULT FOLDERS TO TRY:
     possible_folders = [
         r"F:\ClaudeCode\test files\Before\Processed_Excel_Files",  # Batch processed files
         r"F:\ClaudeCode\test files\VAT_fix",  # VAT corrected files
         r"F:\ClaudeCode\test files",  # Test files folder
     ]
-    
+
     print("Available folders with Excel files:")
     print()
-    
+
     available_folders = []
     for i, folder in enumerate(possible_folders, 1):
         if os.path.exists(folder):
@@ -156,18 +274,20 @@ def main():
                 print(f"{i}. {folder} (no Excel files)")
         else:
             print(f"{i}. {folder} (folder not found)")
-    
+
     print()
-    
+
     if available_folders:
-        print("🚀 Converting all available folders:")
+        print("Converting all available folders:")
         for folder in available_folders:
-            print(f"\n📂 Processing: {folder}")
-            convert_excel_to_tsv(folder)
+            print(f"\nProcessing: {folder}")
+            convert_excel_to_tsv(folder, incremental=incremental, max_workers=max_workers)
     else:
-        print("❌ No Excel files found in any default folders")
+        print("No Excel files found in any default folders")
         print("You can manually specify a folder path:")
         print('convert_excel_to_tsv("C:\\path\\to\\your\\excel\\files")')
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    # Set UTF-8 encoding for stdout (Hebrew filenames on Windows consoles)
+    sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
+    main()
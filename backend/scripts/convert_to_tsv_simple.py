@@ -5,15 +5,12 @@ Simple Excel to TSV converter for the billing system
 import sys
 import os
 import re
-import pandas as pd
 from datetime import datetime
+from excel_reader import excel_to_tsv
 
 def convert_excel_to_tsv(excel_path, tsv_path=None):
     """Convert Excel file to TSV format with proper naming convention"""
     try:
-        # Read Excel file
-        df = pd.read_excel(excel_path)
-        
         # If no output path specified, generate one with proper naming
         if tsv_path is None:
             filename = os.path.basename(excel_path)
@@ -52,8 +49,8 @@ def convert_excel_to_tsv(excel_path, tsv_path=None):
             tsv_filename = f"invoice_lines - {data_month}_{timestamp}.txt"
             tsv_path = os.path.join(output_dir, tsv_filename)
         
-        # Write to TSV (tab-separated values)
-        df.to_csv(tsv_path, sep='\t', index=False, encoding='utf-8')
+        # Stream rows straight into the TSV (tab-separated values)
+        excel_to_tsv(excel_path, tsv_path, encoding='utf-8')
         
         return True
     except Exception as e:
@@ -0,0 +1,364 @@
+"""
+BillFlow Upload Deduplication Index
+Detects re-uploaded files (same content under any filename) and files whose
+documents overlap already converted ones, before any conversion work starts.
+
+Index directory layout:
+    files.json      - {sha256: {filename, billing_period, document_count, registered_at}}
+    documents.npy   - sorted int64 array of every converted Document number (exact set)
+    bloom.npy       - Bloom filter bits over the same document numbers
+    bloom.json      - Bloom filter parameters
+    file_documents/ - <sha256>.npy: the document numbers each file registered, so a
+                      deleted upload can be unregistered
+    pending.json    - uploads being converted right now: {sha256: {filename, documents, pid, reserved_at}}
+    .lock           - lock file; hold index_lock() from load to save
+
+Concurrent conversions (server requests, hot-folder workers) share one index: the
+check reserves the upload's documents under the lock, so a second upload of the
+same file or documents is rejected while the first one is still converting, and
+the reservation becomes a registration (or is dropped) when the conversion ends.
+
+A Bloom filter cannot forget a document, so unregister_upload() rebuilds it from
+the exact set that is left.
+"""
+import os
+import sys
+import json
+import math
+import time
+import numpy as np
+from contextlib import contextmanager
+from datetime import datetime
+from file_hash import file_sha256
+
+DEFAULT_CAPACITY = 1_000_000
+DEFAULT_ERROR_RATE = 0.001
+MAX_REPORTED_OVERLAPS = 20
+# A reservation whose conversion died without releasing it expires after this long
+RESERVATION_SECONDS = 6 * 3600
+
+_MASK64 = np.uint64(0xFFFFFFFFFFFFFFFF)
+
+
+def _splitmix64(x):
+    """Vectorized splitmix64 finalizer - spreads sequential document numbers over the bit array."""
+    x = (x + np.uint64(0x9E3779B97F4A7C15)) & _MASK64
+    x = ((x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)) & _MASK64
+    x = ((x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)) & _MASK64
+    return x ^ (x >> np.uint64(31))
+
+
+def _bloom_positions(documents, bits, hashes):
+    """Bit positions (len(documents), hashes) using double hashing h1 + i*h2."""
+    keys = documents.astype(np.uint64)
+    h1 = _splitmix64(keys)
+    h2 = _splitmix64(keys ^ np.uint64(0xD6E8FEB86659FD93)) | np.uint64(1)
+    steps = np.arange(hashes, dtype=np.uint64)
+    with np.errstate(over='ignore'):
+        return (h1[:, None] + steps[None, :] * h2[:, None]) % np.uint64(bits)
+
+
+def bloom_parameters(capacity, error_rate=DEFAULT_ERROR_RATE):
+    """Optimal bit count and hash count for the expected number of documents."""
+    bits = int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+    hashes = max(1, int(round(bits / capacity * math.log(2))))
+    return bits, hashes
+
+
+def _paths(index_dir):
+    return {name: os.path.join(index_dir, name)
+            for name in ('files.json', 'documents.npy', 'bloom.npy', 'bloom.json')}
+
+
+def _file_documents_path(index_dir, file_hash):
+    return os.path.join(index_dir, 'file_documents', f'{file_hash}.npy')
+
+
+def _atomic_save(path, writer):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        writer(f)
+    os.replace(tmp_path, path)
+
+
+@contextmanager
+def index_lock(index_dir):
+    """Exclusive lock of an index directory across processes."""
+    os.makedirs(index_dir, exist_ok=True)
+    with open(os.path.join(index_dir, '.lock'), 'a+b') as f:
+        if os.name == 'nt':
+            import msvcrt
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    continue  # LK_LOCK gives up after 10 seconds
+        else:
+            import fcntl
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if os.name == 'nt':
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def _process_alive(pid):
+    if os.name == 'nt':
+        return True  # os.kill would terminate it; rely on the expiry
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def load_pending(index_dir):
+    """Live reservations (expired ones and those of dead processes are dropped). Call under index_lock."""
+    path = os.path.join(index_dir, 'pending.json')
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding='utf-8') as f:
+        pending = json.load(f)
+    now = time.time()
+    return {file_hash: entry for file_hash, entry in pending.items()
+            if now - entry['reserved_at'] < RESERVATION_SECONDS and _process_alive(entry['pid'])}
+
+
+def save_pending(index_dir, pending):
+    _atomic_save(os.path.join(index_dir, 'pending.json'),
+                 lambda f: f.write(json.dumps(pending, ensure_ascii=False).encode('utf-8')))
+
+
+def reserve_upload(index_dir, pending, file_hash, documents, filename=None):
+    """Reserve an upload's documents while it converts (call under index_lock after check_upload)."""
+    pending[file_hash] = {
+        'filename': filename,
+        'documents': np.unique(np.asarray(documents, dtype=np.int64)).tolist(),
+        'pid': os.getpid(),
+        'reserved_at': time.time(),
+    }
+    save_pending(index_dir, pending)
+
+
+def release_upload(index_dir, file_hash):
+    """Drop a reservation (the conversion finished or failed)."""
+    with index_lock(index_dir):
+        pending = load_pending(index_dir)
+        if pending.pop(file_hash, None) is not None:
+            save_pending(index_dir, pending)
+
+
+def load_index(index_dir):
+    """Load an index directory (an empty index if it does not exist yet)."""
+    paths = _paths(index_dir)
+    if not os.path.exists(paths['files.json']):
+        bits, hashes = bloom_parameters(DEFAULT_CAPACITY)
+        return {
+            'dir': index_dir,
+            'files': {},
+            'documents': np.empty(0, dtype=np.int64),
+            'bloom': np.zeros((bits + 7) // 8, dtype=np.uint8),
+            'bloom_meta': {'bits': bits, 'hashes': hashes, 'capacity': DEFAULT_CAPACITY},
+        }
+
+    with open(paths['files.json'], encoding='utf-8') as f:
+        files = json.load(f)
+    with open(paths['bloom.json'], encoding='utf-8') as f:
+        bloom_meta = json.load(f)
+    return {
+        'dir': index_dir,
+        'files': files,
+        # Memory-mapped: a lookup touches only the pages it needs
+        'documents': np.load(paths['documents.npy'], mmap_mode='r'),
+        'bloom': np.load(paths['bloom.npy'], mmap_mode='r'),
+        'bloom_meta': bloom_meta,
+    }
+
+
+def save_index(index):
+    """Persist an index; each file is replaced atomically."""
+    os.makedirs(index['dir'], exist_ok=True)
+    paths = _paths(index['dir'])
+    _atomic_save(paths['documents.npy'], lambda f: np.save(f, np.asarray(index['documents'])))
+    _atomic_save(paths['bloom.npy'], lambda f: np.save(f, np.asarray(index['bloom'])))
+    _atomic_save(paths['bloom.json'], lambda f: f.write(json.dumps(index['bloom_meta']).encode('utf-8')))
+    for file_hash, documents in index.pop('registered', {}).items():
+        os.makedirs(os.path.dirname(_file_documents_path(index['dir'], file_hash)), exist_ok=True)
+        _atomic_save(_file_documents_path(index['dir'], file_hash), lambda f: np.save(f, documents))
+    # files.json last - its presence marks a complete index
+    _atomic_save(paths['files.json'],
+                 lambda f: f.write(json.dumps(index['files'], ensure_ascii=False, indent=2).encode('utf-8')))
+    for file_hash in index.pop('unregistered', []):
+        if os.path.exists(_file_documents_path(index['dir'], file_hash)):
+            os.remove(_file_documents_path(index['dir'], file_hash))
+
+
+def _bloom_contains(index, documents):
+    meta = index['bloom_meta']
+    positions = _bloom_positions(documents, meta['bits'], meta['hashes'])
+    bytes_, offsets = positions // np.uint64(8), (positions % np.uint64(8)).astype(np.uint8)
+    hits = (np.asarray(index['bloom'])[bytes_.astype(np.int64)] >> offsets) & 1
+    return hits.all(axis=1)
+
+
+def find_known_documents(index, documents):
+    """
+    Return the subset of documents already in the index.
+    The Bloom filter rules out almost every new document without touching the
+    exact set; only Bloom positives are confirmed with a binary search.
+    """
+    documents = np.unique(np.asarray(documents, dtype=np.int64))
+    if documents.size == 0 or len(index['documents']) == 0:
+        return documents[:0]
+    candidates = documents[_bloom_contains(index, documents)]
+    if candidates.size == 0:
+        return candidates
+    known = index['documents']
+    positions = np.searchsorted(known, candidates).clip(max=len(known) - 1)
+    return candidates[np.asarray(known)[positions] == candidates]
+
+
+def check_upload(index, file_hash, documents, pending=None):
+    """
+    Classify an upload against the index and the reservations of running conversions.
+    Returns {'duplicate', 'duplicate_of', 'overlap_count', 'overlap_documents', 'document_count'}.
+    """
+    pending = pending or {}
+    known = find_known_documents(index, documents)
+    if pending:
+        reserved = np.concatenate([np.asarray(entry['documents'], dtype=np.int64) for entry in pending.values()])
+        known = np.union1d(known, np.intersect1d(np.asarray(documents, dtype=np.int64), reserved))
+    duplicate_of = index['files'].get(file_hash)
+    if duplicate_of is None and file_hash in pending:
+        duplicate_of = {'filename': pending[file_hash]['filename'], 'converting': True}
+    return {
+        'sha256': file_hash,
+        'duplicate': duplicate_of is not None,
+        'duplicate_of': duplicate_of,
+        'document_count': int(np.unique(np.asarray(documents, dtype=np.int64)).size),
+        'overlap_count': int(known.size),
+        'overlap_documents': [str(d) for d in known[:MAX_REPORTED_OVERLAPS]],
+    }
+
+
+def _add_to_bloom(bloom, meta, documents):
+    if documents.size:
+        positions = _bloom_positions(documents, meta['bits'], meta['hashes']).ravel()
+        np.bitwise_or.at(bloom, (positions // np.uint64(8)).astype(np.int64),
+                         (np.uint8(1) << (positions % np.uint64(8)).astype(np.uint8)))
+    return bloom
+
+
+def register_upload(index, file_hash, documents, filename=None, billing_period=None):
+    """Add a converted file and its documents to the index (call save_index afterwards)."""
+    documents = np.unique(np.asarray(documents, dtype=np.int64))
+    merged = np.union1d(np.asarray(index['documents']), documents)
+    meta = index['bloom_meta']
+
+    if merged.size > meta['capacity']:
+        # Grow and rebuild the filter from the exact set to keep the error rate bounded
+        capacity = max(merged.size * 2, meta['capacity'] * 2)
+        bits, hashes = bloom_parameters(capacity)
+        meta = {'bits': bits, 'hashes': hashes, 'capacity': capacity}
+        bloom = _add_to_bloom(np.zeros((bits + 7) // 8, dtype=np.uint8), meta, merged)
+    else:
+        bloom = _add_to_bloom(np.array(index['bloom']), meta, documents)
+
+    index['documents'] = merged
+    index['bloom'] = bloom
+    index['bloom_meta'] = meta
+    index['files'][file_hash] = {
+        'filename': filename,
+        'billing_period': billing_period,
+        'document_count': int(documents.size),
+        'registered_at': datetime.now().isoformat(timespec='seconds'),
+    }
+    previous = index.get('registered', {}).get(file_hash)
+    if previous is None and os.path.exists(_file_documents_path(index['dir'], file_hash)):
+        previous = np.load(_file_documents_path(index['dir'], file_hash))
+    index.setdefault('registered', {})[file_hash] = (
+        documents if previous is None else np.union1d(previous, documents))
+    if file_hash in index.get('unregistered', []):
+        index['unregistered'].remove(file_hash)
+    return index
+
+
+def unregister_upload(index, file_hash):
+    """
+    Remove a file and the documents only it registered (call save_index afterwards).
+    Returns the number of documents removed.
+    """
+    if index['files'].pop(file_hash, None) is None:
+        return 0
+    path = _file_documents_path(index['dir'], file_hash)
+    documents = index.get('registered', {}).pop(file_hash, None)
+    if documents is None:
+        documents = np.load(path) if os.path.exists(path) else np.empty(0, dtype=np.int64)
+    index.setdefault('unregistered', []).append(file_hash)
+
+    # Documents another file also registered (e.g. a merge of fixed rejects) stay
+    for other in index['files']:
+        if documents.size == 0:
+            break
+        other_documents = index.get('registered', {}).get(other)
+        if other_documents is None and os.path.exists(_file_documents_path(index['dir'], other)):
+            other_documents = np.load(_file_documents_path(index['dir'], other), mmap_mode='r')
+        if other_documents is not None:
+            documents = np.setdiff1d(documents, other_documents)
+
+    if documents.size == 0:
+        return 0
+    remaining = np.setdiff1d(np.asarray(index['documents']), documents)
+    meta = index['bloom_meta']
+    index['documents'] = remaining
+    index['bloom'] = _add_to_bloom(np.zeros((meta['bits'] + 7) // 8, dtype=np.uint8), meta, remaining)
+    return int(documents.size)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3 or sys.argv[1] not in ('check', 'register', 'unregister', 'stats'):
+        print(json.dumps({'success': False, 'error': 'Usage: python dedupe_index.py check|register|unregister <index_dir> [csv_file]'}))
+        sys.exit(1)
+
+    command, index_dir = sys.argv[1], sys.argv[2]
+    try:
+        with index_lock(index_dir):
+            index = load_index(index_dir)
+            pending = load_pending(index_dir)
+        if command == 'stats':
+            print(json.dumps({'success': True, 'files': len(index['files']),
+                              'documents': len(index['documents']), 'converting': len(pending),
+                              'bloom': index['bloom_meta']}))
+        else:
+            from billflow_converter import read_billing_csv
+
+            csv_file = sys.argv[3]
+            file_hash = file_sha256(csv_file)
+            if command != 'unregister':
+                documents = read_billing_csv(csv_file, usecols=['Document number'])['Document number'].dropna()
+            if command == 'check':
+                print(json.dumps({'success': True, **check_upload(index, file_hash, documents, pending)},
+                                 ensure_ascii=False))
+            elif command == 'register':
+                with index_lock(index_dir):
+                    index = load_index(index_dir)
+                    save_index(register_upload(index, file_hash, documents, os.path.basename(csv_file)))
+                print(json.dumps({'success': True, 'sha256': file_hash, 'documents': len(index['documents'])}))
+            else:
+                with index_lock(index_dir):
+                    index = load_index(index_dir)
+                    removed = unregister_upload(index, file_hash)
+                    save_index(index)
+                print(json.dumps({'success': True, 'sha256': file_hash, 'removed_documents': removed,
+                                  'documents': len(index['documents'])}))
+    except Exception as e:
+        print(json.dumps({'success': False, 'error': str(e)}))
+        sys.exit(1)
@@ -0,0 +1,161 @@
+"""
+BillFlow Streaming Excel Reader
+Reads XLSX workbooks row by row instead of loading the whole workbook into memory.
+Uses python-calamine when it is installed and openpyxl read-only mode otherwise.
+"""
+import csv
+import os
+from datetime import datetime, date, time
+
+DEFAULT_CHUNK_SIZE = 5000
+
+# Strings pd.read_excel() treats as missing by default
+NA_STRINGS = {'', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan',
+              '1.#IND', '1.#QNAN', '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None',
+              'n/a', 'nan', 'null'}
+
+
+def available_engine():
+    """Return the fastest installed streaming engine ('calamine' or 'openpyxl')."""
+    try:
+        import python_calamine  # noqa: F401
+        return 'calamine'
+    except ImportError:
+        return 'openpyxl'
+
+
+def _calamine_rows(path, sheet_name):
+    from python_calamine import CalamineWorkbook
+
+    workbook = CalamineWorkbook.from_path(path)
+    sheet = workbook.get_sheet_by_name(sheet_name or workbook.sheet_names[0])
+    yield from sheet.iter_rows()
+
+
+def _openpyxl_rows(path, sheet_name):
+    import openpyxl
+
+    workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        sheet = workbook[sheet_name] if sheet_name else workbook.active
+        # Some exporters write a wrong <dimension> tag, which truncates read-only iteration
+        sheet.reset_dimensions()
+        for row in sheet.iter_rows(values_only=True):
+            yield row
+    finally:
+        workbook.close()
+
+
+def iter_excel_rows(path, sheet_name=None, engine=None):
+    """
+    Yield the rows of one worksheet as tuples, header row first.
+    NA strings become None and fully empty rows are skipped, as in pd.read_excel.
+    """
+    engine = engine or available_engine()
+    if engine == 'calamine':
+        rows = _calamine_rows(path, sheet_name)
+    elif engine == 'openpyxl':
+        rows = _openpyxl_rows(path, sheet_name)
+    else:
+        raise ValueError(f"Unsupported Excel engine: {engine}")
+
+    for row in rows:
+        row = tuple(None if isinstance(value, str) and value in NA_STRINGS else value
+                    for value in row)
+        if any(value is not None for value in row):
+            yield row
+
+
+def _header_names(header):
+    """Name header cells the way pandas does ('Unnamed: N' for blanks)."""
+    return [str(name) if name is not None else f'Unnamed: {i}' for i, name in enumerate(header)]
+
+
+def _fit_row(row, width):
+    """Pad or truncate a row to the header width."""
+    if len(row) < width:
+        return tuple(row) + (None,) * (width - len(row))
+    return tuple(row[:width])
+
+
+def iter_excel_chunks(path, chunk_size=DEFAULT_CHUNK_SIZE, sheet_name=None, engine=None):
+    """
+    Yield a worksheet as DataFrames of at most chunk_size rows.
+    Only one chunk is held in memory at a time.
+    """
+    import pandas as pd
+
+    rows = iter_excel_rows(path, sheet_name, engine)
+    header = next(rows, None)
+    if header is None:
+        return
+    columns = _header_names(header)
+    width = len(columns)
+
+    chunk = []
+    for row in rows:
+        chunk.append(_fit_row(row, width))
+        if len(chunk) >= chunk_size:
+            yield _chunk_frame(chunk, columns)
+            chunk = []
+    if chunk:
+        yield _chunk_frame(chunk, columns)
+
+
+def _chunk_frame(rows, columns):
+    """DataFrame of a chunk with blank cells as NaN (pd.read_excel never hands out None)."""
+    import numpy as np
+    import pandas as pd
+
+    df = pd.DataFrame.from_records(rows, columns=columns)
+    for column in df.columns[df.dtypes == object]:
+        df[column] = df[column].where(df[column].notna(), np.nan)
+    return df
+
+
+def read_excel_frame(path, sheet_name=None, engine=None):
+    """Streaming replacement for pd.read_excel() that returns one DataFrame."""
+    import pandas as pd
+
+    chunks = list(iter_excel_chunks(path, sheet_name=sheet_name, engine=engine))
+    if not chunks:
+        return pd.DataFrame()
+    return pd.concat(chunks, ignore_index=True)
+
+
+def _format_cell(value):
+    """Format a cell the way DataFrame.to_csv() writes it."""
+    if value is None:
+        return ''
+    if isinstance(value, float):
+        return '' if value != value else repr(value)
+    if isinstance(value, datetime):
+        if value.time() == time(0, 0):
+            return value.strftime('%Y-%m-%d')
+        return value.isoformat(sep=' ')
+    if isinstance(value, (date, time)):
+        return value.isoformat()
+    return str(value)
+
+
+def excel_to_tsv(excel_path, tsv_path, encoding='utf-8-sig', sheet_name=None, engine=None):
+    """
+    Stream an Excel worksheet straight into a TSV file in roughly constant memory.
+    Returns the number of data rows written.
+    """
+    rows = iter_excel_rows(excel_path, sheet_name, engine)
+    header = next(rows, None)
+    row_count = 0
+
+    with open(tsv_path, 'w', encoding=encoding, newline='') as f:
+        writer = csv.writer(f, delimiter='\t', lineterminator=os.linesep)
+        if header is None:
+            return row_count
+        columns = _header_names(header)
+        width = len(columns)
+        writer.writerow(columns)
+        for row in rows:
+            writer.writerow([_format_cell(value) for value in _fit_row(row, width)])
+            row_count += 1
+
+    return row_count
@@ -0,0 +1,16 @@
+"""
+BillFlow File Hashing
+Streaming content hashes shared by the conversion scripts.
+"""
+import hashlib
+
+HASH_CHUNK_SIZE = 1024 * 1024  # 1 MB
+
+
+def file_sha256(path, chunk_size=HASH_CHUNK_SIZE):
+    """Hash a file in fixed-size chunks and return the SHA-256 hex digest."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(chunk_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
@@ -0,0 +1,354 @@
+"""
+BillFlow Golden-Output Harness
+Guards optimizations of the converters: a candidate engine must reproduce the
+reference output cell by cell and must not regress throughput or peak memory.
+
+Commands:
+    record  - run the reference engine on every input, store the outputs as golden
+              files plus a performance baseline (golden_dir/baseline.json)
+    check   - run a candidate engine, diff against the golden files and fail on
+              mismatches or on performance regressions beyond the thresholds
+    compare - run a reference and a candidate engine side by side (no stored files)
+    startup - cold-start gate: `billflow_converter.py --validate` must finish within
+              the budget and must not import pandas / NumPy / openpyxl
+
+Engines are names from ENGINES or 'module:function' callables taking
+(input_csv, output_dir) and returning a dict with 'tsv_path'.
+"""
+import os
+import sys
+import glob
+import json
+import time
+import shutil
+import tempfile
+import importlib
+import subprocess
+import statistics
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_INPUTS = os.path.join(SCRIPTS_DIR, '..', '..', 'seed-data', '*.csv')
+
+DEFAULT_FLOAT_TOLERANCE = 1e-6
+DEFAULT_MAX_SLOWDOWN = 0.25       # candidate may lose at most 25% throughput
+DEFAULT_MAX_MEMORY_GROWTH = 0.25  # and use at most 25% more peak memory
+MAX_REPORTED_DIFFS = 20
+
+DEFAULT_STARTUP_BUDGET_MS = 150
+STARTUP_FORBIDDEN_MODULES = ('pandas', 'numpy', 'openpyxl')
+
+
+def _run_billflow(input_csv, output_dir):
+    from billflow_converter import convert_csv_to_tsv
+    return convert_csv_to_tsv(input_csv, output_dir)
+
+
+def _run_transform(input_csv, output_dir):
+    from transform_final_corrected import transform_final_corrected
+    dst = os.path.join(output_dir, os.path.splitext(os.path.basename(input_csv))[0] + '.xlsx')
+    return {**transform_final_corrected(input_csv, dst), 'tsv_path': dst}
+
+
+ENGINES = {
+    'billflow': _run_billflow,
+    'transform': _run_transform,
+}
+
+
+def resolve_engine(name):
+    if name in ENGINES:
+        return ENGINES[name]
+    module_name, _, function_name = name.partition(':')
+    if not function_name:
+        raise ValueError(f"Unknown engine '{name}' - use one of {sorted(ENGINES)} or module:function")
+    return getattr(importlib.import_module(module_name), function_name)
+
+
+def _peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None  # Windows
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KB, macOS bytes
+    return peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
+
+
+def _measure(engine_name, input_csv, output_dir):
+    """Run one engine on one input. Executed in a fresh process so peak RSS is per run."""
+    sys.path.insert(0, SCRIPTS_DIR)
+    engine = resolve_engine(engine_name)
+    started = time.perf_counter()
+    result = engine(input_csv, output_dir)
+    seconds = time.perf_counter() - started
+    return {
+        'output_path': result['tsv_path'],
+        'seconds': seconds,
+        'input_bytes': os.path.getsize(input_csv),
+        'mb_per_second': os.path.getsize(input_csv) / seconds / 1e6 if seconds else 0.0,
+        'peak_rss_mb': _peak_rss_mb(),
+    }
+
+
+def run_engine(engine_name, input_csv, output_dir, repeat=1):
+    """Best-of-repeat measurement, each repetition in its own spawned process."""
+    best = None
+    for _ in range(repeat):
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+            measurement = pool.submit(_measure, engine_name, input_csv, output_dir).result()
+        if best is None or measurement['seconds'] < best['seconds']:
+            best = measurement
+    return best
+
+
+def load_table(path):
+    """Load an output (TSV/.gz/.zst or XLSX) as a DataFrame of strings."""
+    import pandas as pd
+
+    if path.endswith('.xlsx'):
+        from excel_reader import read_excel_frame
+        return read_excel_frame(path).astype(str).replace({'None': '', 'nan': ''})
+    compression = 'zstd' if path.endswith('.zst') else 'infer'
+    return pd.read_csv(path, sep='\t', dtype=str, keep_default_na=False,
+                       encoding='utf-8-sig', compression=compression)
+
+
+def diff_tables(expected, actual, float_tolerance=DEFAULT_FLOAT_TOLERANCE):
+    """
+    Compare two tables cell by cell. Numeric cells match within
+    float_tolerance (absolute, or relative for values above 1); everything else exactly.
+    """
+    import numpy as np
+    import pandas as pd
+
+    problems = []
+    if list(expected.columns) != list(actual.columns):
+        return {'match': False, 'mismatched_cells': None,
+                'problems': [f"columns differ: {list(expected.columns)} != {list(actual.columns)}"]}
+    if len(expected) != len(actual):
+        problems.append(f"row count differs: {len(expected)} != {len(actual)}")
+
+    rows = min(len(expected), len(actual))
+    mismatched = 0
+    for column in expected.columns:
+        left = expected[column].iloc[:rows].to_numpy()
+        right = actual[column].iloc[:rows].to_numpy()
+        left_num = pd.to_numeric(pd.Series(left), errors='coerce').to_numpy()
+        right_num = pd.to_numeric(pd.Series(right), errors='coerce').to_numpy()
+
+        numeric = ~np.isnan(left_num) & ~np.isnan(right_num)
+        scale = np.maximum(1.0, np.abs(left_num))
+        same = np.where(numeric, np.abs(left_num - right_num) <= float_tolerance * scale, left == right)
+        bad_rows = np.flatnonzero(~same)
+        mismatched += len(bad_rows)
+        for row in bad_rows[:max(0, MAX_REPORTED_DIFFS - len(problems))]:
+            problems.append(f"row {row + 1}, column '{column}': {left[row]!r} != {right[row]!r}")
+
+    return {'match': not problems, 'mismatched_cells': mismatched, 'problems': problems}
+
+
+def make_synthetic_csv(seed_csv, target_rows, path):
+    """
+    Build a large input by repeating a seed file with fresh document numbers.
+    Deterministic, so golden outputs recorded from it stay valid.
+    """
+    import pandas as pd
+    from billflow_converter import read_billing_csv
+
+    seed = read_billing_csv(seed_csv)
+    seed = seed[seed['Document number'].notna()]
+    copies = -(-target_rows // len(seed))
+    frames = []
+    for i in range(copies):
+        frame = seed.copy()
+        frame['Document number'] = frame['Document number'].astype('int64') + (i + 1) * 10_000_000
+        frames.append(frame)
+    pd.concat(frames, ignore_index=True).iloc[:target_rows].to_csv(path, index=False, encoding='utf-8-sig')
+    return path
+
+
+def _inputs(patterns):
+    files = []
+    for pattern in patterns or [DEFAULT_INPUTS]:
+        files.extend(glob.glob(pattern))
+    return sorted(set(os.path.abspath(f) for f in files))
+
+
+def record(golden_dir, engine='billflow', inputs=None, synthetic_rows=None, repeat=1):
+    """Store golden outputs and the performance baseline of the reference engine."""
+    os.makedirs(golden_dir, exist_ok=True)
+    files = _inputs(inputs)
+    if synthetic_rows:
+        files.append(make_synthetic_csv(files[0], synthetic_rows,
+                                        os.path.join(golden_dir, f'synthetic_{synthetic_rows}.csv')))
+
+    baseline = {'engine': engine, 'inputs': {}}
+    with tempfile.TemporaryDirectory() as work_dir:
+        for input_csv in files:
+            measurement = run_engine(engine, input_csv, work_dir, repeat)
+            ext = '.xlsx' if measurement['output_path'].endswith('.xlsx') else '.tsv'
+            golden_name = os.path.splitext(os.path.basename(input_csv))[0] + '.golden' + ext
+            shutil.copyfile(measurement['output_path'], os.path.join(golden_dir, golden_name))
+            baseline['inputs'][input_csv] = {**measurement, 'golden': golden_name}
+            del baseline['inputs'][input_csv]['output_path']
+
+    with open(os.path.join(golden_dir, 'baseline.json'), 'w', encoding='utf-8') as f:
+        json.dump(baseline, f, indent=2)
+    return {'success': True, 'recorded': len(files), 'golden_dir': golden_dir}
+
+
+def _perf_gate(reference, candidate, max_slowdown, max_memory_growth):
+    failures = []
+    if candidate['mb_per_second'] < reference['mb_per_second'] * (1 - max_slowdown):
+        failures.append(f"throughput {candidate['mb_per_second']:.2f} MB/s vs baseline "
+                        f"{reference['mb_per_second']:.2f} MB/s")
+    if reference.get('peak_rss_mb') and candidate.get('peak_rss_mb') and \
+            candidate['peak_rss_mb'] > reference['peak_rss_mb'] * (1 + max_memory_growth):
+        failures.append(f"peak memory {candidate['peak_rss_mb']:.0f} MB vs baseline "
+                        f"{reference['peak_rss_mb']:.0f} MB")
+    return failures
+
+
+def check(golden_dir, engine='billflow', float_tolerance=DEFAULT_FLOAT_TOLERANCE,
+          max_slowdown=DEFAULT_MAX_SLOWDOWN, max_memory_growth=DEFAULT_MAX_MEMORY_GROWTH, repeat=1):
+    """Run a candidate engine against the recorded golden outputs and baseline."""
+    with open(os.path.join(golden_dir, 'baseline.json'), encoding='utf-8') as f:
+        baseline = json.load(f)
+
+    report = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        for input_csv, reference in baseline['inputs'].items():
+            candidate = run_engine(engine, input_csv, work_dir, repeat)
+            diff = diff_tables(load_table(os.path.join(golden_dir, reference['golden'])),
+                               load_table(candidate['output_path']), float_tolerance)
+            perf_failures = _perf_gate(reference, candidate, max_slowdown, max_memory_growth)
+            report.append({
+                'input': os.path.basename(input_csv),
+                'output_match': diff['match'],
+                'mismatched_cells': diff['mismatched_cells'],
+                'problems': diff['problems'],
+                'performance_failures': perf_failures,
+                'seconds': candidate['seconds'],
+                'baseline_seconds': reference['seconds'],
+                'peak_rss_mb': candidate['peak_rss_mb'],
+            })
+
+    passed = all(r['output_match'] and not r['performance_failures'] for r in report)
+    return {'success': passed, 'engine': engine, 'reference_engine': baseline['engine'], 'results': report}
+
+
+def compare(reference, candidate, inputs=None, float_tolerance=DEFAULT_FLOAT_TOLERANCE,
+            max_slowdown=DEFAULT_MAX_SLOWDOWN, max_memory_growth=DEFAULT_MAX_MEMORY_GROWTH, repeat=1):
+    """Run two engines on the same inputs and diff their outputs directly."""
+    report = []
+    with tempfile.TemporaryDirectory() as ref_dir, tempfile.TemporaryDirectory() as cand_dir:
+        for input_csv in _inputs(inputs):
+            ref = run_engine(reference, input_csv, ref_dir, repeat)
+            cand = run_engine(candidate, input_csv, cand_dir, repeat)
+            diff = diff_tables(load_table(ref['output_path']), load_table(cand['output_path']), float_tolerance)
+            report.append({
+                'input': os.path.basename(input_csv),
+                'output_match': diff['match'],
+                'mismatched_cells': diff['mismatched_cells'],
+                'problems': diff['problems'],
+                'performance_failures': _perf_gate(ref, cand, max_slowdown, max_memory_growth),
+                'reference_seconds': ref['seconds'],
+                'candidate_seconds': cand['seconds'],
+            })
+
+    passed = all(r['output_match'] and not r['performance_failures'] for r in report)
+    return {'success': passed, 'reference_engine': reference, 'engine': candidate, 'results': report}
+
+
+def startup_check(inputs=None, budget_ms=DEFAULT_STARTUP_BUDGET_MS, repeat=5):
+    """
+    Time `billflow_converter.py <csv> --validate` in fresh interpreters (median of
+    `repeat` runs) and list the heavy modules its import trace pulls in.
+    A run that exits nonzero fails the gate, however fast it was.
+    """
+    input_csv = _inputs(inputs)[0]
+    command = [sys.executable, os.path.join(SCRIPTS_DIR, 'billflow_converter.py'), input_csv, '--validate']
+
+    timings = []
+    runs = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        runs.append(subprocess.run(command, capture_output=True, text=True, cwd=SCRIPTS_DIR))
+        timings.append((time.perf_counter() - started) * 1000)
+
+    traced = subprocess.run([sys.executable, '-X', 'importtime'] + command[1:],
+                            capture_output=True, text=True, cwd=SCRIPTS_DIR)
+    trace = traced.stderr
+    runs.append(traced)
+    imported = {line.rsplit('|', 1)[-1].strip().split('.')[0] for line in trace.splitlines() if '|' in line}
+    heavy = sorted(imported & set(STARTUP_FORBIDDEN_MODULES))
+
+    wall_ms = statistics.median(timings)
+    failures = []
+    for run in runs:
+        if run.returncode != 0:
+            # The import trace is on stderr too - report only the lines that are not part of it
+            stderr = '\n'.join(line for line in run.stderr.splitlines() if not line.startswith('import time:'))
+            failures.append(f'--validate exited with {run.returncode}: {stderr.strip() or run.stdout.strip()}')
+            break
+    if wall_ms > budget_ms:
+        failures.append(f'cold start {wall_ms:.0f} ms exceeds the {budget_ms:.0f} ms budget')
+    if heavy:
+        failures.append(f"--validate imports {', '.join(heavy)}")
+    return {
+        'success': not failures,
+        'input': os.path.basename(input_csv),
+        'wall_ms': wall_ms,
+        'budget_ms': budget_ms,
+        'heavy_imports': heavy,
+        'failures': failures,
+    }
+
+
+if __name__ == "__main__":
+    usage = ('Usage: python golden_harness.py record|check <golden_dir> [--engine NAME] [--inputs GLOB]... '
+             '[--synthetic ROWS] [--float-tolerance X] [--max-slowdown X] [--max-memory-growth X] [--repeat N]\n'
+             '       python golden_harness.py compare <reference_engine> <candidate_engine> [--inputs GLOB]...\n'
+             '       python golden_harness.py startup [--inputs GLOB] [--budget-ms MS] [--repeat N]')
+    args = sys.argv[1:]
+    if not args or args[0] not in ('record', 'check', 'compare', 'startup') or (args[0] != 'startup' and len(args) < 2):
+        print(usage)
+        sys.exit(1)
+
+    inputs = []
+    while '--inputs' in args:
+        i = args.index('--inputs')
+        inputs.append(args[i + 1])
+        del args[i:i + 2]
+    options = {}
+    for flag in ('--engine', '--synthetic', '--float-tolerance', '--max-slowdown', '--max-memory-growth', '--repeat',
+                 '--budget-ms'):
+        if flag in args:
+            i = args.index(flag)
+            options[flag] = args[i + 1]
+            del args[i:i + 2]
+
+    engine = options.get('--engine', 'billflow')
+    repeat = int(options.get('--repeat', 1))
+    gates = {
+        'float_tolerance': float(options.get('--float-tolerance', DEFAULT_FLOAT_TOLERANCE)),
+        'max_slowdown': float(options.get('--max-slowdown', DEFAULT_MAX_SLOWDOWN)),
+        'max_memory_growth': float(options.get('--max-memory-growth', DEFAULT_MAX_MEMORY_GROWTH)),
+    }
+
+    if args[0] == 'startup':
+        result = startup_check(inputs, float(options.get('--budget-ms', DEFAULT_STARTUP_BUDGET_MS)),
+                               int(options.get('--repeat', 5)))
+    elif args[0] == 'record':
+        synthetic = int(options['--synthetic']) if '--synthetic' in options else None
+        result = record(args[1], engine, inputs, synthetic, repeat)
+    elif args[0] == 'check':
+        result = check(args[1], engine, repeat=repeat, **gates)
+    else:
+        result = compare(args[1], args[2], inputs, repeat=repeat, **gates)
+
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    sys.exit(0 if result['success'] else 1)
@@ -0,0 +1,221 @@
+"""
+BillFlow Hot-Folder Ingestion Daemon
+Watches an inbox directory and converts every CSV dropped into it.
+
+- a file is picked up once its size and mtime stop changing for settle_seconds
+- conversions run in a bounded process pool; a bounded queue between the poller
+  and the workers provides backpressure, so dropping hundreds of months at once
+  never runs more than `workers` conversions at a time
+- finished files move to processed/ or failed/ with a <filename>.json result next to them
+- with --max-seconds / --max-memory-mb every conversion runs under a job budget, so
+  one pathological file fails with a "budget_exceeded" result instead of holding a
+  worker or exhausting memory; with a memory budget each conversion gets a fresh
+  worker process, so memory kept by one job never counts against the next
+- with --dedupe-index all workers share one index; the check and registration run
+  under the index lock and a running conversion reserves its documents (see
+  dedupe_index.py), so copies of one file dropped together convert exactly once,
+  and a file dropped again later (under any name) goes to failed/ as a duplicate
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import signal
+import asyncio
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+
+DEFAULT_POLL_SECONDS = 2.0
+DEFAULT_SETTLE_SECONDS = 5.0
+INPUT_EXTENSIONS = ('.csv',)
+
+
+def log(message):
+    print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] {message}", flush=True)
+
+
+def run_conversion(path, output_dir, dedupe_index=None, max_seconds=None, max_memory_mb=None):
+    """Convert one file. Runs in a worker process and never raises."""
+    from billflow_converter import convert_csv_to_tsv
+    from job_budget import JobBudget, run_with_budget
+
+    started = time.perf_counter()
+    try:
+        result = run_with_budget(JobBudget(max_seconds, max_memory_mb), convert_csv_to_tsv, path, output_dir,
+                                 dedupe_index=dedupe_index)
+    except Exception as e:
+        result = {'success': False, 'error': str(e)}
+    result['seconds'] = time.perf_counter() - started
+    return result
+
+
+def _move_unique(path, target_dir):
+    """Move a file into target_dir, adding a timestamp if the name is taken."""
+    os.makedirs(target_dir, exist_ok=True)
+    target = os.path.join(target_dir, os.path.basename(path))
+    if os.path.exists(target):
+        stem, ext = os.path.splitext(os.path.basename(path))
+        target = os.path.join(target_dir, f"{stem}_{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}{ext}")
+    shutil.move(path, target)
+    return target
+
+
+def _scan(inbox):
+    """Current (size, mtime) of every candidate file in the inbox."""
+    found = {}
+    with os.scandir(inbox) as entries:
+        for entry in entries:
+            if entry.is_file() and entry.name.lower().endswith(INPUT_EXTENSIONS):
+                stat = entry.stat()
+                found[entry.path] = (stat.st_size, stat.st_mtime_ns)
+    return found
+
+
+class HotFolder:
+    """Poller + bounded worker pool around convert_csv_to_tsv."""
+
+    def __init__(self, inbox, output_dir, workers=2, queue_size=None,
+                 poll_seconds=DEFAULT_POLL_SECONDS, settle_seconds=DEFAULT_SETTLE_SECONDS,
+                 dedupe_index=None, max_seconds=None, max_memory_mb=None):
+        self.inbox = inbox
+        self.output_dir = output_dir
+        self.workers = workers
+        self.poll_seconds = poll_seconds
+        self.settle_seconds = settle_seconds
+        self.dedupe_index = dedupe_index
+        self.max_seconds = max_seconds
+        self.max_memory_mb = max_memory_mb
+        self.processing_dir = os.path.join(inbox, 'processing')
+        self.processed_dir = os.path.join(inbox, 'processed')
+        self.failed_dir = os.path.join(inbox, 'failed')
+        self.queue = asyncio.Queue(maxsize=queue_size or workers)
+        self.stop_event = asyncio.Event()
+        self.claimed = set()
+        self.stats = {'processed': 0, 'failed': 0}
+
+    async def poll(self, once=False):
+        """Watch the inbox and queue files once they stop growing."""
+        observed = {}  # path -> ((size, mtime), first time this signature was seen)
+        while not self.stop_event.is_set():
+            now = time.monotonic()
+            current = {p: sig for p, sig in _scan(self.inbox).items() if p not in self.claimed}
+            observed = {p: observed[p] if p in observed and observed[p][0] == sig else (sig, now)
+                        for p, sig in current.items()}
+
+            for path, (_, since) in sorted(observed.items(), key=lambda item: (item[1][1], item[0])):
+                if now - since < self.settle_seconds:
+                    continue
+                self.claimed.add(path)
+                # Blocks while the queue is full - the poller stops claiming new files
+                await self.queue.put(path)
+                if self.stop_event.is_set():
+                    break
+
+            if once and not observed:
+                return
+            try:
+                await asyncio.wait_for(self.stop_event.wait(), timeout=self.poll_seconds)
+            except asyncio.TimeoutError:
+                pass
+
+    async def work(self, pool):
+        loop = asyncio.get_running_loop()
+        while True:
+            path = await self.queue.get()
+            try:
+                await self._process(loop, pool, path)
+            finally:
+                self.claimed.discard(path)
+                self.queue.task_done()
+
+    async def _process(self, loop, pool, path):
+        if not os.path.exists(path):
+            return
+        working = _move_unique(path, self.processing_dir)
+        log(f"Converting {os.path.basename(path)}")
+        result = await loop.run_in_executor(pool, run_conversion, working, self.output_dir, self.dedupe_index,
+                                            self.max_seconds, self.max_memory_mb)
+
+        target_dir = self.processed_dir if result.get('success') else self.failed_dir
+        final = _move_unique(working, target_dir)
+        with open(final + '.json', 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
+        if result.get('success'):
+            self.stats['processed'] += 1
+            log(f"Done {os.path.basename(final)} ({result['seconds']:.1f}s, {result.get('billing_period')})")
+        else:
+            self.stats['failed'] += 1
+            log(f"FAILED {os.path.basename(final)}: {result.get('error')}")
+
+    async def run(self, once=False):
+        for directory in (self.processing_dir, self.processed_dir, self.failed_dir, self.output_dir):
+            os.makedirs(directory, exist_ok=True)
+
+        # Files left in processing/ by a crash go back to the inbox
+        for name in os.listdir(self.processing_dir):
+            shutil.move(os.path.join(self.processing_dir, name), os.path.join(self.inbox, name))
+
+        log(f"Watching {self.inbox} with {self.workers} workers")
+        # A fresh process per conversion when memory is budgeted (RSS is per process)
+        with ProcessPoolExecutor(max_workers=self.workers,
+                                 max_tasks_per_child=1 if self.max_memory_mb else None) as pool:
+            workers = [asyncio.create_task(self.work(pool)) for _ in range(self.workers)]
+            await self.poll(once=once)
+            # Drain what was already claimed, then stop the workers
+            await self.queue.join()
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+        log(f"Stopped - processed {self.stats['processed']}, failed {self.stats['failed']}")
+        return self.stats
+
+    def stop(self):
+        log("Shutdown requested - finishing running conversions")
+        self.stop_event.set()
+
+
+async def _main(args):
+    options = {}
+    for flag in ('--output', '--workers', '--queue', '--poll', '--settle', '--dedupe-index',
+                 '--max-seconds', '--max-memory-mb'):
+        if flag in args:
+            i = args.index(flag)
+            options[flag] = args[i + 1]
+            del args[i:i + 2]
+    once = '--once' in args
+    args = [a for a in args if a != '--once']
+
+    inbox = args[0]
+    folder = HotFolder(
+        inbox,
+        options.get('--output', os.path.join(inbox, 'output')),
+        workers=int(options.get('--workers', 2)),
+        queue_size=int(options['--queue']) if '--queue' in options else None,
+        poll_seconds=float(options.get('--poll', DEFAULT_POLL_SECONDS)),
+        settle_seconds=float(options.get('--settle', DEFAULT_SETTLE_SECONDS)),
+        dedupe_index=options.get('--dedupe-index'),
+        max_seconds=float(options['--max-seconds']) if '--max-seconds' in options else None,
+        max_memory_mb=float(options['--max-memory-mb']) if '--max-memory-mb' in options else None,
+    )
+
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, folder.stop)
+        except (NotImplementedError, AttributeError):
+            pass  # Windows - Ctrl+C raises KeyboardInterrupt instead
+
+    stats = await folder.run(once=once)
+    return 1 if once and stats['failed'] else 0
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python hot_folder.py <inbox_dir> [--output DIR] [--workers N] [--queue N] "
+              "[--poll SECONDS] [--settle SECONDS] [--dedupe-index DIR] [--max-seconds S] [--max-memory-mb MB] "
+              "[--once]")
+        sys.exit(1)
+
+    sys.exit(asyncio.run(_main(sys.argv[1:])))
@@ -0,0 +1,165 @@
+"""
+BillFlow Job Budget
+Wall-time and memory limits, plus external cancellation, for one conversion job.
+
+The converter calls budget.checkpoint(stage) between stages and every
+CHECKPOINT_ROWS rows of its row loops. A checkpoint raises BudgetExceeded when
+    - the job has run for longer than max_seconds,
+    - the resident memory of the process is above max_memory_mb, or
+    - the job was cancelled (budget.cancel(), SIGTERM/SIGINT once
+      install_signal_handlers() was called, or one of the cancel files exists).
+Once exceeded, every later checkpoint raises the same error, so concurrent
+stages stop too. Output files registered with budget.output(path) are deleted
+by remove_outputs(), and result() is the structured "budget exceeded" reply.
+Checks are cooperative: a single long call (e.g. writing the XLSX) is only
+interrupted at the next checkpoint after it.
+"""
+import os
+import time
+import signal
+
+CHECKPOINT_ROWS = 500
+
+
+class BudgetExceeded(Exception):
+    """A job ran out of time or memory, or was cancelled."""
+
+    def __init__(self, reason, stage, message):
+        super().__init__(reason, stage, message)
+        self.reason = reason
+        self.stage = stage
+        self.message = message
+
+    def __str__(self):
+        return self.message
+
+
+def resident_memory_mb():
+    """Current resident memory of this process in MB (peak RSS where /proc is missing)."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None  # Windows - memory is not checked
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class JobBudget:
+    """Limits of one conversion job; pass the same object through every stage."""
+
+    def __init__(self, max_seconds=None, max_memory_mb=None, cancel_files=()):
+        self.max_seconds = max_seconds
+        self.max_memory_mb = max_memory_mb
+        if cancel_files is None or isinstance(cancel_files, str):
+            cancel_files = [cancel_files]
+        self.cancel_files = [path for path in cancel_files if path]
+        self.started = time.time()
+        self.stage = 'start'
+        self.peak_memory_mb = 0.0
+        self.cancelled = False
+        self.exceeded = None
+        self.outputs = []
+        self.worker_cancel_file = None
+
+    def elapsed(self):
+        return time.time() - self.started
+
+    def cancel(self, *_):
+        """Request cancellation; also usable as a signal handler."""
+        self.cancelled = True
+
+    def install_signal_handlers(self):
+        """SIGTERM / SIGINT cancel the job at its next checkpoint (main thread only)."""
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(sig, self.cancel)
+
+    def checkpoint(self, stage=None):
+        """Record the stage reached and raise BudgetExceeded if the budget is used up."""
+        if stage is not None and self.exceeded is None:
+            self.stage = stage
+        if self.exceeded is not None:
+            raise self.exceeded
+
+        if self.cancelled or any(os.path.exists(path) for path in self.cancel_files):
+            self._exceed('cancelled', 'Job was cancelled')
+        elapsed = self.elapsed()
+        if self.max_seconds is not None and elapsed > self.max_seconds:
+            self._exceed('time', f'Time budget of {self.max_seconds:g}s exceeded ({elapsed:.1f}s)')
+        memory = resident_memory_mb()
+        if memory is not None:
+            self.peak_memory_mb = max(self.peak_memory_mb, memory)
+            if self.max_memory_mb is not None and memory > self.max_memory_mb:
+                self._exceed('memory', f'Memory budget of {self.max_memory_mb:g} MB exceeded ({memory:.0f} MB)')
+
+    def _exceed(self, reason, message):
+        self.exceeded = BudgetExceeded(reason, self.stage, f'{message} during {self.stage}')
+        raise self.exceeded
+
+    def out_of_memory(self):
+        """Record a MemoryError as an exceeded memory budget and return the error."""
+        if self.exceeded is None:
+            self.exceeded = BudgetExceeded('memory', self.stage, f'Out of memory during {self.stage}')
+        return self.exceeded
+
+    def share_with_workers(self, cancel_file):
+        """
+        Prepare the budget to be pickled into worker processes: workers also watch
+        cancel_file, which stop_workers() creates.
+        """
+        self.worker_cancel_file = cancel_file
+        self.cancel_files.append(cancel_file)
+
+    def stop_workers(self):
+        if self.worker_cancel_file:
+            try:
+                open(self.worker_cancel_file, 'w').close()
+            except OSError:
+                pass  # e.g. the output directory is missing - the workers fail on their own
+
+    def output(self, path):
+        """Register a file the job writes, so an aborted job can delete it."""
+        self.outputs.append(path)
+        return path
+
+    def remove_outputs(self):
+        """Delete the registered output files that exist; returns their names."""
+        removed = []
+        for path in self.outputs:
+            if os.path.exists(path):
+                os.remove(path)
+                removed.append(os.path.basename(path))
+        self.outputs = []
+        return removed
+
+    def result(self, error, removed=()):
+        """The structured reply for a job stopped by its budget."""
+        return {
+            'success': False,
+            'budget_exceeded': True,
+            'reason': error.reason,
+            'stage': error.stage,
+            'error': error.message,
+            'elapsed_seconds': self.elapsed(),
+            'peak_memory_mb': self.peak_memory_mb or None,
+            'max_seconds': self.max_seconds,
+            'max_memory_mb': self.max_memory_mb,
+            'removed_outputs': list(removed),
+        }
+
+
+def run_with_budget(budget, job, *args, **kwargs):
+    """
+    Run job(*args, budget=budget, **kwargs). An exceeded budget (or a MemoryError)
+    deletes the job's registered outputs and returns budget.result() instead.
+    """
+    try:
+        return job(*args, budget=budget, **kwargs)
+    except MemoryError:
+        error = budget.out_of_memory()
+    except BudgetExceeded as e:
+        error = e
+    return budget.result(error, budget.remove_outputs())
@@ -0,0 +1,125 @@
+"""
+BillFlow Parsed-Input Cache
+Keeps the cleaned, typed billing DataFrame of every converted upload so that
+reprocessing the same file skips encoding probing, CSV parsing and number cleanup.
+
+Each entry is a directory of per-column .npy files (memory-mapped on load):
+    <cache_dir>/<sha256>_v<PARSE_CACHE_VERSION>/
+        meta.json           - columns, dtypes, row count, source filename
+        index.npy           - the DataFrame index
+        c<NNN>.npy          - one array per column (text columns as fixed-width unicode)
+        c<NNN>.null.npy     - missing-value mask of a text column
+Entries are keyed by file content hash plus PARSE_CACHE_VERSION, which must be
+bumped whenever read_billing_csv / clean_billing_frame change their output.
+The cache is bounded by size; the least recently used entries are evicted first.
+"""
+import os
+import json
+import time
+import shutil
+import numpy as np
+import pandas as pd
+from file_hash import file_sha256
+
+PARSE_CACHE_VERSION = 1
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+
+
+def entry_dir(cache_dir, file_hash):
+    return os.path.join(cache_dir, f'{file_hash}_v{PARSE_CACHE_VERSION}')
+
+
+def _dir_size(path):
+    return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+
+
+def store_frame(cache_dir, file_hash, df, source=None, max_bytes=DEFAULT_MAX_BYTES):
+    """Write df as a cache entry (atomically) and evict old entries over max_bytes."""
+    target = entry_dir(cache_dir, file_hash)
+    tmp_dir = f'{target}.tmp{os.getpid()}'
+    os.makedirs(tmp_dir, exist_ok=True)
+
+    columns = []
+    for i, column in enumerate(df.columns):
+        series = df[column]
+        name = f'c{i:03d}'
+        if series.dtype == object:
+            nulls = series.isna().to_numpy()
+            np.save(os.path.join(tmp_dir, f'{name}.null.npy'), nulls)
+            np.save(os.path.join(tmp_dir, f'{name}.npy'), series.where(~nulls, '').astype(str).to_numpy(dtype=str))
+            kind = 'text'
+        else:
+            np.save(os.path.join(tmp_dir, f'{name}.npy'), series.to_numpy())
+            kind = 'array'
+        columns.append({'name': column, 'file': name, 'kind': kind, 'dtype': str(series.dtype)})
+
+    np.save(os.path.join(tmp_dir, 'index.npy'), df.index.to_numpy())
+    with open(os.path.join(tmp_dir, 'meta.json'), 'w', encoding='utf-8') as f:
+        json.dump({'version': PARSE_CACHE_VERSION, 'sha256': file_hash, 'source': source,
+                   'rows': len(df), 'columns': columns}, f, ensure_ascii=False)
+
+    if os.path.exists(target):
+        shutil.rmtree(target, ignore_errors=True)
+    os.replace(tmp_dir, target)
+    evict(cache_dir, max_bytes, keep=target)
+    return target
+
+
+def load_frame(cache_dir, file_hash):
+    """Return the cached DataFrame for file_hash, or None on a miss."""
+    target = entry_dir(cache_dir, file_hash)
+    meta_path = os.path.join(target, 'meta.json')
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path, encoding='utf-8') as f:
+        meta = json.load(f)
+
+    data = {}
+    for column in meta['columns']:
+        values = np.load(os.path.join(target, f"{column['file']}.npy"), mmap_mode='r')
+        if column['kind'] == 'text':
+            nulls = np.load(os.path.join(target, f"{column['file']}.null.npy"))
+            values = values.astype(object)
+            values[nulls] = np.nan
+        data[column['name']] = values
+    index = np.load(os.path.join(target, 'index.npy'))
+
+    # Touch for LRU eviction
+    os.utime(meta_path)
+    return pd.DataFrame(data, index=index, columns=[c['name'] for c in meta['columns']])
+
+
+def evict(cache_dir, max_bytes=DEFAULT_MAX_BYTES, keep=None):
+    """Remove least recently used entries until the cache fits in max_bytes."""
+    entries = []
+    for entry in os.scandir(cache_dir):
+        meta_path = os.path.join(entry.path, 'meta.json')
+        if entry.is_dir() and os.path.exists(meta_path):
+            entries.append((os.stat(meta_path).st_mtime, entry.path, _dir_size(entry.path)))
+
+    total = sum(size for _, _, size in entries)
+    evicted = 0
+    for _, path, size in sorted(entries):
+        if total <= max_bytes:
+            break
+        if path == keep:
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+        evicted += 1
+    return evicted
+
+
+def cached_billing_frame(csv_file, cache_dir, loader, file_hash=None, max_bytes=DEFAULT_MAX_BYTES):
+    """
+    loader(csv_file) through the cache. Returns (df, stats) where stats reports
+    whether the entry was hit and how long loading took.
+    """
+    started = time.perf_counter()
+    file_hash = file_hash or file_sha256(csv_file)
+    df = load_frame(cache_dir, file_hash)
+    hit = df is not None
+    if not hit:
+        df = loader(csv_file)
+        store_frame(cache_dir, file_hash, df, os.path.basename(csv_file), max_bytes)
+    return df, {'hit': hit, 'seconds': time.perf_counter() - started}
@@ -0,0 +1,147 @@
+"""
+BillFlow Period Diff
+What changed per site between two billing periods.
+
+Site records of both periods are keyed by normalized meter number (the same
+rules as site_dimension.normalize_number, applied column-wise), aggregated per
+meter and joined with one outer merge. Every site is classified as
+new / removed / changed / unchanged and gets before, after and delta columns
+for consumption, tariffs, cost, discount and fines.
+"""
+import sys
+import json
+import numpy as np
+import pandas as pd
+from site_history import load_site_records, ADDITIVE_FIELDS
+
+DIFF_FIELDS = [
+    'peak_consumption', 'offpeak_consumption', 'total_consumption',
+    'tou_tariff_peak', 'tou_tariff_offpeak',
+    'total_cost', 'total_discount', 'power_factor_fine',
+    'kva_cost', 'distribution_cost', 'supply_cost',
+]
+ATTRIBUTE_FIELDS = ['site_name', 'tariff_type', 'site_key']
+
+# Deltas smaller than this (kWh / agorot / ILS) count as unchanged
+CHANGE_TOLERANCE = 0.005
+DEFAULT_SORT = 'total_cost_delta'
+MISSING_TEXT = ['', 'nan', 'NaN', 'None', 'none', 'null', 'NULL', 'n/a', 'N/A']
+
+
+def normalize_meter_numbers(values):
+    """Vectorized site_dimension.normalize_number for a Series of meter numbers."""
+    text = values.astype(str).str.replace(r'^[\s\'"-]*0*|[\s\'"-]+|\.0$', '', regex=True)
+    return text.mask(text.isin(MISSING_TEXT))
+
+
+def _period_frame(df, period):
+    """One row per normalized meter for a period (additive fields summed, the rest last)."""
+    df = df[df['billing_period'] == period]
+    if df.empty:
+        raise ValueError(f"No site records for billing period {period}")
+
+    df = df.assign(meter=normalize_meter_numbers(df['meter_number'])).dropna(subset=['meter'])
+    fields = [f for f in DIFF_FIELDS if f in df.columns]
+    attributes = [f for f in ATTRIBUTE_FIELDS if f in df.columns]
+    numeric = df[fields].apply(pd.to_numeric, errors='coerce')
+
+    # Usually one record per meter - only group when a meter has several documents
+    if df['meter'].is_unique:
+        return numeric.join(df[attributes]).set_index(df['meter'])
+    grouped = numeric.groupby(df['meter'])
+    aggregated = grouped.agg({f: 'sum' if f in ADDITIVE_FIELDS else 'last' for f in fields})
+    return aggregated.join(df.groupby('meter')[attributes].last())
+
+
+def diff_periods(records, before, after, tolerance=CHANGE_TOLERANCE):
+    """
+    Per-site diff of period `after` against period `before`.
+    records is a list of site records or a DataFrame of them.
+    Returns a DataFrame indexed by normalized meter number with status,
+    <field>_before / <field>_after / <field>_delta and total_cost_delta_pct.
+    """
+    df = records if isinstance(records, pd.DataFrame) else pd.DataFrame.from_records(records)
+    old = _period_frame(df, before)
+    new = _period_frame(df, after)
+    merged = old.join(new, how='outer', lsuffix='_before', rsuffix='_after')
+
+    in_old = merged.index.isin(old.index)
+    in_new = merged.index.isin(new.index)
+
+    result = pd.DataFrame(index=merged.index)
+    result.index.name = 'meter_number'
+    for attribute in ATTRIBUTE_FIELDS:
+        if f'{attribute}_after' in merged:
+            result[attribute] = merged[f'{attribute}_after'].fillna(merged[f'{attribute}_before'])
+
+    changed = np.zeros(len(merged), dtype=bool)
+    for field in DIFF_FIELDS:
+        if f'{field}_before' not in merged:
+            continue
+        before_values = merged[f'{field}_before']
+        after_values = merged[f'{field}_after']
+        delta = after_values.fillna(0.0) - before_values.fillna(0.0)
+        result[f'{field}_before'] = before_values
+        result[f'{field}_after'] = after_values
+        result[f'{field}_delta'] = delta
+        changed |= (delta.abs() > tolerance).to_numpy()
+
+    result['total_cost_delta_pct'] = (result['total_cost_delta'] / result['total_cost_before'].where(
+        result['total_cost_before'].abs() > tolerance) * 100)
+    result.insert(0, 'status', np.select([~in_old, ~in_new, changed], ['new', 'removed', 'changed'], 'unchanged'))
+    return result
+
+
+def summarize_diff(diff):
+    counts = diff['status'].value_counts()
+    return {
+        'site_count': len(diff),
+        'status_counts': {status: int(counts.get(status, 0)) for status in ('new', 'removed', 'changed', 'unchanged')},
+        'total_cost_before': float(diff['total_cost_before'].sum()),
+        'total_cost_after': float(diff['total_cost_after'].sum()),
+        'total_cost_delta': float(diff['total_cost_delta'].sum()),
+        'total_consumption_delta': float(diff['total_consumption_delta'].sum()),
+    }
+
+
+def sorted_diff(diff, sort=DEFAULT_SORT, status=None, limit=None):
+    """Rows ordered by |sort column| descending, optionally filtered by status."""
+    if status:
+        diff = diff[diff['status'].isin(status if isinstance(status, (list, tuple)) else [status])]
+    order = diff[sort].abs().sort_values(ascending=False, na_position='last').index
+    diff = diff.loc[order]
+    return diff if limit is None else diff.head(limit)
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    options = {}
+    for flag in ('--from', '--to', '--sort', '--status', '--limit', '--output'):
+        if flag in args:
+            i = args.index(flag)
+            options[flag] = args[i + 1]
+            del args[i:i + 2]
+
+    if not args or '--from' not in options or '--to' not in options:
+        print(json.dumps({'success': False, 'error': 'Usage: python period_diff.py <history_json_or_dir>... --from YYYY-MM --to YYYY-MM '
+                                                     '[--sort COLUMN] [--status new,removed,changed] [--limit N] [--output diff.tsv]'}))
+        sys.exit(1)
+
+    try:
+        diff = diff_periods(load_site_records(args), options['--from'], options['--to'])
+        rows = sorted_diff(diff, options.get('--sort', DEFAULT_SORT),
+                           options['--status'].split(',') if '--status' in options else None)
+        if '--output' in options:
+            rows.to_csv(options['--output'], sep='\t', encoding='utf-8-sig')
+        limited = rows.head(int(options.get('--limit', 100)))
+        print(json.dumps({
+            'success': True,
+            'from': options['--from'],
+            'to': options['--to'],
+            **summarize_diff(diff),
+            'columns': ['meter_number'] + list(limited.columns),
+            'rows': json.loads(limited.reset_index().to_json(orient='values', force_ascii=False)),
+        }, ensure_ascii=False))
+    except Exception as e:
+        print(json.dumps({'success': False, 'error': str(e)}))
+        sys.exit(1)
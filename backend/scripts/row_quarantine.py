@@ -0,0 +1,122 @@
+"""
+BillFlow Row Quarantine
+Vectorized validation of the cleaned billing rows before invoice-line generation.
+Every check runs once over whole columns and marks the rows the converter could
+not process; those rows are set aside with reason codes instead of aborting the
+file, and the rest of the file is converted as usual.
+
+Rejects are written as a CSV with the input columns plus source_row (line number
+in the original CSV) and reject_reasons, so they can be fixed in Excel and fed
+back with billflow_converter.py --merge-into to be appended to the existing outputs.
+"""
+import numpy as np
+import pandas as pd
+
+REJECT_REASONS = {
+    'BAD_DOCUMENT_NUMBER': 'Document number is not a number',
+    'BAD_FROM_DATE': "'From' is not a date",
+    'BAD_TO_DATE': "'To' is not a date",
+    'BAD_METER_NUMBER': 'Meter IEC long number is not a number',
+    'BAD_CONTRACT_NUMBER': 'Contract number is not a number',
+    'BAD_AMOUNT': 'An amount or consumption column is not a number',
+}
+
+# Columns used in arithmetic during line generation (optional ones only when present)
+AMOUNT_COLUMNS = ['Total cost', 'Energy cost peak by TOU tariff', 'Energy cost off-peak by TOU tariff',
+                  'Total discount peak (ILS)', 'Total discount off-peak (ILS)',
+                  'Distribution', 'Supply', 'KVA cost', 'Peak consumption', 'Off-peak consumption',
+                  'Power factor fine', 'Various charges', 'Various credits']
+
+SOURCE_ROW_COLUMN = 'source_row'
+REASONS_COLUMN = 'reject_reasons'
+# CSV line of DataFrame index 0 (line 1 is the header)
+FIRST_DATA_LINE = 2
+
+
+def _as_number(values, thousands=True):
+    """float() over a column, ignoring quotes (and thousands commas, as clean_billing_frame does); NaN if not a number."""
+    if values.dtype != object:
+        return values.astype(float)
+    text = values.astype(str).str.strip().str.strip("'")
+    if thousands:
+        text = text.str.replace(',', '')
+    return pd.to_numeric(text, errors='coerce')
+
+
+def _is_date(values):
+    """Whether each value parses as dd/mm/yyyy, mm/dd/yyyy or any format pandas recognizes."""
+    text = values.astype(str).str.strip()
+    valid = pd.to_datetime(text, format='%d/%m/%Y', errors='coerce').notna().to_numpy()
+    valid |= pd.to_datetime(text, format='%m/%d/%Y', errors='coerce').notna().to_numpy()
+    if not valid.all():
+        valid[~valid] = pd.to_datetime(text[~valid], format='mixed', errors='coerce').notna().to_numpy()
+    return pd.Series(valid, index=values.index)
+
+
+def validate_rows(df):
+    """Boolean DataFrame (rows x reason codes) - True where the row fails that check."""
+    checks = pd.DataFrame(False, index=df.index, columns=list(REJECT_REASONS))
+
+    # Identifiers go through int(float(...)) in the converter, which takes no commas
+    checks['BAD_DOCUMENT_NUMBER'] = ~np.isfinite(_as_number(df['Document number'], thousands=False))
+    checks['BAD_FROM_DATE'] = ~_is_date(df['From'])
+    checks['BAD_TO_DATE'] = ~_is_date(df['To'])
+    checks['BAD_METER_NUMBER'] = ~np.isfinite(_as_number(df['Meter IEC long number'], thousands=False))
+
+    if 'Contract number' in df.columns:
+        contract = df['Contract number']
+        # Empty and zero contracts are allowed (no contract); anything else must be a number
+        text = contract.astype(str).str.strip().str.strip("'")
+        empty = contract.isin(['', 0]) | (text == '0')
+        checks['BAD_CONTRACT_NUMBER'] = ~empty & ~np.isfinite(_as_number(contract, thousands=False))
+
+    bad_amount = pd.Series(False, index=df.index)
+    for column in AMOUNT_COLUMNS:
+        if column in df.columns and df[column].dtype == object:
+            text = df[column].astype(str).str.strip()
+            bad_amount |= _as_number(df[column]).isna() & df[column].notna() & ~text.isin(['', 'nan'])
+    checks['BAD_AMOUNT'] = bad_amount
+    return checks
+
+
+def quarantine_rows(df):
+    """
+    Split cleaned rows into (accepted, rejects). Accepted rows get float amount
+    columns (missing amounts count as 0, like clean_billing_frame); rejects keep
+    their values plus source_row and reject_reasons ('BAD_FROM_DATE;BAD_AMOUNT').
+    """
+    checks = validate_rows(df)
+    bad = checks.any(axis=1).to_numpy()
+
+    accepted = df[~bad].copy()
+    if accepted['Document number'].dtype == object:
+        accepted['Document number'] = _as_number(accepted['Document number'], thousands=False)
+    for column in AMOUNT_COLUMNS:
+        if column in accepted.columns and accepted[column].dtype == object:
+            accepted[column] = _as_number(accepted[column].replace('nan', '0')).fillna(0.0)
+
+    rejects = df[bad].copy()
+    codes = checks[bad]
+    rejects[REASONS_COLUMN] = [';'.join(codes.columns[row]) for row in codes.to_numpy()]
+    if SOURCE_ROW_COLUMN not in rejects.columns:
+        rejects.insert(0, SOURCE_ROW_COLUMN, rejects.index + FIRST_DATA_LINE)
+    return accepted, rejects
+
+
+def drop_reject_columns(df):
+    """A fixed rejects file back to plain billing rows."""
+    return df.drop(columns=[c for c in (SOURCE_ROW_COLUMN, REASONS_COLUMN) if c in df.columns])
+
+
+def reject_counts(rejects):
+    """Number of rejected rows per reason code."""
+    counts = {}
+    for reasons in rejects[REASONS_COLUMN]:
+        for code in reasons.split(';'):
+            counts[code] = counts.get(code, 0) + 1
+    return counts
+
+
+def write_rejects(rejects, path):
+    rejects.to_csv(path, index=False, encoding='utf-8-sig')
+    return path
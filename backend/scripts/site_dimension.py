@@ -0,0 +1,194 @@
+"""
+BillFlow Site Dimension
+Assigns stable integer surrogate keys (site_key) to sites across billing periods.
+
+The utility renames sites from time to time and Site ID is usually empty, so a
+site is identified by, in order:
+    1. normalized meter number
+    2. normalized contract number (when it points at exactly one site)
+    3. normalized Hebrew site name (when it points at exactly one site)
+A record that matches nothing gets a new key. Every identifier seen for a site
+is added to the index, so a renamed site or a replaced meter keeps its key.
+
+The index is a JSON file of hash maps {normalized identifier: site_key}.
+"""
+import os
+import re
+import sys
+import json
+import unicodedata
+from datetime import datetime
+
+INDEX_VERSION = 1
+MISSING_VALUES = {'', 'nan', 'none', 'null', 'n/a'}
+
+# Niqqud / cantillation marks, geresh and gershayim (both the Hebrew and ASCII forms)
+_HEBREW_MARKS = re.compile('[֑-ׇ׳״\'"`’”]')
+_NON_WORD = re.compile(r'[^\w]+')
+_FINAL_LETTERS = str.maketrans('ךםןףץ', 'כמנפצ')
+
+
+def normalize_number(value):
+    """Meter / contract numbers: no quote prefix, no '.0' float suffix, no leading zeros."""
+    if value is None:
+        return None
+    text = str(value).strip().strip("'\"").strip()
+    if text.lower() in MISSING_VALUES:
+        return None
+    if text.endswith('.0'):
+        text = text[:-2]
+    text = text.replace(' ', '').replace('-', '').lstrip('0')
+    return text or None
+
+
+def normalize_site_name(name):
+    """
+    Hebrew site names: NFKC, without niqqud/geresh/punctuation, final letters
+    folded to their regular forms, whitespace collapsed and Latin lowercased.
+    """
+    if name is None:
+        return None
+    text = unicodedata.normalize('NFKC', str(name))
+    if text.strip().lower() in MISSING_VALUES:
+        return None
+    text = _HEBREW_MARKS.sub('', text).translate(_FINAL_LETTERS).lower()
+    text = _NON_WORD.sub(' ', text).strip()
+    return text or None
+
+
+def new_site_index():
+    return {'version': INDEX_VERSION, 'next_key': 1, 'sites': {},
+            'by_meter': {}, 'by_contract': {}, 'by_name': {}}
+
+
+def load_site_index(path):
+    """Load the site index (an empty index if the file does not exist yet)."""
+    if not os.path.exists(path):
+        return new_site_index()
+    with open(path, encoding='utf-8') as f:
+        index = json.load(f)
+    if index.get('version') != INDEX_VERSION:
+        raise ValueError(f"Unsupported site index version: {index.get('version')}")
+    return index
+
+
+def save_site_index(index, path):
+    """Write the index atomically."""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(index, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def _link(index, table, identifier, site_key):
+    """
+    Point identifier at site_key. Contract numbers and names can be shared by
+    several sites - those are marked ambiguous (0) and no longer used for matching.
+    """
+    if identifier is None:
+        return
+    current = index[table].get(identifier)
+    if current is None:
+        index[table][identifier] = site_key
+    elif current != site_key and table != 'by_meter':
+        index[table][identifier] = 0
+
+
+def _match(index, meter, contract, name, taken):
+    """Return (site_key, matched_by) or (None, None)."""
+    for table, identifier in (('by_meter', meter), ('by_contract', contract), ('by_name', name)):
+        if identifier is None:
+            continue
+        site_key = index[table].get(identifier)
+        # Two records in one batch are two sites - never fold them together on a weak match
+        if site_key and (table == 'by_meter' or site_key not in taken):
+            return site_key, table[3:]
+    return None, None
+
+
+def assign_site_keys(index, records):
+    """
+    Add 'site_key' to every site record (in place) and update the index.
+    Records are treated as one batch - typically one billing period.
+    Returns match statistics.
+    """
+    stats = {'meter': 0, 'contract': 0, 'name': 0, 'new': 0}
+    taken = set()
+    period = max((r.get('billing_period') or '' for r in records), default='') or None
+
+    for record in records:
+        meter = normalize_number(record.get('meter_number'))
+        contract = normalize_number(record.get('contract_number'))
+        name = normalize_site_name(record.get('site_name'))
+
+        site_key, matched_by = _match(index, meter, contract, name, taken)
+        if site_key is None:
+            site_key = index['next_key']
+            index['next_key'] += 1
+            index['sites'][str(site_key)] = {'first_period': record.get('billing_period')}
+            matched_by = 'new'
+        stats[matched_by] += 1
+        taken.add(site_key)
+
+        _link(index, 'by_meter', meter, site_key)
+        _link(index, 'by_contract', contract, site_key)
+        _link(index, 'by_name', name, site_key)
+
+        # Latest attributes win - the dimension shows the current name and meter
+        site = index['sites'][str(site_key)]
+        site.update({
+            'site_name': record.get('site_name'),
+            'meter_number': meter,
+            'contract_number': contract,
+            'last_period': record.get('billing_period') or site.get('last_period'),
+        })
+        record['site_key'] = site_key
+
+    index['updated_at'] = datetime.now().isoformat(timespec='seconds')
+    stats['site_count'] = len(index['sites'])
+    stats['billing_period'] = period
+    return stats
+
+
+def assign_history_keys(index, records):
+    """Assign keys to records from several periods, oldest period first."""
+    by_period = {}
+    for record in records:
+        by_period.setdefault(record.get('billing_period'), []).append(record)
+    return {period: assign_site_keys(index, by_period[period])
+            for period in sorted(by_period, key=lambda p: p or '')}
+
+
+def site_dimension_frame(index):
+    """The site dimension as a DataFrame indexed by site_key."""
+    import pandas as pd
+
+    frame = pd.DataFrame.from_dict(index['sites'], orient='index')
+    frame.index = frame.index.astype(int)
+    frame.index.name = 'site_key'
+    return frame.sort_index()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3 or sys.argv[1] not in ('assign', 'stats'):
+        print(json.dumps({'success': False, 'error': 'Usage: python site_dimension.py assign <index.json> <history_json_or_dir>... | stats <index.json>'}))
+        sys.exit(1)
+
+    command, index_path = sys.argv[1], sys.argv[2]
+    try:
+        index = load_site_index(index_path)
+        if command == 'stats':
+            print(json.dumps({'success': True, 'site_count': len(index['sites']),
+                              'meters': len(index['by_meter']), 'contracts': len(index['by_contract']),
+                              'names': len(index['by_name'])}))
+        else:
+            from site_history import load_site_records
+
+            periods = assign_history_keys(index, load_site_records(sys.argv[3:]))
+            save_site_index(index, index_path)
+            print(json.dumps({'success': True, 'site_count': len(index['sites']), 'periods': periods},
+                             ensure_ascii=False))
+    except Exception as e:
+        print(json.dumps({'success': False, 'error': str(e)}))
+        sys.exit(1)
@@ -0,0 +1,189 @@
+"""
+BillFlow Site Forecasting
+Forecasts consumption and cost per site for the coming months from the
+site-record history.
+
+Every site gets the same seasonal model
+    y = level + trend * month_index + season effect (Summer / Winter / Spring/Fall)
+fitted by weighted least squares, where the weights mask the months a site has
+no record. All sites are solved at once: the normal equations are built as one
+(sites, p, p) stack and solved with a single batched np.linalg.solve.
+A small ridge on the trend and season terms keeps sites with only a few
+months of history close to their own average.
+
+Forecasts are cached by history fingerprint, so converting a new month (which
+changes the history) invalidates them; stale cache entries are pruned on write.
+"""
+import os
+import sys
+import json
+import glob
+import hashlib
+import numpy as np
+from site_history import load_site_records, build_site_matrix, history_fingerprint
+
+FORECAST_FIELDS = ['total_consumption', 'total_cost']
+DEFAULT_HORIZON = 12
+RIDGE = 1.0
+# A site with no record in the last ACTIVE_PERIODS converted months is treated as
+# closed (e.g. a replaced meter) and forecast at zero
+ACTIVE_PERIODS = 3
+
+# Israel Electric TOU seasons, used for future months the history has not covered yet
+DEFAULT_SEASONS = {1: 'Winter', 2: 'Winter', 12: 'Winter',
+                   6: 'Summer', 7: 'Summer', 8: 'Summer', 9: 'Summer'}
+DEFAULT_SEASON = 'Spring/Fall'
+
+
+def _month_index(period):
+    year, month = period.split('-')
+    return int(year) * 12 + int(month) - 1
+
+
+def _period_name(month_index):
+    return f'{month_index // 12:04d}-{month_index % 12 + 1:02d}'
+
+
+def season_calendar(records):
+    """Calendar month -> season as billed in the history (most common value wins)."""
+    counts = {}
+    for record in records:
+        season = record.get('season')
+        if not season or season == 'nan' or not record.get('billing_month'):
+            continue
+        month = int(record['billing_month'])
+        counts.setdefault(month, {}).setdefault(season, 0)
+        counts[month][season] += 1
+    calendar = {month: DEFAULT_SEASONS.get(month, DEFAULT_SEASON) for month in range(1, 13)}
+    calendar.update({month: max(seasons, key=seasons.get) for month, seasons in counts.items()})
+    return calendar
+
+
+def _design(month_indexes, calendar, seasons, origin):
+    """Design matrix (months, 2 + len(seasons) - 1): level, trend, season dummies."""
+    month_indexes = np.asarray(month_indexes)
+    columns = [np.ones(len(month_indexes)), (month_indexes - origin) / 12.0]
+    month_seasons = [calendar[m % 12 + 1] for m in month_indexes]
+    # First season is the reference level
+    for season in seasons[1:]:
+        columns.append(np.array([s == season for s in month_seasons], dtype=float))
+    return np.column_stack(columns)
+
+
+def fit_forecast(values, periods, calendar, horizon=DEFAULT_HORIZON, ridge=RIDGE):
+    """
+    Fit all sites at once and forecast the next `horizon` months.
+    values is (sites, months) with NaN where a site has no record.
+    Returns (forecast (sites, horizon), future periods, rmse per site).
+    """
+    months = np.array([_month_index(p) for p in periods])
+    future = np.arange(months[-1] + 1, months[-1] + 1 + horizon)
+    seasons = sorted(set(calendar.values()))
+    X = _design(months, calendar, seasons, months[0])
+    X_future = _design(future, calendar, seasons, months[0])
+
+    observed = ~np.isnan(values)
+    w = observed.astype(float)
+    y = np.where(observed, values, 0.0)
+
+    # Per-site normal equations X^T W X b = X^T W y, solved as one batch
+    xtwx = np.einsum('mp,sm,mq->spq', X, w, X)
+    xtwy = np.einsum('mp,sm->sp', X, w * y)
+    penalty = np.full(X.shape[1], ridge)
+    penalty[0] = 1e-9  # the level is never shrunk
+    xtwx += np.diag(penalty)[None, :, :]
+    coefs = np.linalg.solve(xtwx, xtwy[:, :, None])[:, :, 0]
+
+    counts = w.sum(axis=1)
+    fitted = coefs @ X.T
+    residuals = np.where(observed, values - fitted, 0.0)
+    rmse = np.sqrt(np.divide((residuals ** 2).sum(axis=1), counts, out=np.zeros_like(counts), where=counts > 0))
+
+    forecast = np.clip(coefs @ X_future.T, 0.0, None)
+    forecast[counts == 0] = 0.0
+    return forecast, [_period_name(m) for m in future], rmse
+
+
+def _cache_key(fingerprint, horizon, fields, key):
+    params = json.dumps({'horizon': horizon, 'fields': fields, 'key': key, 'ridge': RIDGE}, sort_keys=True)
+    return f"{fingerprint[:16]}_{hashlib.sha256(params.encode('utf-8')).hexdigest()[:12]}"
+
+
+def forecast_sites(records, horizon=DEFAULT_HORIZON, fields=None, key='meter_number', cache_dir=None):
+    """
+    Forecast every site for the next `horizon` months.
+    Returns {periods, totals {field: [...]}, sites [{key, site_name, field: [...], field_rmse}], cached}.
+    """
+    fields = fields or FORECAST_FIELDS
+    matrix = build_site_matrix(records, fields, key=key)
+    fingerprint = history_fingerprint(matrix)
+    cache_key = _cache_key(fingerprint, horizon, fields, key)
+    cache_path = os.path.join(cache_dir, f'forecast_{cache_key}.json') if cache_dir else None
+
+    if cache_path and os.path.exists(cache_path):
+        with open(cache_path, encoding='utf-8') as f:
+            return {**json.load(f), 'cached': True}
+
+    calendar = season_calendar(records)
+    site_names = matrix['attributes']['site_name'].tolist() if 'site_name' in matrix['attributes'] else None
+    result = {'history_periods': matrix['periods'], 'periods': None, 'totals': {},
+              'sites': [{key: s.item() if hasattr(s, 'item') else s} for s in matrix['sites']]}
+    if site_names:
+        for site, name in zip(result['sites'], site_names):
+            site['site_name'] = name
+
+    recent = next(iter(matrix['values'].values()))[:, -ACTIVE_PERIODS:]
+    active = (~np.isnan(recent)).any(axis=1)
+    for site, is_active in zip(result['sites'], active):
+        site['active'] = bool(is_active)
+
+    for field in fields:
+        forecast, periods, rmse = fit_forecast(matrix['values'][field], matrix['periods'], calendar, horizon)
+        forecast[~active] = 0.0
+        result['periods'] = periods
+        result['totals'][field] = [float(v) for v in forecast.sum(axis=0)]
+        for site, values, error in zip(result['sites'], forecast, rmse):
+            site[field] = [round(float(v), 2) for v in values]
+            site[f'{field}_rmse'] = round(float(error), 2)
+
+    result['seasons'] = [calendar[_month_index(p) % 12 + 1] for p in result['periods']]
+    result['site_count'] = len(result['sites'])
+    result['active_site_count'] = int(active.sum())
+    result['fingerprint'] = fingerprint
+
+    if cache_path:
+        os.makedirs(cache_dir, exist_ok=True)
+        # Entries for an older history can never be hit again
+        for stale in glob.glob(os.path.join(cache_dir, 'forecast_*.json')):
+            if not os.path.basename(stale).startswith(f'forecast_{fingerprint[:16]}_'):
+                os.remove(stale)
+        tmp_path = cache_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False)
+        os.replace(tmp_path, cache_path)
+
+    return {**result, 'cached': False}
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print(json.dumps({'success': False, 'error': 'Usage: python site_forecast.py <history_json_or_dir>... [--horizon N] [--key meter_number|site_key] [--cache-dir DIR]'}))
+        sys.exit(1)
+
+    args = sys.argv[1:]
+    options = {}
+    for flag in ('--horizon', '--key', '--cache-dir'):
+        if flag in args:
+            i = args.index(flag)
+            options[flag] = args[i + 1]
+            del args[i:i + 2]
+
+    try:
+        result = forecast_sites(load_site_records(args),
+                                horizon=int(options.get('--horizon', DEFAULT_HORIZON)),
+                                key=options.get('--key', 'meter_number'),
+                                cache_dir=options.get('--cache-dir'))
+        print(json.dumps({'success': True, **result}, ensure_ascii=False))
+    except Exception as e:
+        print(json.dumps({'success': False, 'error': str(e)}))
+        sys.exit(1)
@@ -0,0 +1,129 @@
+"""
+BillFlow Site History
+Loads the site-level records produced by extract_site_records() and lays them out
+as sites x months matrices for the vectorized analytics modules.
+"""
+import os
+import glob
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+
+# Fields that add up when a meter has more than one document in a period
+ADDITIVE_FIELDS = {
+    'peak_consumption', 'offpeak_consumption', 'total_consumption',
+    'kva_cost', 'distribution_cost', 'supply_cost',
+    'consumption_cost_peak', 'consumption_cost_offpeak',
+    'total_cost', 'total_cost_vat', 'total_cost_without_discount',
+    'total_discount', 'discount_peak', 'discount_offpeak',
+    'power_factor_fine',
+}
+
+
+def _expand_paths(paths):
+    """Expand files, directories (*.json inside) and glob patterns into a sorted file list."""
+    if isinstance(paths, str):
+        paths = [paths]
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(glob.glob(os.path.join(path, '*.json')))
+        elif any(ch in path for ch in '*?['):
+            files.extend(glob.glob(path))
+        else:
+            files.append(path)
+    return sorted(set(files))
+
+
+def load_site_records(paths):
+    """
+    Load site records from converter result JSON files (with 'site_records')
+    or from plain JSON lists of records.
+    """
+    records = []
+    for path in _expand_paths(paths):
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+        if isinstance(data, dict):
+            records.extend(data.get('site_records', []))
+        else:
+            records.extend(data)
+    return records
+
+
+def save_period_records(history_dir, billing_period, records):
+    """
+    Store one converted period's site records as <history_dir>/site_records_<period>.json.
+    Re-converting a period replaces its file, so the directory always holds one
+    record set per period and can be passed straight to load_site_records().
+    """
+    os.makedirs(history_dir, exist_ok=True)
+    path = os.path.join(history_dir, f'site_records_{billing_period}.json')
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(records, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+    return path
+
+
+def append_period_records(history_dir, billing_period, records):
+    """Add records converted after the period's main conversion to its stored file."""
+    path = os.path.join(history_dir, f'site_records_{billing_period}.json')
+    existing = load_site_records(path) if os.path.exists(path) else []
+    return save_period_records(history_dir, billing_period, existing + list(records))
+
+
+def build_site_matrix(records, fields, key='meter_number'):
+    """
+    Pivot site records into sites x months arrays.
+
+    Returns a dict with:
+        sites      - array of site keys (rows)
+        periods    - list of billing periods 'YYYY-MM' (columns, ascending)
+        values     - {field: float array (sites, periods)}, NaN where a site has no record
+        attributes - DataFrame indexed by site key with the latest site_name / tariff_type
+    Additive fields are summed when a site has several documents in one period;
+    rates and percentages keep the last value. With key='site_key' (see
+    site_dimension.py) the sites are small integers instead of strings.
+    """
+    df = pd.DataFrame.from_records(records)
+    if df.empty:
+        raise ValueError("No site records to build a history matrix from")
+
+    if key not in df.columns:
+        raise ValueError(f"Site records have no '{key}' field")
+    df[key] = df[key].astype('int64') if key == 'site_key' else df[key].astype(str)
+    df = df.sort_values('billing_period', kind='stable')
+    sites = np.array(sorted(df[key].unique()))
+    periods = sorted(df['billing_period'].unique())
+
+    values = {}
+    for field in fields:
+        numeric = pd.to_numeric(df[field], errors='coerce')
+        grouped = numeric.groupby([df[key], df['billing_period']])
+        series = grouped.sum(min_count=1) if field in ADDITIVE_FIELDS else grouped.last()
+        matrix = series.unstack('billing_period').reindex(index=sites, columns=periods)
+        values[field] = matrix.to_numpy(dtype=float)
+
+    attribute_columns = [c for c in ('site_name', 'tariff_type', 'season') if c in df.columns]
+    attributes = df.groupby(key)[attribute_columns].last().reindex(sites)
+
+    return {
+        'key': key,
+        'sites': sites,
+        'periods': periods,
+        'values': values,
+        'attributes': attributes,
+    }
+
+
+def history_fingerprint(matrix):
+    """Content hash of a site matrix - changes whenever a period or value changes."""
+    digest = hashlib.sha256()
+    digest.update(json.dumps([matrix['key'], list(matrix['periods'])]).encode('utf-8'))
+    digest.update('\0'.join(map(str, matrix['sites'])).encode('utf-8'))
+    for field in sorted(matrix['values']):
+        digest.update(field.encode('utf-8'))
+        digest.update(np.ascontiguousarray(matrix['values'][field]).tobytes())
+    return digest.hexdigest()
@@ -0,0 +1,387 @@
+"""
+BillFlow Site Sketches
+Small mergeable summaries of each converted period's site records, so dashboard
+statistics over any range of months are answered by merging a few fixed-size
+sketches instead of scanning every site record.
+
+Per period (<sketch_dir>/sketches_<period>.json):
+    distinct meters    - HyperLogLog, 2^HLL_PRECISION registers, merged by
+                         element-wise max; standard error 1.04 / sqrt(registers)
+    quantiles          - cost per kWh and consumption in log-spaced buckets
+                         (DDSketch); merged by adding counts; every quantile is
+                         within QUANTILE_ACCURACY relative error
+    top consumers      - weighted Misra-Gries heavy hitters by total cost and by
+                         consumption, HEAVY_HITTER_CAPACITY counters; merged by
+                         summing and reducing again; every estimate is at most
+                         max_error below the true total
+    totals             - exact record count, cost and consumption
+Merging is associative, so a range query costs the same whatever the number of
+site records behind it.
+"""
+import os
+import re
+import sys
+import glob
+import json
+import math
+import base64
+import hashlib
+import numpy as np
+from site_dimension import normalize_number
+
+SKETCH_VERSION = 1
+HLL_PRECISION = 14
+QUANTILE_ACCURACY = 0.01
+HEAVY_HITTER_CAPACITY = 200
+DEFAULT_QUANTILES = [0.1, 0.25, 0.5, 0.75, 0.9, 0.95, 0.99]
+DEFAULT_TOP = 10
+
+# Bucketed range of the quantile sketches; smaller magnitudes count as zero, larger ones are clamped
+QUANTILE_MIN_VALUE = 1e-4
+QUANTILE_MAX_VALUE = 1e10
+_GAMMA = (1 + QUANTILE_ACCURACY) / (1 - QUANTILE_ACCURACY)
+_LOG_GAMMA = math.log(_GAMMA)
+_MIN_INDEX = math.ceil(math.log(QUANTILE_MIN_VALUE) / _LOG_GAMMA)
+_MAX_INDEX = math.ceil(math.log(QUANTILE_MAX_VALUE) / _LOG_GAMMA)
+
+QUANTILE_METRICS = ['cost_per_kwh', 'consumption']
+HEAVY_HITTER_METRICS = ['total_cost', 'total_consumption']
+SKETCH_FILE_PATTERN = re.compile(r'^sketches_(\d{4}-\d{2})\.json$')
+
+
+# HyperLogLog
+
+def hash64(values):
+    """Stable 64-bit hashes of strings (independent of PYTHONHASHSEED)."""
+    return np.fromiter((int.from_bytes(hashlib.blake2b(v.encode('utf-8'), digest_size=8).digest(), 'little')
+                        for v in values), dtype=np.uint64, count=len(values))
+
+
+def hll_new(precision=HLL_PRECISION):
+    return np.zeros(1 << precision, dtype=np.uint8)
+
+
+def hll_add(registers, hashes):
+    """Add 64-bit hashes to the registers in place."""
+    precision = int(len(registers)).bit_length() - 1
+    hashes = np.asarray(hashes, dtype=np.uint64)
+    index = (hashes >> np.uint64(64 - precision)).astype(np.int64)
+    rest = hashes & np.uint64((1 << (64 - precision)) - 1)
+    with np.errstate(divide='ignore'):
+        bit_length = np.where(rest > 0, np.floor(np.log2(rest.astype(float))) + 1, 0)
+    rank = (64 - precision - bit_length + 1).astype(np.uint8)
+    np.maximum.at(registers, index, rank)
+    return registers
+
+
+def hll_estimate(registers):
+    """Cardinality estimate with the small-range (linear counting) correction."""
+    m = len(registers)
+    alpha = 0.7213 / (1 + 1.079 / m)
+    estimate = alpha * m * m / np.sum(np.ldexp(1.0, -registers.astype(int)))
+    zeros = int(np.count_nonzero(registers == 0))
+    if estimate <= 2.5 * m and zeros:
+        estimate = m * math.log(m / zeros)
+    return estimate
+
+
+# Quantiles
+
+def quantile_new():
+    size = _MAX_INDEX - _MIN_INDEX + 1
+    return {'positive': np.zeros(size, dtype=np.int64), 'negative': np.zeros(size, dtype=np.int64),
+            'zero': 0, 'count': 0, 'min': math.inf, 'max': -math.inf}
+
+
+def quantile_add(sketch, values):
+    """Add finite values to a quantile sketch in place."""
+    values = np.asarray(values, dtype=float)
+    values = values[np.isfinite(values)]
+    if not len(values):
+        return sketch
+    magnitude = np.abs(values)
+    bucketed = magnitude >= QUANTILE_MIN_VALUE
+    index = np.clip(np.ceil(np.log(magnitude[bucketed]) / _LOG_GAMMA).astype(np.int64), _MIN_INDEX, _MAX_INDEX)
+    positive = values[bucketed] > 0
+    sketch['positive'] += np.bincount(index[positive] - _MIN_INDEX, minlength=len(sketch['positive']))
+    sketch['negative'] += np.bincount(index[~positive] - _MIN_INDEX, minlength=len(sketch['negative']))
+    sketch['zero'] += int((~bucketed).sum())
+    sketch['count'] += len(values)
+    sketch['min'] = min(sketch['min'], float(values.min()))
+    sketch['max'] = max(sketch['max'], float(values.max()))
+    return sketch
+
+
+def quantile_merge(target, other):
+    for store in ('positive', 'negative'):
+        target[store] += other[store]
+    target['zero'] += other['zero']
+    target['count'] += other['count']
+    target['min'] = min(target['min'], other['min'])
+    target['max'] = max(target['max'], other['max'])
+    return target
+
+
+def quantile_values(sketch, quantiles):
+    """Approximate values at the given quantiles (None for an empty sketch)."""
+    if sketch['count'] == 0:
+        return [None for _ in quantiles]
+    # Buckets in ascending value order: negatives by descending magnitude, zero, positives
+    indexes = np.arange(_MIN_INDEX, _MAX_INDEX + 1)
+    representative = 2 * np.power(_GAMMA, indexes.astype(float)) / (_GAMMA + 1)
+    counts = np.concatenate([sketch['negative'][::-1], [sketch['zero']], sketch['positive']])
+    values = np.concatenate([-representative[::-1], [0.0], representative])
+    cumulative = np.cumsum(counts)
+
+    result = []
+    for q in quantiles:
+        rank = q * (sketch['count'] - 1)
+        value = float(values[np.searchsorted(cumulative, rank, side='right')])
+        result.append(min(max(value, sketch['min']), sketch['max']))
+    return result
+
+
+# Heavy hitters
+
+def heavy_hitters_new():
+    return {'counters': {}, 'names': {}, 'error': 0.0}
+
+
+def _reduce_heavy_hitters(sketch, capacity):
+    """Misra-Gries reduction: subtract the (capacity+1)-th largest counter from all, keep the positive ones."""
+    counters = sketch['counters']
+    if len(counters) <= capacity:
+        return sketch
+    threshold = sorted(counters.values(), reverse=True)[capacity]
+    sketch['counters'] = {key: value - threshold for key, value in counters.items() if value > threshold}
+    sketch['names'] = {key: sketch['names'].get(key) for key in sketch['counters']}
+    sketch['error'] += threshold
+    return sketch
+
+
+def heavy_hitters_add(sketch, keys, weights, names=None, capacity=HEAVY_HITTER_CAPACITY):
+    """Add non-negative weights per key (keys may repeat) in place."""
+    counters = sketch['counters']
+    for i, (key, weight) in enumerate(zip(keys, weights)):
+        if key and weight > 0:
+            counters[key] = counters.get(key, 0.0) + float(weight)
+            if names is not None and names[i]:
+                sketch['names'][key] = names[i]
+    return _reduce_heavy_hitters(sketch, capacity)
+
+
+def heavy_hitters_merge(target, other, capacity=HEAVY_HITTER_CAPACITY):
+    for key, value in other['counters'].items():
+        target['counters'][key] = target['counters'].get(key, 0.0) + value
+    for key, name in other['names'].items():
+        target['names'].setdefault(key, name)
+    target['error'] += other['error']
+    return _reduce_heavy_hitters(target, capacity)
+
+
+def heavy_hitters_top(sketch, top=DEFAULT_TOP):
+    ranked = sorted(sketch['counters'].items(), key=lambda item: -item[1])[:top]
+    return [{'meter_number': key, 'site_name': sketch['names'].get(key), 'estimate': value,
+             'max_error': sketch['error']} for key, value in ranked]
+
+
+# Period sketches
+
+def new_sketch(precision=HLL_PRECISION):
+    return {
+        'version': SKETCH_VERSION,
+        'periods': [],
+        'totals': {'records': 0, 'total_cost': 0.0, 'total_consumption': 0.0},
+        'distinct_meters': hll_new(precision),
+        'quantiles': {metric: quantile_new() for metric in QUANTILE_METRICS},
+        'heavy_hitters': {metric: heavy_hitters_new() for metric in HEAVY_HITTER_METRICS},
+    }
+
+
+def build_period_sketch(billing_period, records):
+    """Sketch of one period's site records (as produced by extract_site_records)."""
+    sketch = new_sketch()
+    sketch['periods'] = [billing_period]
+    records = [r for r in records if r.get('billing_period', billing_period) == billing_period]
+    meters = [normalize_number(r.get('meter_number')) or '' for r in records]
+    names = [r.get('site_name') for r in records]
+    cost = np.array([r.get('total_cost') or 0.0 for r in records], dtype=float)
+    consumption = np.array([r.get('total_consumption') or 0.0 for r in records], dtype=float)
+
+    known = [m for m in meters if m]
+    hll_add(sketch['distinct_meters'], hash64(sorted(set(known))))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        quantile_add(sketch['quantiles']['cost_per_kwh'], np.where(consumption > 0, cost / consumption, np.nan))
+    quantile_add(sketch['quantiles']['consumption'], consumption)
+    heavy_hitters_add(sketch['heavy_hitters']['total_cost'], meters, cost, names)
+    heavy_hitters_add(sketch['heavy_hitters']['total_consumption'], meters, consumption, names)
+    sketch['totals'] = {'records': len(records), 'total_cost': float(cost.sum()),
+                        'total_consumption': float(consumption.sum())}
+    return sketch
+
+
+def merge_sketches(sketches):
+    """Merge any number of sketches into a new one."""
+    merged = new_sketch()
+    for sketch in sketches:
+        merged['periods'] = sorted(set(merged['periods']) | set(sketch['periods']))
+        for field, value in sketch['totals'].items():
+            merged['totals'][field] += value
+        np.maximum(merged['distinct_meters'], sketch['distinct_meters'], out=merged['distinct_meters'])
+        for metric in QUANTILE_METRICS:
+            quantile_merge(merged['quantiles'][metric], sketch['quantiles'][metric])
+        for metric in HEAVY_HITTER_METRICS:
+            heavy_hitters_merge(merged['heavy_hitters'][metric], sketch['heavy_hitters'][metric])
+    return merged
+
+
+def summarize_sketch(sketch, quantiles=DEFAULT_QUANTILES, top=DEFAULT_TOP):
+    """Dashboard statistics of a (merged) sketch, with their error bounds."""
+    registers = sketch['distinct_meters']
+    return {
+        'periods': sketch['periods'],
+        **sketch['totals'],
+        'avg_cost_per_kwh': (sketch['totals']['total_cost'] / sketch['totals']['total_consumption']
+                             if sketch['totals']['total_consumption'] > 0 else 0.0),
+        'distinct_meters': int(round(hll_estimate(registers))),
+        'distinct_meters_relative_error': 1.04 / math.sqrt(len(registers)),
+        'quantiles': {metric: dict(zip(map(str, quantiles), quantile_values(sketch['quantiles'][metric], quantiles)))
+                      for metric in QUANTILE_METRICS},
+        'quantile_relative_accuracy': QUANTILE_ACCURACY,
+        'top_consumers': {metric: heavy_hitters_top(sketch['heavy_hitters'][metric], top)
+                          for metric in HEAVY_HITTER_METRICS},
+    }
+
+
+# Persistence
+
+def _encode_store(counts):
+    nonzero = np.nonzero(counts)[0]
+    return {'index': (nonzero + _MIN_INDEX).tolist(), 'count': counts[nonzero].tolist()}
+
+
+def _decode_store(data):
+    counts = np.zeros(_MAX_INDEX - _MIN_INDEX + 1, dtype=np.int64)
+    counts[np.asarray(data['index'], dtype=np.int64) - _MIN_INDEX] = data['count']
+    return counts
+
+
+def sketch_to_json(sketch):
+    return {
+        'version': sketch['version'],
+        'periods': sketch['periods'],
+        'totals': sketch['totals'],
+        'distinct_meters': {'precision': int(len(sketch['distinct_meters'])).bit_length() - 1,
+                            'registers': base64.b64encode(sketch['distinct_meters'].tobytes()).decode('ascii')},
+        'quantiles': {metric: {'accuracy': QUANTILE_ACCURACY,
+                               'positive': _encode_store(q['positive']), 'negative': _encode_store(q['negative']),
+                               'zero': q['zero'], 'count': q['count'],
+                               'min': q['min'] if q['count'] else None, 'max': q['max'] if q['count'] else None}
+                      for metric, q in sketch['quantiles'].items()},
+        'heavy_hitters': sketch['heavy_hitters'],
+    }
+
+
+def sketch_from_json(data):
+    if data.get('version') != SKETCH_VERSION:
+        raise ValueError(f"Unsupported sketch version: {data.get('version')}")
+    quantiles = {}
+    for metric, q in data['quantiles'].items():
+        if q['accuracy'] != QUANTILE_ACCURACY:
+            raise ValueError(f"Sketch accuracy {q['accuracy']} does not match {QUANTILE_ACCURACY}")
+        quantiles[metric] = {'positive': _decode_store(q['positive']), 'negative': _decode_store(q['negative']),
+                             'zero': q['zero'], 'count': q['count'],
+                             'min': math.inf if q['min'] is None else q['min'],
+                             'max': -math.inf if q['max'] is None else q['max']}
+    return {
+        'version': data['version'],
+        'periods': data['periods'],
+        'totals': data['totals'],
+        'distinct_meters': np.frombuffer(base64.b64decode(data['distinct_meters']['registers']),
+                                         dtype=np.uint8).copy(),
+        'quantiles': quantiles,
+        'heavy_hitters': data['heavy_hitters'],
+    }
+
+
+def _period_sketch_path(sketch_dir, billing_period):
+    return os.path.join(sketch_dir, f'sketches_{billing_period}.json')
+
+
+def _write_sketch(path, sketch):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(sketch_to_json(sketch), f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+    return path
+
+
+def save_period_sketch(sketch_dir, billing_period, records):
+    """Build and store <sketch_dir>/sketches_<period>.json (re-converting a period replaces it)."""
+    return _write_sketch(_period_sketch_path(sketch_dir, billing_period), build_period_sketch(billing_period, records))
+
+
+def add_to_period_sketch(sketch_dir, billing_period, records):
+    """Merge records converted after the period's main conversion into its stored sketch."""
+    path = _period_sketch_path(sketch_dir, billing_period)
+    sketch = build_period_sketch(billing_period, records)
+    if os.path.exists(path):
+        with open(path, encoding='utf-8') as f:
+            sketch = merge_sketches([sketch_from_json(json.load(f)), sketch])
+    return _write_sketch(path, sketch)
+
+
+def load_sketches(sketch_dir, period_from=None, period_to=None):
+    """The stored period sketches in [period_from, period_to]."""
+    sketches = []
+    for path in sorted(glob.glob(os.path.join(sketch_dir, 'sketches_*.json'))):
+        match = SKETCH_FILE_PATTERN.match(os.path.basename(path))
+        if not match:
+            continue
+        period = match.group(1)
+        if (period_from and period < period_from) or (period_to and period > period_to):
+            continue
+        with open(path, encoding='utf-8') as f:
+            sketches.append(sketch_from_json(json.load(f)))
+    return sketches
+
+
+def query_sketches(sketch_dir, period_from=None, period_to=None, quantiles=DEFAULT_QUANTILES, top=DEFAULT_TOP):
+    """Merged statistics of every stored period in the range."""
+    return summarize_sketch(merge_sketches(load_sketches(sketch_dir, period_from, period_to)), quantiles, top)
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    options = {}
+    for flag in ('--from', '--to', '--top', '--quantiles'):
+        if flag in args:
+            i = args.index(flag)
+            options[flag] = args[i + 1]
+            del args[i:i + 2]
+
+    if len(args) < 2 or args[0] not in ('build', 'query'):
+        print(json.dumps({'success': False, 'error': 'Usage: python site_sketches.py build <sketch_dir> <history_json_or_dir>...\n'
+                                                     '       python site_sketches.py query <sketch_dir> [--from YYYY-MM] [--to YYYY-MM] '
+                                                     '[--top N] [--quantiles 0.5,0.9,0.99]'}))
+        sys.exit(1)
+
+    try:
+        if args[0] == 'build':
+            from site_history import load_site_records
+            by_period = {}
+            for record in load_site_records(args[2:]):
+                by_period.setdefault(record['billing_period'], []).append(record)
+            files = [os.path.basename(save_period_sketch(args[1], period, records))
+                     for period, records in sorted(by_period.items())]
+            print(json.dumps({'success': True, 'sketch_files': files}))
+        else:
+            quantiles = [float(q) for q in options['--quantiles'].split(',')] if '--quantiles' in options \
+                else DEFAULT_QUANTILES
+            summary = query_sketches(args[1], options.get('--from'), options.get('--to'), quantiles,
+                                     int(options.get('--top', DEFAULT_TOP)))
+            print(json.dumps({'success': True, **summary}, ensure_ascii=False))
+    except Exception as e:
+        print(json.dumps({'success': False, 'error': str(e)}))
+        sys.exit(1)
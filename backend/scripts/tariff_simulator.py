@@ -0,0 +1,235 @@
+"""
+BillFlow Tariff What-If Simulator
+Recomputes every site-month's cost under alternative tariff plans, discount
+percentages and peak-shifting scenarios as one batched NumPy computation over
+sites x months x scenarios. Results are cached per scenario hash.
+"""
+import os
+import sys
+import json
+import hashlib
+import numpy as np
+from site_history import load_site_records, build_site_matrix, history_fingerprint
+
+SIMULATION_FIELDS = [
+    'peak_consumption', 'offpeak_consumption',
+    'tou_tariff_peak', 'tou_tariff_offpeak', 'gc_tariff_peak', 'gc_tariff_offpeak',
+    'discount_from_gc_peak', 'discount_from_gc_offpeak',
+    'kva_cost', 'distribution_cost', 'supply_cost', 'total_cost',
+]
+
+RATE_FIELDS = {
+    'tou_peak': 'tou_tariff_peak',
+    'tou_offpeak': 'tou_tariff_offpeak',
+    'gc_peak': 'gc_tariff_peak',
+    'gc_offpeak': 'gc_tariff_offpeak',
+}
+
+SCENARIO_DEFAULTS = {
+    'name': None,
+    # Multipliers on the current rates (agorot per kWh)
+    'tou_peak_factor': 1.0,
+    'tou_offpeak_factor': 1.0,
+    'gc_peak_factor': 1.0,
+    'gc_offpeak_factor': 1.0,
+    # Discount from GC tariff in percent - None keeps each site's contracted discount
+    'discount_peak_pct': None,
+    'discount_offpeak_pct': None,
+    # Share of peak kWh moved to off-peak (0.1 = 10%)
+    'peak_shift_pct': 0.0,
+    # Multiplier on KVA, distribution and supply charges
+    'fixed_cost_factor': 1.0,
+    # Replacement rates per tariff type: {"TOU LV": {"tou_peak": 60.1, "gc_offpeak": 21.0}}
+    'tariff_plans': {},
+}
+
+# Upper bound on sites x months x scenarios cells computed at once (~32 MB per array)
+BATCH_CELL_BUDGET = 4_000_000
+
+_RESULT_CACHE = {}
+
+
+def normalize_scenario(scenario):
+    """Fill defaults and reject unknown keys or rate names."""
+    unknown = set(scenario) - set(SCENARIO_DEFAULTS)
+    if unknown:
+        raise ValueError(f"Unknown scenario fields: {sorted(unknown)}")
+    normalized = {**SCENARIO_DEFAULTS, **scenario}
+    for tariff_type, rates in normalized['tariff_plans'].items():
+        bad_rates = set(rates) - set(RATE_FIELDS)
+        if bad_rates:
+            raise ValueError(f"Unknown rates for tariff plan '{tariff_type}': {sorted(bad_rates)}")
+    return normalized
+
+
+def scenario_hash(scenario):
+    """Stable hash of the scenario parameters (the display name is ignored)."""
+    params = {k: v for k, v in normalize_scenario(scenario).items() if k != 'name'}
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def prepare_history(records):
+    """
+    Build the sites x months arrays the simulator runs on.
+    The residual (fines, various charges/credits, rounding) is the part of the
+    actual Total cost the tariff model does not explain; it is carried into
+    every scenario so the baseline scenario reproduces the billed totals exactly.
+    """
+    matrix = build_site_matrix(records, SIMULATION_FIELDS)
+    v = {field: np.nan_to_num(arr) for field, arr in matrix['values'].items()}
+    present = ~np.isnan(matrix['values']['total_cost'])
+
+    tariff_types = matrix['attributes']['tariff_type'].fillna('Unknown').to_numpy()
+    type_names, type_codes = np.unique(tariff_types, return_inverse=True)
+
+    model = {
+        'sites': matrix['sites'],
+        'periods': matrix['periods'],
+        'values': v,
+        'present': present,
+        'type_names': list(type_names),
+        'type_codes': type_codes,
+        'fingerprint': history_fingerprint(matrix),
+    }
+    baseline = _batch_costs(model, [normalize_scenario({})])[0]
+    model['residual'] = np.where(present, v['total_cost'] - baseline, 0.0)
+    return model
+
+
+def _param_array(scenarios, field):
+    return np.array([s[field] for s in scenarios], dtype=float)[:, None, None]
+
+
+def _rate_matrix(model, scenarios, rate, factor_field):
+    """Rates as (scenarios, sites, months) with tariff-plan overrides applied per site type."""
+    base = model['values'][RATE_FIELDS[rate]][None, :, :]
+    overrides = np.full((len(scenarios), len(model['type_names'])), np.nan)
+    for i, s in enumerate(scenarios):
+        for tariff_type, rates in s['tariff_plans'].items():
+            if rate in rates and tariff_type in model['type_names']:
+                overrides[i, model['type_names'].index(tariff_type)] = rates[rate]
+    site_overrides = overrides[:, model['type_codes']][:, :, None]
+    rates = np.where(np.isnan(site_overrides), base, site_overrides)
+    return rates * _param_array(scenarios, factor_field)
+
+
+def _discount_matrix(model, scenarios, field, site_field):
+    pct = np.array([np.nan if s[field] is None else s[field] for s in scenarios], dtype=float)[:, None, None]
+    return np.where(np.isnan(pct), model['values'][site_field][None, :, :], pct)
+
+
+def _batch_costs(model, scenarios):
+    """Cost of every site-month under each scenario - shape (scenarios, sites, months)."""
+    v = model['values']
+    shift = _param_array(scenarios, 'peak_shift_pct')
+    peak = v['peak_consumption'][None, :, :] * (1.0 - shift)
+    offpeak = v['offpeak_consumption'][None, :, :] + v['peak_consumption'][None, :, :] * shift
+
+    energy = (peak * _rate_matrix(model, scenarios, 'tou_peak', 'tou_peak_factor') +
+              offpeak * _rate_matrix(model, scenarios, 'tou_offpeak', 'tou_offpeak_factor')) / 100
+
+    # Discount is a percentage of the energy cost priced at the GC tariff
+    discount = (peak * _rate_matrix(model, scenarios, 'gc_peak', 'gc_peak_factor') *
+                _discount_matrix(model, scenarios, 'discount_peak_pct', 'discount_from_gc_peak') +
+                offpeak * _rate_matrix(model, scenarios, 'gc_offpeak', 'gc_offpeak_factor') *
+                _discount_matrix(model, scenarios, 'discount_offpeak_pct', 'discount_from_gc_offpeak')) / 10000
+
+    fixed = (v['kva_cost'] + v['distribution_cost'] + v['supply_cost'])[None, :, :] * \
+        _param_array(scenarios, 'fixed_cost_factor')
+
+    costs = energy - discount + fixed + model.get('residual', 0.0)
+    return np.where(model['present'][None, :, :], costs, 0.0)
+
+
+def _summarize(model, scenario, costs, top_n):
+    """Reduce one scenario's sites x months costs to the result payload."""
+    actual = np.where(model['present'], model['values']['total_cost'], 0.0)
+    site_savings = actual.sum(axis=1) - costs.sum(axis=1)
+    monthly = costs.sum(axis=0)
+    total = float(monthly.sum())
+    baseline_total = float(actual.sum())
+    top = np.argsort(site_savings)[::-1][:top_n]
+
+    return {
+        'name': scenario['name'],
+        'scenario_hash': scenario_hash(scenario),
+        'total_cost': total,
+        'baseline_cost': baseline_total,
+        'savings': baseline_total - total,
+        'savings_pct': (baseline_total - total) / baseline_total * 100 if baseline_total else 0.0,
+        'monthly_costs': {p: float(c) for p, c in zip(model['periods'], monthly)},
+        'top_site_savings': [{'meter_number': str(model['sites'][i]), 'savings': float(site_savings[i])}
+                             for i in top],
+    }
+
+
+def _cache_path(cache_dir, model, digest):
+    return os.path.join(cache_dir, model['fingerprint'][:16], f'{digest}.json')
+
+
+def simulate(model, scenarios, cache_dir=None, top_n=10):
+    """
+    Evaluate scenarios against a prepared history.
+    Only scenarios missing from the in-memory / on-disk cache are computed,
+    in batches sized to BATCH_CELL_BUDGET.
+    """
+    scenarios = [normalize_scenario(s) for s in scenarios]
+    results = [None] * len(scenarios)
+    pending = []
+
+    for i, scenario in enumerate(scenarios):
+        digest = scenario_hash(scenario)
+        cached = _RESULT_CACHE.get((model['fingerprint'], digest))
+        if cached is None and cache_dir and os.path.exists(_cache_path(cache_dir, model, digest)):
+            with open(_cache_path(cache_dir, model, digest), encoding='utf-8') as f:
+                cached = json.load(f)
+            _RESULT_CACHE[(model['fingerprint'], digest)] = cached
+        if cached is not None:
+            results[i] = {**cached, 'name': scenario['name'], 'cached': True}
+        else:
+            pending.append(i)
+
+    cells = max(1, len(model['sites']) * len(model['periods']))
+    batch_size = max(1, BATCH_CELL_BUDGET // cells)
+
+    for start in range(0, len(pending), batch_size):
+        batch = pending[start:start + batch_size]
+        costs = _batch_costs(model, [scenarios[i] for i in batch])
+        for j, i in enumerate(batch):
+            result = _summarize(model, scenarios[i], costs[j], top_n)
+            _RESULT_CACHE[(model['fingerprint'], result['scenario_hash'])] = result
+            if cache_dir:
+                path = _cache_path(cache_dir, model, result['scenario_hash'])
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, 'w', encoding='utf-8') as f:
+                    json.dump(result, f, ensure_ascii=False)
+            results[i] = {**result, 'cached': False}
+
+    return results
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print(json.dumps({'success': False, 'error': 'Usage: python tariff_simulator.py <scenarios.json> <history_json_or_dir>... [--cache-dir DIR]'}))
+        sys.exit(1)
+
+    args = sys.argv[1:]
+    cache_dir = None
+    if '--cache-dir' in args:
+        cache_dir = args[args.index('--cache-dir') + 1]
+        del args[args.index('--cache-dir'):args.index('--cache-dir') + 2]
+
+    try:
+        with open(args[0], encoding='utf-8') as f:
+            scenarios = json.load(f)
+        model = prepare_history(load_site_records(args[1:]))
+        results = simulate(model, scenarios, cache_dir=cache_dir)
+        print(json.dumps({
+            'success': True,
+            'site_count': len(model['sites']),
+            'periods': model['periods'],
+            'scenarios': results,
+        }, ensure_ascii=False))
+    except Exception as e:
+        print(json.dumps({'success': False, 'error': str(e)}))
+        sys.exit(1)
@@ -0,0 +1,89 @@
+"""Behavior of the integer money engine: largest-remainder allocation and exact reconciliation."""
+import os
+import sys
+import unittest
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from agorot_engine import largest_remainder, apply_agorot_amounts, to_units, UNITS_PER_ILS
+
+SEED_CSV = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..', 'seed-data',
+                        '01_2024-04_april.csv')
+
+
+class LargestRemainderTest(unittest.TestCase):
+    def test_every_group_sums_to_its_target(self):
+        rng = np.random.default_rng(7)
+        groups = np.repeat(np.arange(200), rng.integers(1, 12, size=200))
+        weights = rng.integers(1, 10 ** 9, size=len(groups))
+        targets = rng.integers(1, 10 ** 10, size=200)
+
+        shares = largest_remainder(weights, groups, targets)
+        self.assertEqual(np.bincount(groups, weights=shares).astype(np.int64).tolist(), targets.tolist())
+        # Every share is within one unit of its exact proportional quota
+        quotas = weights / np.bincount(groups, weights=weights)[groups] * targets[groups]
+        self.assertTrue((np.abs(shares - quotas) < 1 + 1e-6).all())
+
+    def test_negative_weights(self):
+        # A document with discounts and a credit line
+        weights = np.array([1000, -150, 500, -75, -20])
+        groups = np.zeros(5, dtype=np.int64)
+        targets = np.array([1254])
+
+        shares = largest_remainder(weights, groups, targets)
+        self.assertEqual(int(shares.sum()), 1254)
+        self.assertTrue((np.sign(shares) == np.sign(weights)).all())
+
+    def test_groups_without_positive_weight_keep_their_weights(self):
+        weights = np.array([100, -300, 7, 3])
+        groups = np.array([0, 0, 1, 1])
+        shares = largest_remainder(weights, groups, np.array([999, 11]))
+        self.assertEqual(shares.tolist(), [100, -300, 8, 3])
+
+
+@unittest.skipUnless(os.path.exists(SEED_CSV), 'seed data not available')
+class ApplyAgorotAmountsTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        from billflow_converter import load_billing_frame
+        cls.df = load_billing_frame(SEED_CSV)
+
+    def convert(self, df):
+        from billflow_converter import generate_invoice_lines
+        lines = pd.DataFrame(generate_invoice_lines(df))
+        return apply_agorot_amounts(lines, df)
+
+    def test_documents_sum_to_the_unrounded_csv_totals(self):
+        lines, stats = self.convert(self.df)
+
+        included = lines[lines['כלול בחיוב'] == 'כן']
+        line_totals = to_units(included.groupby('מספר חשבונית')['סכום '].sum())
+        csv_totals = to_units(self.df.groupby('Document number')['Total cost'].sum())
+        self.assertEqual(line_totals.tolist(), csv_totals.tolist())
+        self.assertEqual(stats['documents_exact'], stats['documents'])
+        self.assertEqual(stats['included_units'], stats['csv_units'])
+        self.assertEqual(stats['difference'], 0)
+
+    def test_rows_of_one_document_with_negative_credits(self):
+        df = self.df.head(3).copy()
+        df['Document number'] = df['Document number'].iloc[0]
+        df.loc[df.index[0], 'Various credits'] = -12.345
+        df.loc[df.index[1], 'Total cost'] = 201.162
+        lines, stats = self.convert(df)
+
+        included = lines[lines['כלול בחיוב'] == 'כן']
+        credit = included[included['מזהה פריט'] == 'P-9002']['סכום ']
+        self.assertEqual(len(credit), 1)
+        self.assertLess(float(credit.iloc[0]), 0)
+        self.assertEqual(stats['documents'], 1)
+        self.assertEqual(stats['documents_exact'], 1)
+        self.assertEqual(int(to_units(included['סכום '].sum())), int(to_units(df['Total cost'].sum())))
+        # VAT is integer milli-agorot per line
+        vat_units = included['סכום המע"מ'].to_numpy() * UNITS_PER_ILS
+        self.assertTrue(np.allclose(vat_units, np.round(vat_units)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+"""Behavior of the upload dedupe index: Bloom filter fallback, reservations, unregistering."""
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+import subprocess
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from dedupe_index import (load_index, save_index, register_upload, unregister_upload, find_known_documents,
+                          check_upload, index_lock, load_pending, save_pending, reserve_upload, release_upload,
+                          RESERVATION_SECONDS)
+
+SEED_CSV = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..', 'seed-data',
+                        '01_2024-04_april.csv')
+
+
+class DedupeIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.index_dir)
+
+    def test_bloom_false_positives_are_checked_against_the_exact_set(self):
+        index = register_upload(load_index(self.index_dir), 'a' * 64, [10, 20, 30], 'april.csv')
+        save_index(index)
+        index = load_index(self.index_dir)
+        # A saturated filter answers "maybe" for everything - only the exact set decides
+        index['bloom'] = np.full_like(np.asarray(index['bloom']), 0xFF)
+
+        known = find_known_documents(index, [20, 25, 30, 99])
+        self.assertEqual(known.tolist(), [20, 30])
+
+    def test_registered_documents_survive_a_reload(self):
+        save_index(register_upload(load_index(self.index_dir), 'a' * 64, [1, 2, 3], 'april.csv', '2024-04'))
+        index = load_index(self.index_dir)
+
+        result = check_upload(index, 'a' * 64, [3, 4])
+        self.assertTrue(result['duplicate'])
+        self.assertEqual(result['duplicate_of']['filename'], 'april.csv')
+        self.assertEqual(result['overlap_count'], 1)
+        self.assertEqual(check_upload(index, 'b' * 64, [4, 5])['overlap_count'], 0)
+
+    def test_reservation_blocks_the_same_file_and_its_documents(self):
+        with index_lock(self.index_dir):
+            reserve_upload(self.index_dir, load_pending(self.index_dir), 'a' * 64, [1, 2], 'april.csv')
+            pending = load_pending(self.index_dir)
+        index = load_index(self.index_dir)
+
+        same_file = check_upload(index, 'a' * 64, [1, 2], pending)
+        self.assertTrue(same_file['duplicate_of']['converting'])
+        self.assertEqual(check_upload(index, 'b' * 64, [2, 3], pending)['overlap_count'], 1)
+
+        release_upload(self.index_dir, 'a' * 64)
+        with index_lock(self.index_dir):
+            self.assertEqual(load_pending(self.index_dir), {})
+
+    def test_stale_reservations_are_dropped(self):
+        finished = subprocess.run([sys.executable, '-c', 'import os; print(os.getpid())'],
+                                  capture_output=True, text=True)
+        with index_lock(self.index_dir):
+            pending = load_pending(self.index_dir)
+            reserve_upload(self.index_dir, pending, 'a' * 64, [1], 'expired.csv')
+            reserve_upload(self.index_dir, pending, 'b' * 64, [2], 'live.csv')
+            pending['a' * 64]['reserved_at'] = time.time() - RESERVATION_SECONDS - 1
+            if os.name != 'nt':
+                reserve_upload(self.index_dir, pending, 'c' * 64, [3], 'dead.csv')
+                pending['c' * 64]['pid'] = int(finished.stdout)
+            save_pending(self.index_dir, pending)
+
+            self.assertEqual(list(load_pending(self.index_dir)), ['b' * 64])
+
+    def test_unregister_keeps_documents_another_file_registered(self):
+        index = register_upload(load_index(self.index_dir), 'a' * 64, [1, 2, 3], 'april.csv')
+        index = register_upload(index, 'b' * 64, [3], 'april_fixed_rejects.csv')
+        save_index(index)
+
+        index = load_index(self.index_dir)
+        self.assertEqual(unregister_upload(index, 'a' * 64), 2)
+        save_index(index)
+
+        index = load_index(self.index_dir)
+        self.assertNotIn('a' * 64, index['files'])
+        self.assertEqual(np.asarray(index['documents']).tolist(), [3])
+        self.assertEqual(find_known_documents(index, [1, 2, 3]).tolist(), [3])
+        self.assertFalse(check_upload(index, 'a' * 64, [1, 2])['duplicate'])
+        self.assertEqual(unregister_upload(index, 'a' * 64), 0)
+
+    @unittest.skipUnless(os.path.exists(SEED_CSV), 'seed data not available')
+    def test_converting_the_same_file_again_needs_reprocess(self):
+        from billflow_converter import convert_csv_to_tsv
+
+        output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, output_dir)
+        self.assertTrue(convert_csv_to_tsv(SEED_CSV, output_dir, dedupe_index=self.index_dir)['success'])
+
+        again = convert_csv_to_tsv(SEED_CSV, output_dir, dedupe_index=self.index_dir)
+        self.assertFalse(again['success'])
+        self.assertTrue(again['duplicate'])
+
+        reprocessed = convert_csv_to_tsv(SEED_CSV, output_dir, dedupe_index=self.index_dir, reprocess=True)
+        self.assertTrue(reprocessed['success'])
+        self.assertEqual(len(load_index(self.index_dir)['files']), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+"""Behavior of --quarantine followed by --merge-into: rejects, line numbering and dedupe registration."""
+import os
+import sys
+import glob
+import shutil
+import tempfile
+import unittest
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+SEED_CSV = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..', 'seed-data',
+                        '01_2024-04_april.csv')
+
+
+@unittest.skipUnless(os.path.exists(SEED_CSV), 'seed data not available')
+class QuarantineMergeTest(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.work_dir)
+        self.output_dir = os.path.join(self.work_dir, 'output')
+        self.index_dir = os.path.join(self.work_dir, 'dedupe_index')
+        os.makedirs(self.output_dir)
+
+        self.rows = pd.read_csv(SEED_CSV, dtype=str, keep_default_na=False, encoding='utf-8-sig').head(30)
+        bad = self.rows.copy()
+        bad.loc[3, 'From'] = 'not a date'
+        bad.loc[7, 'Supply'] = 'twelve'
+        self.bad_csv = self.write_csv(bad, 'bad.csv')
+
+    def write_csv(self, df, name):
+        path = os.path.join(self.work_dir, name)
+        df.to_csv(path, index=False, encoding='utf-8-sig')
+        return path
+
+    def convert(self):
+        from billflow_converter import convert_csv_to_tsv
+        return convert_csv_to_tsv(self.bad_csv, self.output_dir, dedupe_index=self.index_dir, quarantine=True)
+
+    def fixed_rejects(self, result):
+        rejects = pd.read_csv(result['rejects_path'], dtype=str, keep_default_na=False, encoding='utf-8-sig')
+        for column in ('From', 'Supply'):
+            # source_row is the line in the original CSV (line 1 is the header)
+            rejects[column] = [self.rows.loc[int(line) - 2, column] for line in rejects['source_row']]
+        return self.write_csv(rejects, 'fixed.csv')
+
+    def test_bad_rows_are_set_aside_with_reasons(self):
+        result = self.convert()
+
+        self.assertTrue(result['success'])
+        self.assertEqual(result['rejected_rows'], 2)
+        self.assertEqual(result['reject_reasons'], {'BAD_FROM_DATE': 1, 'BAD_AMOUNT': 1})
+        rejects = pd.read_csv(result['rejects_path'], dtype=str, encoding='utf-8-sig')
+        self.assertEqual(rejects['source_row'].tolist(), ['5', '9'])
+
+    def test_merge_continues_the_line_numbers_and_registers_the_documents(self):
+        from billflow_converter import merge_fixed_rejects
+        from dedupe_index import load_index, find_known_documents
+
+        result = self.convert()
+        rejected_documents = self.rows.loc[[3, 7], 'Document number'].astype(int).tolist()
+        index = load_index(self.index_dir)
+        self.assertEqual(find_known_documents(index, rejected_documents).tolist(), [])
+
+        merged = merge_fixed_rejects(self.fixed_rejects(result), result['tsv_path'], dedupe_index=self.index_dir)
+        self.assertTrue(merged['success'])
+        self.assertEqual(merged['document_count'], 2)
+
+        lines = pd.read_csv(result['tsv_path'], sep='\t', encoding='utf-8-sig')
+        self.assertEqual(lines['מספר שורה'].tolist(), list(range(1, len(lines) + 1)))
+        self.assertEqual(set(lines['מספר חשבונית']), set(self.rows['Document number'].astype(int)))
+
+        # The merged lines get their own workbook; the month's XLSX is left as it was
+        merge_workbook = pd.read_excel(merged['excel_path'])
+        self.assertEqual(len(merge_workbook), len(lines) - result['total_rows'])
+        self.assertEqual(len(pd.read_excel(result['excel_path'])), result['total_rows'])
+
+        index = load_index(self.index_dir)
+        self.assertEqual(sorted(find_known_documents(index, rejected_documents).tolist()), sorted(rejected_documents))
+        self.assertEqual(len(index['files']), 2)
+
+        again = merge_fixed_rejects(os.path.join(self.work_dir, 'fixed.csv'), result['tsv_path'],
+                                    dedupe_index=self.index_dir)
+        self.assertFalse(again['success'])
+        self.assertTrue(again['duplicate'])
+        self.assertEqual(len(glob.glob(os.path.join(self.output_dir, '*_merge_*.xlsx'))), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,9 +1,22 @@
 import os
 import pandas as pd
-import openpyxl
 from datetime import datetime, date
+from excel_reader import iter_excel_chunks
+from billing_rules import load_rule_set, rule_stamp, tariff_rules
 
-VAT_RATE = 0.18  # 18%
+# Comma-formatted numbers (like "1,778.33") that need cleaning before math
+NUMERIC_COLUMNS = ['Peak consumption', 'Off-peak consumption', 'Transformer unit',
+                   'Consumption with discount peak', 'Consumption with discount off-peak',
+                   'Consumption without discount peak', 'Consumption without discount off-peak',
+                   'Cost with discount peak', 'Cost with discount off-peak',
+                   'Energy cost peak by TOU tariff', 'Energy cost off-peak by TOU tariff',
+                   'Total discount peak (ILS)', 'Total discount off-peak (ILS)',
+                   'Total discount (ILS)', 'Total cost', 'Total cost VAT',
+                   'Total cost without discount', 'Distribution', 'Supply', 'KVA cost',
+                   'Power factor fine', 'Various charges', 'Various credits']
+
+# Tariff IDs this transform bills (rows with any other tariff are skipped)
+TARIFF_IDS = ['Residential', 'TOU LV', 'Streetlight', 'TOU MV']
 
 def fmt_dmy(val) -> str:
     """Convert date value to dd/mm/yyyy string."""
@@ -17,90 +30,73 @@ def fmt_dmy(val) -> str:
             continue
     return s
 
-def transform_final_corrected(src_path: str, dst_path: str):
+def _read_source_chunks(src_path: str):
     """
-    FINAL CORRECTED VERSION: 
-    - Use Energy cost by TOU tariff fields for consumption
-    - Use CSV Total discount (ILS) field instead of calculating discounts manually
+    Yield the source rows as cleaned DataFrame chunks.
+    CSV is read in one go; Excel is streamed so the workbook is never loaded whole.
+    The output lines are still kept until the end (as one DataFrame per chunk),
+    because they are sorted by document before the workbook is written.
     """
-    
     ext = os.path.splitext(src_path)[1].lower()
     if ext == ".csv":
-        df = pd.read_csv(src_path)
+        chunks = [pd.read_csv(src_path)]
     else:
-        df = pd.read_excel(src_path)
-    
-    # Handle comma-formatted numbers (like "1,778.33") in CSV files
-    numeric_columns = ['Peak consumption', 'Off-peak consumption', 'Transformer unit', 
-                      'Consumption with discount peak', 'Consumption with discount off-peak',
-                      'Consumption without discount peak', 'Consumption without discount off-peak',
-                      'Cost with discount peak', 'Cost with discount off-peak',
-                      'Energy cost peak by TOU tariff', 'Energy cost off-peak by TOU tariff',
-                      'Total discount peak (ILS)', 'Total discount off-peak (ILS)',
-                      'Total discount (ILS)', 'Total cost', 'Total cost VAT',
-                      'Total cost without discount', 'Distribution', 'Supply', 'KVA cost',
-                      'Power factor fine', 'Various charges', 'Various credits']
-    
-    for col in numeric_columns:
-        if col in df.columns and df[col].dtype == 'object':
-            # Remove commas and convert to float
-            df[col] = df[col].astype(str).str.replace(',', '').astype(float)
-
-    # Tariff mappings 
-    tariff_map = {
-        "Residential": [
-            ("P-3008", "מגורים - עם הנחה פסגה"),
-            ("P-3009", "מגורים - עם הנחה שפל"),
-            ("P-0005", "חלוקה"), ("P-0001", "אספקה"), ("P-0011", "עלות החיבור"),
-        ],
-        "TOU LV": [
-            ("P-2008", "תעוז מתח נמוך - עם הנחה פסגה"),
-            ("P-2009", "תעוז מתח נמוך - עם הנחה שפל"),
-            ("P-0005", "חלוקה"), ("P-0001", "אספקה"), ("P-0011", "עלות החיבור"),
-        ],
-        "Streetlight": [
-            ("P-4008", "מאור רחוב - עם הנחה פסגה"),
-            ("P-4009", "מאור רחוב - עם הנחה שפל"),
-            ("P-0005", "חלוקה"), ("P-0001", "אספקה"), ("P-0011", "עלות החיבור"),
-        ],
-        "TOU MV": [
-            ("P-1008", "תעוז מתח גבוה - עם הנחה פסגה"),
-            ("P-1009", "תעוז מתח גבוה - עם הנחה שפל"),
-            ("P-0005", "חלוקה"), ("P-0001", "אספקה"), ("P-0011", "עלות החיבור"),
-        ],
-    }
+        chunks = iter_excel_chunks(src_path)
 
-    # GROSS CHARGES - for display only
-    gross_map = {
-        "TOU LV":      (("P-5004","סה\"כ חיוב גולמי תעוז מתח נמוך פסגה"),
-                        ("P-5005","סה\"כ חיוב גולמי תעוז מתח נמוך שפל")),
-        "TOU MV":      (("P-5008","סה\"כ חיוב גולמי תעוז מתח גבוה פסגה"),
-                        ("P-5009","סה\"כ חיוב גולמי תעוז מתח גבוה שפל")),
-        "Residential": (("P-5038","סה\"כ חיוב גולמי מגורים פסגה"),
-                        ("P-5039","סה\"כ חיוב גולמי מגורים שפל")),
-        "Streetlight": (("P-5048","סה\"כ חיוב גולמי מאור רחוב פסגה"),
-                        ("P-5049","סה\"כ חיוב גולמי מאור רחוב שפל")),
-    }
+    for df in chunks:
+        for col in NUMERIC_COLUMNS:
+            if col in df.columns and df[col].dtype == 'object':
+                # Remove commas and convert to float
+                df[col] = df[col].astype(str).str.replace(',', '').astype(float)
+        yield df
+
+def transform_final_corrected(src_path: str, dst_path: str, rules=None):
+    """
+    FINAL CORRECTED VERSION: 
+    - Use Energy cost by TOU tariff fields for consumption
+    - Use CSV Total discount (ILS) field instead of calculating discounts manually
+    rules is the billing rule set whose VAT rate, item codes and descriptions are
+    applied (default: the latest version); the results carry its version and fingerprint.
+    """
+    rules = rules or load_rule_set()
+    vat_rate = rules['vat_rate']
+    items = rules['items']
 
-    out = []
+    # Item codes and descriptions of each billed tariff, from the rule set
+    tariff_map = {tid: tariff_rules(rules, tid) for tid in TARIFF_IDS}
 
-    for _, row in df.iterrows():
-        tid = row["Tariff ID"]
-        items = tariff_map.get(tid, [])
-        if not items:
-            continue
+    # Row order within a document (energy lines, which vary per tariff, come 5th)
+    order = {**{tariff['gross_peak']['code']: 1 for tariff in tariff_map.values()},
+             items['discount_peak']['code']: 2,
+             **{tariff['gross_offpeak']['code']: 3 for tariff in tariff_map.values()},
+             items['discount_offpeak']['code']: 4,
+             items['supply']['code']: 6, items['distribution']['code']: 7, items['kva']['code']: 8,
+             items['power_factor_fine']['code']: 9, items['various_charges']['code']: 10,
+             items['various_credits']['code']: 11}
+    gross_codes = [tariff[key]['code'] for tariff in tariff_map.values() for key in ('gross_peak', 'gross_offpeak')]
+
+    frames = []
+    csv_total = 0.0
 
-        start_date = fmt_dmy(row["From"])
-        end_date = fmt_dmy(row["To"])
+    for chunk in _read_source_chunks(src_path):
+        out = []
+        csv_total += float(chunk["Total cost"].sum())
+        for _, row in chunk.iterrows():
+            tid = row["Tariff ID"]
+            tariff = tariff_map.get(tid)
+            if tariff is None:
+                continue
 
-        # 1. GROSS CHARGES - FOR DISPLAY ONLY (כלול בחיוב = "לא")
-        if tid in gross_map:
-            for code, desc in gross_map[tid]:
-                peak = "פסגה" in desc
+            start_date = fmt_dmy(row["From"])
+            end_date = fmt_dmy(row["To"])
+
+            # 1. GROSS CHARGES - FOR DISPLAY ONLY (כלול בחיוב = "לא")
+            for key, peak in (('gross_peak', True), ('gross_offpeak', False)):
+                code, desc = tariff[key]['code'], tariff[key]['description']
                 qty = row["Peak consumption"] if peak else row["Off-peak consumption"]
                 price_orig = row["TOU tariff peak"] if peak else row["TOU tariff off-peak"]
                 total = qty * price_orig / 100
-                vat = total * VAT_RATE
+                vat = total * vat_rate
                 out.append({
                     "מזהה פריט": code, "תיאור": desc,
                     "מש\"ב": "פסגה" if peak else "שפל",
@@ -121,95 +117,87 @@ def transform_final_corrected(src_path: str, dst_path: str):
                     "תאריך הסיום": end_date,
                 })
 
-        # 2. DISCOUNT ITEMS - Calculate from gross vs net costs
-        # P-6001 - הנחה פסגה (calculated as gross - net)
-        gross_peak = float(row.get("Energy cost peak by TOU tariff", 0))
-        net_peak = float(row.get("Cost with discount peak", 0))
-        discount_peak = gross_peak - net_peak
-        if discount_peak > 0:
-            qty = row["Peak consumption"]
-            discount_amount = -discount_peak  # Make negative
-            unit_price = (discount_amount * 100) / qty if qty > 0 else 0  # convert to agorot
-            vat = discount_amount * VAT_RATE
-            out.append({
-                "מזהה פריט": "P-6001",
-                "תיאור": "הנחה פסגה",
-                "מש\"ב": "פסגה",
-                "כמות": qty,
-                "יחידת מידה": "kWh",
-                "מחיר יחידה": unit_price,
-                "סכום ": discount_amount,
-                "סכום המע\"מ": vat,
-                "סכום כולל מע\"מ": discount_amount + vat,
-                "כלול בחיוב": "לא",  # DISPLAY ONLY - discount for transparency
-                "מספר חשבונית": row["Document number"],
-                "חשבון לקוח משלם": 10003,
-                "שם הלקוח המשלם": "עיריית ראשון לציון",
-                "שם משתמש עיקרי": row["Site name"],
-                "מספר  מזהה לחיבור": str(row["Site ID"]).replace("'", "").replace('"', '').strip(),
-                "מספר מונה חח\"י": str(row["Meter IEC long number"]).replace("'", "").strip(),
-                "מספר חוזה": str(row["Contract number"]).replace("'", "").strip(),
-                "תאריך התחלה": start_date,
-                "תאריך הסיום": end_date,
-            })
-
-        # P-6002 - הנחה שפל (calculated as gross - net)
-        gross_offpeak = float(row.get("Energy cost off-peak by TOU tariff", 0))
-        net_offpeak = float(row.get("Cost with discount off-peak", 0))
-        discount_offpeak = gross_offpeak - net_offpeak
-        if discount_offpeak > 0:
-            qty = row["Off-peak consumption"]
-            discount_amount = -discount_offpeak  # Make negative
-            unit_price = (discount_amount * 100) / qty if qty > 0 else 0  # convert to agorot
-            vat = discount_amount * VAT_RATE
-            out.append({
-                "מזהה פריט": "P-6002",
-                "תיאור": "הנחה שפל",
-                "מש\"ב": "שפל",
-                "כמות": qty,
-                "יחידת מידה": "kWh",
-                "מחיר יחידה": unit_price,
-                "סכום ": discount_amount,
-                "סכום המע\"מ": vat,
-                "סכום כולל מע\"מ": discount_amount + vat,
-                "כלול בחיוב": "לא",  # DISPLAY ONLY - discount for transparency
-                "מספר חשבונית": row["Document number"],
-                "חשבון לקוח משלם": 10003,
-                "שם הלקוח המשלם": "עיריית ראשון לציון",
-                "שם משתמש עיקרי": row["Site name"],
-                "מספר  מזהה לחיבור": str(row["Site ID"]).replace("'", "").replace('"', '').strip(),
-                "מספר מונה חח\"י": str(row["Meter IEC long number"]).replace("'", "").strip(),
-                "מספר חוזה": str(row["Contract number"]).replace("'", "").strip(),
-                "תאריך התחלה": start_date,
-                "תאריך הסיום": end_date,
-            })
-
-        # 3. CONSUMPTION ITEMS - USE COST WITH DISCOUNT FIELDS
-        # Peak consumption charge
-        energy_peak_cost = float(row.get("Cost with discount peak", 0))
-        if energy_peak_cost > 0:
-            # Find the appropriate P-code for peak
-            peak_code = None
-            for code, desc in items:
-                if "פסגה" in desc and "עם הנחה" in desc:
-                    peak_code = code
-                    break
-            
-            if peak_code:
+            # 2. DISCOUNT ITEMS - Calculate from gross vs net costs
+            # Peak discount (calculated as gross - net)
+            gross_peak = float(row.get("Energy cost peak by TOU tariff", 0))
+            net_peak = float(row.get("Cost with discount peak", 0))
+            discount_peak = gross_peak - net_peak
+            if discount_peak > 0:
+                qty = row["Peak consumption"]
+                discount_amount = -discount_peak  # Make negative
+                unit_price = (discount_amount * 100) / qty if qty > 0 else 0  # convert to agorot
+                vat = discount_amount * vat_rate
+                out.append({
+                    "מזהה פריט": items['discount_peak']['code'],
+                    "תיאור": items['discount_peak']['description'],
+                    "מש\"ב": "פסגה",
+                    "כמות": qty,
+                    "יחידת מידה": "kWh",
+                    "מחיר יחידה": unit_price,
+                    "סכום ": discount_amount,
+                    "סכום המע\"מ": vat,
+                    "סכום כולל מע\"מ": discount_amount + vat,
+                    "כלול בחיוב": "לא",  # DISPLAY ONLY - discount for transparency
+                    "מספר חשבונית": row["Document number"],
+                    "חשבון לקוח משלם": 10003,
+                    "שם הלקוח המשלם": "עיריית ראשון לציון",
+                    "שם משתמש עיקרי": row["Site name"],
+                    "מספר  מזהה לחיבור": str(row["Site ID"]).replace("'", "").replace('"', '').strip(),
+                    "מספר מונה חח\"י": str(row["Meter IEC long number"]).replace("'", "").strip(),
+                    "מספר חוזה": str(row["Contract number"]).replace("'", "").strip(),
+                    "תאריך התחלה": start_date,
+                    "תאריך הסיום": end_date,
+                })
+
+            # Off-peak discount (calculated as gross - net)
+            gross_offpeak = float(row.get("Energy cost off-peak by TOU tariff", 0))
+            net_offpeak = float(row.get("Cost with discount off-peak", 0))
+            discount_offpeak = gross_offpeak - net_offpeak
+            if discount_offpeak > 0:
+                qty = row["Off-peak consumption"]
+                discount_amount = -discount_offpeak  # Make negative
+                unit_price = (discount_amount * 100) / qty if qty > 0 else 0  # convert to agorot
+                vat = discount_amount * vat_rate
+                out.append({
+                    "מזהה פריט": items['discount_offpeak']['code'],
+                    "תיאור": items['discount_offpeak']['description'],
+                    "מש\"ב": "שפל",
+                    "כמות": qty,
+                    "יחידת מידה": "kWh",
+                    "מחיר יחידה": unit_price,
+                    "סכום ": discount_amount,
+                    "סכום המע\"מ": vat,
+                    "סכום כולל מע\"מ": discount_amount + vat,
+                    "כלול בחיוב": "לא",  # DISPLAY ONLY - discount for transparency
+                    "מספר חשבונית": row["Document number"],
+                    "חשבון לקוח משלם": 10003,
+                    "שם הלקוח המשלם": "עיריית ראשון לציון",
+                    "שם משתמש עיקרי": row["Site name"],
+                    "מספר  מזהה לחיבור": str(row["Site ID"]).replace("'", "").replace('"', '').strip(),
+                    "מספר מונה חח\"י": str(row["Meter IEC long number"]).replace("'", "").strip(),
+                    "מספר חוזה": str(row["Contract number"]).replace("'", "").strip(),
+                    "תאריך התחלה": start_date,
+                    "תאריך הסיום": end_date,
+                })
+
+            # 3. CONSUMPTION ITEMS - USE COST WITH DISCOUNT FIELDS
+            # Peak consumption charge
+            energy_cost = float(row.get("Cost with discount peak", 0))
+            if energy_cost > 0:
                 # Calculate unit price from energy cost and quantity
                 qty = row["Peak consumption"]
-                unit_price = (energy_peak_cost * 100) / qty if qty > 0 else 0  # convert to agorot
-                
+                unit_price = (energy_cost * 100) / qty if qty > 0 else 0  # convert to agorot
+
                 out.append({
-                    "מזהה פריט": peak_code,
-                    "תיאור": f"{tariff_map[tid][0][1]}",
+                    "מזהה פריט": tariff['energy_peak']['code'],
+                    "תיאור": tariff['energy_peak']['description'],
                     "מש\"ב": "פסגה",
-                    "כמות": qty, 
+                    "כמות": qty,
                     "יחידת מידה": "kWh",
                     "מחיר יחידה": unit_price,
-                    "סכום ": energy_peak_cost,
-                    "סכום המע\"מ": energy_peak_cost * VAT_RATE,
-                    "סכום כולל מע\"מ": energy_peak_cost * (1 + VAT_RATE),
+                    "סכום ": energy_cost,
+                    "סכום המע\"מ": energy_cost * vat_rate,
+                    "סכום כולל מע\"מ": energy_cost * (1 + vat_rate),
                     "כלול בחיוב": "כן",  # INCLUDED
                     "מספר חשבונית": row["Document number"],
                     "חשבון לקוח משלם": 10003,
@@ -222,31 +210,23 @@ def transform_final_corrected(src_path: str, dst_path: str):
                     "תאריך הסיום": end_date,
                 })
 
-        # Off-peak consumption charge
-        energy_offpeak_cost = float(row.get("Cost with discount off-peak", 0))
-        if energy_offpeak_cost > 0:
-            # Find the appropriate P-code for off-peak
-            offpeak_code = None
-            for code, desc in items:
-                if "שפל" in desc and "עם הנחה" in desc:
-                    offpeak_code = code
-                    break
-            
-            if offpeak_code:
+            # Off-peak consumption charge
+            energy_cost = float(row.get("Cost with discount off-peak", 0))
+            if energy_cost > 0:
                 # Calculate unit price from energy cost and quantity
                 qty = row["Off-peak consumption"]
-                unit_price = (energy_offpeak_cost * 100) / qty if qty > 0 else 0  # convert to agorot
-                
+                unit_price = (energy_cost * 100) / qty if qty > 0 else 0  # convert to agorot
+
                 out.append({
-                    "מזהה פריט": offpeak_code,
-                    "תיאור": f"{tariff_map[tid][1][1]}",
+                    "מזהה פריט": tariff['energy_offpeak']['code'],
+                    "תיאור": tariff['energy_offpeak']['description'],
                     "מש\"ב": "שפל",
                     "כמות": qty,
-                    "יחידת מידה": "kWh", 
+                    "יחידת מידה": "kWh",
                     "מחיר יחידה": unit_price,
-                    "סכום ": energy_offpeak_cost,
-                    "סכום המע\"מ": energy_offpeak_cost * VAT_RATE,
-                    "סכום כולל מע\"מ": energy_offpeak_cost * (1 + VAT_RATE),
+                    "סכום ": energy_cost,
+                    "סכום המע\"מ": energy_cost * vat_rate,
+                    "סכום כולל מע\"מ": energy_cost * (1 + vat_rate),
                     "כלול בחיוב": "כן",  # INCLUDED
                     "מספר חשבונית": row["Document number"],
                     "חשבון לקוח משלם": 10003,
@@ -259,15 +239,15 @@ def transform_final_corrected(src_path: str, dst_path: str):
                     "תאריך הסיום": end_date,
                 })
 
-        # 4. INFRASTRUCTURE CHARGES - use exact values from original
-        infrastructure = [
-            ("P-0005", "חלוקה", "Distribution"),
-            ("P-0001", "אספקה", "Supply"), 
-            ("P-0011", "עלות החיבור", "KVA cost")
-        ]
-        
-        for code, desc, col in infrastructure:
-            if any(code == p for p, _ in items):
+            # 4. INFRASTRUCTURE CHARGES - use exact values from original
+            infrastructure = [
+                ("distribution", "Distribution"),
+                ("supply", "Supply"),
+                ("kva", "KVA cost")
+            ]
+
+            for item, col in infrastructure:
+                code, desc = items[item]['code'], items[item]['description']
                 amount = float(row.get(col, 0))
                 if amount > 0:
                     out.append({
@@ -278,8 +258,8 @@ def transform_final_corrected(src_path: str, dst_path: str):
                         "יחידת מידה": "",
                         "מחיר יחידה": amount,
                         "סכום ": amount,
-                        "סכום המע\"מ": amount * VAT_RATE,
-                        "סכום כולל מע\"מ": amount * (1 + VAT_RATE),
+                        "סכום המע\"מ": amount * vat_rate,
+                        "סכום כולל מע\"מ": amount * (1 + vat_rate),
                         "כלול בחיוב": "כן",  # INCLUDED
                         "מספר חשבונית": row["Document number"],
                         "חשבון לקוח משלם": 10003,
@@ -292,27 +272,54 @@ def transform_final_corrected(src_path: str, dst_path: str):
                         "תאריך הסיום": end_date,
                     })
 
-        # 5. OTHER CHARGES - use exact values
-        other_charges = [
-            ("P-8001", "קנס מקדם הספק", "Power factor fine"),
-            ("P-9001", "שונות", "Various charges"),
-        ]
-        
-        for code, desc, col in other_charges:
-            amount = float(row.get(col, 0))
-            if amount > 0:
+            # 5. OTHER CHARGES - use exact values
+            other_charges = [
+                ("power_factor_fine", "Power factor fine"),
+                ("various_charges", "Various charges"),
+            ]
+
+            for item, col in other_charges:
+                code, desc = items[item]['code'], items[item]['description']
+                amount = float(row.get(col, 0))
+                if amount > 0:
+                    out.append({
+                        "מזהה פריט": code,
+                        "תיאור": desc,
+                        "מש\"ב": "",
+                        "כמות": 1.0,
+                        "יחידת מידה": "",
+                        "מחיר יחידה": amount,
+                        "סכום ": amount,
+                        "סכום המע\"מ": amount * vat_rate,
+                        "סכום כולל מע\"מ": amount * (1 + vat_rate),
+                        "כלול בחיוב": "כן",  # INCLUDED
+                        "מספר חשבונית": row["Document number"],
+                        "חשבון לקוח משלם": 10003,
+                        "שם הלקוח המשלם": "עיריית ראשון לציון",
+                        "שם משתמש עיקרי": row["Site name"],
+                        "מספר  מזהה לחיבור": str(row["Site ID"]).replace("'", "").replace('"', '').strip(),
+                        "מספר מונה חח\"י": str(row["Meter IEC long number"]).replace("'", "").strip(),
+                        "מספר חוזה": str(row["Contract number"]).replace("'", "").strip(),
+                        "תאריך התחלה": start_date,
+                        "תאריך הסיום": end_date,
+                    })
+
+            # 6. CREDITS - use exact values (negative)
+            credits = float(row.get("Various credits", 0))
+            if credits != 0:
+                amount = -abs(credits) if credits > 0 else credits  # Ensure negative
                 out.append({
-                    "מזהה פריט": code,
-                    "תיאור": desc,
+                    "מזהה פריט": items['various_credits']['code'],
+                    "תיאור": items['various_credits']['description'],
                     "מש\"ב": "",
                     "כמות": 1.0,
                     "יחידת מידה": "",
                     "מחיר יחידה": amount,
                     "סכום ": amount,
-                    "סכום המע\"מ": amount * VAT_RATE,
-                    "סכום כולל מע\"מ": amount * (1 + VAT_RATE),
+                    "סכום המע\"מ": amount * vat_rate,
+                    "סכום כולל מע\"מ": amount * (1 + vat_rate),
                     "כלול בחיוב": "כן",  # INCLUDED
-                    "מספר חשבונית": row["Document number"],
+                    "מספר חשבونית": row["Document number"],
                     "חשבון לקוח משלם": 10003,
                     "שם הלקוח המשלם": "עיריית ראשון לציון",
                     "שם משתמש עיקרי": row["Site name"],
@@ -323,46 +330,18 @@ def transform_final_corrected(src_path: str, dst_path: str):
                     "תאריך הסיום": end_date,
                 })
 
-        # 6. CREDITS - use exact values (negative)
-        credits = float(row.get("Various credits", 0))
-        if credits != 0:
-            amount = -abs(credits) if credits > 0 else credits  # Ensure negative
-            out.append({
-                "מזהה פריט": "P-9002",
-                "תיאור": "זיכויים",
-                "מש\"ב": "",
-                "כמות": 1.0,
-                "יחידת מידה": "",
-                "מחיר יחידה": amount,
-                "סכום ": amount,
-                "סכום המע\"מ": amount * VAT_RATE,
-                "סכום כולל מע\"מ": amount * (1 + VAT_RATE),
-                "כלול בחיוב": "כן",  # INCLUDED
-                "מספר חשבونית": row["Document number"],
-                "חשבון לקוח משלם": 10003,
-                "שם הלקוח המשלם": "עיריית ראשון לציון",
-                "שם משתמש עיקרי": row["Site name"],
-                "מספר  מזהה לחיבור": str(row["Site ID"]).replace("'", "").replace('"', '').strip(),
-                "מספר מונה חח\"י": str(row["Meter IEC long number"]).replace("'", "").strip(),
-                "מספר חוזה": str(row["Contract number"]).replace("'", "").strip(),
-                "תאריך התחלה": start_date,
-                "תאריך הסיום": end_date,
-            })
+        # A chunk's lines are kept as a DataFrame - far smaller than the row dicts
+        if out:
+            frames.append(pd.DataFrame(out))
 
     # Create DataFrame
-    df_out = pd.DataFrame(out)
+    df_out = pd.concat(frames, ignore_index=True)
 
-    # Keep P-50xx even if zero (for display)
-    keep_gross = df_out["מזהה פריט"].str.startswith("P-50")
+    # Keep the gross lines even if zero (for display)
+    keep_gross = df_out["מזהה פריט"].isin(gross_codes)
     df_out = df_out[(df_out["סכום "] != 0) | keep_gross]
 
     # Sort and add row numbers
-    order = {"P-5004": 1, "P-5008": 1, "P-5038": 1, "P-5048": 1,
-             "P-6001": 2,  # Peak discount
-             "P-5005": 3, "P-5009": 3, "P-5039": 3, "P-5049": 3,
-             "P-6002": 4,  # Off-peak discount
-             "P-0001": 6, "P-0005": 7, "P-0011": 8,
-             "P-8001": 9, "P-9001": 10, "P-9002": 11}
     df_out["pr"] = df_out["מזהה פריט"].map(order).fillna(5)
     df_out.sort_values(["מספר חשבונית", "pr"], inplace=True)
     df_out["מספר שורה"] = df_out.groupby("מספר חשבונית").cumcount() + 1
@@ -388,7 +367,6 @@ def transform_final_corrected(src_path: str, dst_path: str):
     # Verify totals
     included_items = df_out[df_out["כלול בחיוב"] == "כן"]
     our_total = included_items["סכום "].sum()
-    csv_total = df["Total cost"].sum()
     gap_amount = csv_total - our_total
     
     # Return processing results as dictionary
@@ -398,7 +376,8 @@ def transform_final_corrected(src_path: str, dst_path: str):
         'gap_amount': float(gap_amount),
         'total_rows': len(df_out),
         'included_items': len(included_items),
-        'output_file': dst_path
+        'output_file': dst_path,
+        **rule_stamp(rules),
     }
     
     return results
@@ -407,16 +386,23 @@ if __name__ == "__main__":
     import sys
     import json
     
-    if len(sys.argv) < 3:
-        print("Usage: python transform_final_corrected.py <input_file> <output_file>")
+    args = sys.argv[1:]
+    rules_version = None
+    if '--rules' in args:
+        i = args.index('--rules')
+        rules_version = args[i + 1] if i + 1 < len(args) else None
+        del args[i:i + 2]
+
+    if len(args) < 2:
+        print("Usage: python transform_final_corrected.py <input_file> <output_file> [--rules VERSION|FILE]")
         sys.exit(1)
     
-    src = sys.argv[1]
-    dst = sys.argv[2]
+    src = args[0]
+    dst = args[1]
     
     try:
         # Process the file
-        result = transform_final_corrected(src, dst)
+        result = transform_final_corrected(src, dst, load_rule_set(rules_version))
         
         # Output result as JSON for the backend to parse
         print(json.dumps(result))
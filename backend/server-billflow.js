@@ -18,6 +18,12 @@ const app = express();
 const PORT = process.env.PORT || 5000;
 const JWT_SECRET = process.env.JWT_SECRET || 'billflow-secret-key';
 
+// Budget of one conversion job - a pathological upload fails instead of exhausting the box
+const CONVERSION_MAX_SECONDS = Number(process.env.CONVERSION_MAX_SECONDS || 600);
+const CONVERSION_MAX_MEMORY_MB = Number(process.env.CONVERSION_MAX_MEMORY_MB || 2048);
+// Grace period before a converter that ignores its budget is cancelled, then killed
+const CONVERSION_KILL_GRACE_MS = 30000;
+
 // Database connection
 const pool = new Pool({
   host: process.env.DB_HOST || 'localhost',
@@ -401,7 +407,7 @@ app.get('/api/files', authenticate, async (req, res) => {
 // Process file
 app.post('/api/process', authenticate, async (req, res) => {
   try {
-    const { fileId } = req.body;
+    const { fileId, quarantine, reprocess } = req.body;
 
     if (!fileId) {
       return res.status(400).json({ success: false, message: 'נדרש מזהה קובץ' });
@@ -433,7 +439,35 @@ app.post('/api/process', authenticate, async (req, res) => {
 
     // Use python3 on Linux/Docker, python on Windows
     const pythonCmd = process.platform === 'win32' ? 'python' : 'python3';
-    const pythonProcess = spawn(pythonCmd, [scriptPath, inputPath, outputDir]);
+    const dedupeIndexDir = path.join(outputDir, '.dedupe_index');
+    // Re-processing an upload reuses its parsed CSV from the cache
+    const parseCacheDir = path.join(outputDir, '.parse_cache');
+    // Per-period dashboard sketches, merged by /api/analytics/sketch-summary
+    const sketchDir = path.join(outputDir, '.sketches');
+    // Per-period site records; each conversion scores its period against them for anomalies
+    const historyDir = path.join(outputDir, '.site_history');
+    const anomalyDb = path.join(outputDir, '.anomalies.db');
+    // Opt-in: rows that cannot be converted go to a rejects CSV instead of failing the whole file
+    const pythonProcess = spawn(pythonCmd, [
+      scriptPath, inputPath, outputDir,
+      ...(quarantine === true ? ['--quarantine'] : []),
+      '--dedupe-index', dedupeIndexDir,
+      // Opt-in: convert an upload that is already in the dedupe index again
+      ...(reprocess === true ? ['--reprocess'] : []),
+      '--parse-cache', parseCacheDir,
+      '--sketch-dir', sketchDir,
+      '--history-dir', historyDir,
+      '--anomaly-db', anomalyDb,
+      '--max-seconds', String(CONVERSION_MAX_SECONDS),
+      '--max-memory-mb', String(CONVERSION_MAX_MEMORY_MB)
+    ]);
+
+    // SIGTERM makes the converter stop at its next checkpoint and clean up; SIGKILL is the last resort
+    let killTimer = null;
+    const cancelTimer = setTimeout(() => {
+      pythonProcess.kill('SIGTERM');
+      killTimer = setTimeout(() => pythonProcess.kill('SIGKILL'), CONVERSION_KILL_GRACE_MS);
+    }, CONVERSION_MAX_SECONDS * 1000 + CONVERSION_KILL_GRACE_MS);
 
     let outputData = '';
     let errorData = '';
@@ -447,6 +481,8 @@ app.post('/api/process', authenticate, async (req, res) => {
     });
 
     pythonProcess.on('close', async (code) => {
+      clearTimeout(cancelTimer);
+      clearTimeout(killTimer);
       if (code === 0) {
         try {
           const results = JSON.parse(outputData);
@@ -501,7 +537,11 @@ app.post('/api/process', authenticate, async (req, res) => {
                 totalRows: results.total_rows,
                 excelFilename: results.excel_filename,
                 tsvFilename: results.tsv_filename,
-                billingPeriod: results.billing_period
+                billingPeriod: results.billing_period,
+                rejectedRows: results.rejected_rows || 0,
+                rejectsFilename: results.rejects_filename,
+                rejectReasons: results.reject_reasons,
+                anomalies: results.anomalies
               }
             });
           } else {
@@ -516,10 +556,46 @@ app.post('/api/process', authenticate, async (req, res) => {
           res.status(500).json({ success: false, message: 'שגיאה בעיבוד התוצאות' });
         }
       } else {
+        // The converter reports structured failures (e.g. duplicates) as JSON on stdout
+        let failure = {};
+        try {
+          failure = JSON.parse(outputData);
+        } catch (e) {}
+
         await pool.query(
           'UPDATE file_uploads SET processing_status = $1, processing_errors = $2 WHERE id = $3',
-          ['error', errorData || 'Processing failed', fileId]
+          ['error', failure.error || errorData || 'Processing failed', fileId]
         );
+
+        if (failure.duplicate) {
+          return res.status(409).json({
+            success: false,
+            isDuplicate: true,
+            message: 'החשבונית הזו כבר נותחה וקיימת במערכת',
+            error: failure.error,
+            dedupe: failure.dedupe
+          });
+        }
+        if (failure.rejected_rows) {
+          return res.status(422).json({
+            success: false,
+            message: 'כל שורות הקובץ נדחו בבדיקת התקינות',
+            error: failure.error,
+            rejectedRows: failure.rejected_rows,
+            rejectsFilename: failure.rejects_filename,
+            rejectReasons: failure.reject_reasons
+          });
+        }
+        if (failure.budget_exceeded || code === null) {
+          return res.status(422).json({
+            success: false,
+            budgetExceeded: true,
+            message: 'עיבוד הקובץ חרג ממגבלת הזמן או הזיכרון ובוטל',
+            error: failure.error || 'Conversion was stopped',
+            stage: failure.stage,
+            reason: failure.reason
+          });
+        }
         res.status(500).json({ success: false, message: 'שגיאה בעיבוד הקובץ', error: errorData });
       }
     });
@@ -587,6 +663,29 @@ app.get('/api/download/tsv', authenticate, async (req, res) => {
   }
 });
 
+// Remove an upload's file hash and documents from the dedupe index
+function unregisterUpload(uploadPath) {
+  const pythonCmd = process.platform === 'win32' ? 'python' : 'python3';
+  return new Promise((resolve) => {
+    const pythonProcess = spawn(pythonCmd, [
+      path.join(__dirname, 'scripts/dedupe_index.py'), 'unregister',
+      path.join(__dirname, 'output', '.dedupe_index'), uploadPath
+    ]);
+    let outputData = '';
+    pythonProcess.stdout.on('data', (data) => {
+      outputData += data.toString();
+    });
+    pythonProcess.on('error', (error) => resolve({ success: false, error: error.message }));
+    pythonProcess.on('close', () => {
+      try {
+        resolve(JSON.parse(outputData));
+      } catch (error) {
+        resolve({ success: false, error: outputData || error.message });
+      }
+    });
+  });
+}
+
 // Delete file
 app.delete('/api/files/:fileId', authenticate, async (req, res) => {
   try {
@@ -603,6 +702,17 @@ app.delete('/api/files/:fileId', authenticate, async (req, res) => {
 
     const file = fileResult.rows[0];
 
+    // A converted upload leaves the dedupe index, so the same bill can be uploaded again
+    const uploadPath = path.join(__dirname, file.file_path);
+    const uploadExists = await fs.access(uploadPath).then(() => true, () => false);
+    if (file.processing_status === 'completed' && uploadExists) {
+      const unregistered = await unregisterUpload(uploadPath);
+      if (!unregistered.success) {
+        console.error('Dedupe unregister error:', unregistered.error);
+        return res.status(500).json({ success: false, message: 'שגיאה במחיקה' });
+      }
+    }
+
     // Delete physical files
     const filesToDelete = [file.file_path, file.excel_path, file.tsv_path].filter(Boolean);
     for (const filePath of filesToDelete) {
@@ -1159,6 +1269,40 @@ app.get('/api/analytics/site/:siteId', authenticate, async (req, res) => {
   }
 });
 
+// Analytics - Approximate statistics over any range of months from the stored sketches
+app.get('/api/analytics/sketch-summary', authenticate, async (req, res) => {
+  const { from, to, top = 10 } = req.query;
+  const periodPattern = /^\d{4}-\d{2}$/;
+  if ((from && !periodPattern.test(from)) || (to && !periodPattern.test(to))) {
+    return res.status(400).json({ success: false, message: 'תקופה לא תקינה' });
+  }
+
+  const pythonCmd = process.platform === 'win32' ? 'python' : 'python3';
+  const args = [
+    path.join(__dirname, 'scripts/site_sketches.py'), 'query',
+    path.join(__dirname, 'output', '.sketches'),
+    '--top', String(parseInt(top) || 10)
+  ];
+  if (from) args.push('--from', from);
+  if (to) args.push('--to', to);
+
+  const pythonProcess = spawn(pythonCmd, args);
+  let outputData = '';
+  pythonProcess.stdout.on('data', (data) => {
+    outputData += data.toString();
+  });
+  pythonProcess.on('close', () => {
+    try {
+      const summary = JSON.parse(outputData);
+      if (!summary.success) throw new Error(summary.error);
+      res.json({ success: true, data: summary });
+    } catch (error) {
+      console.error('Sketch summary error:', error);
+      res.status(500).json({ success: false, message: 'שגיאה בטעינת הסטטיסטיקות' });
+    }
+  });
+});
+
 // Start server
 async function startServer() {
   try {
@@ -20,7 +20,9 @@ import {
   Dialog,
   DialogTitle,
   DialogContent,
-  DialogActions
+  DialogActions,
+  FormControlLabel,
+  Checkbox
 } from '@mui/material'
 import {
   CloudUpload,
@@ -67,6 +69,7 @@ function Upload() {
   const [error, setError] = useState('')
   const [dragOver, setDragOver] = useState(false)
   const [showResults, setShowResults] = useState(false)
+  const [quarantine, setQuarantine] = useState(false)
 
   const handleFileSelect = (file) => {
     if (!file) return
@@ -187,7 +190,8 @@ function Upload() {
     
     try {
       const response = await axios.post('/api/process', {
-        fileId: uploadResult.fileId
+        fileId: uploadResult.fileId,
+        quarantine
       })
       console.log('Process response:', response.data); // Debug log
       const processData = response.data.data || response.data;
@@ -205,6 +209,9 @@ function Upload() {
         } else if (data.message) {
           errorMessage = data.message
         }
+        if (data.rejectedRows) {
+          errorMessage += ` (${data.rejectedRows} שורות נשמרו בקובץ ${data.rejectsFilename})`
+        }
         
         // Show full error details
         if (data.error) {
@@ -418,6 +425,18 @@ function Upload() {
                           <Alert severity="success" sx={{ mb: 2, borderRadius: 2 }}>
                             הקובץ הועלה בהצלחה! מוכן לעיבוד
                           </Alert>
+
+                          <FormControlLabel
+                            sx={{ mb: 2 }}
+                            control={
+                              <Checkbox
+                                checked={quarantine}
+                                onChange={(e) => setQuarantine(e.target.checked)}
+                                disabled={processing}
+                              />
+                            }
+                            label="העבר שורות לא תקינות לקובץ דחיות ועבד את שאר הקובץ"
+                          />
                           
                           <Box sx={{ display: 'flex', gap: 2 }}>
                             <Button
@@ -458,6 +477,12 @@ function Upload() {
                               הקובץ עובד בהצלחה!
                             </Typography>
                           </Alert>
+
+                          {processingResult.rejectedRows > 0 && (
+                            <Alert severity="warning" sx={{ mb: 3, borderRadius: 2 }}>
+                              {processingResult.rejectedRows} שורות לא תקינות לא נכללו בעיבוד ונשמרו בקובץ {processingResult.rejectsFilename}
+                            </Alert>
+                          )}
                           
                           <Box sx={{ display: 'flex', gap: 2, mb: 2 }}>
                             <Button